@@ -3,83 +3,79 @@
 ###############################################################
 
 import numpy as np
+import sys
 import datetime
-from .utils import z_to_xyz, xy_to_xyz, add_time_dim, is_depth_dependent
+from .utils import z_to_xyz, xy_to_xyz, add_time_dim
 
 
-# Helper functions to set up integrands and masks, tiled to be the same dimension as the "data" array
+# Helper functions to set up integrands and masks. Nothing is tiled to the dimension of the "data" array: the integrands keep the dimensions of the grid, and are broadcast against the trailing dimensions of the data.
 
-# Returns area, volume, or distance integrand (option='dA', 'dV', 'dx', or 'dy'), and whichever mask is already applied to the MaskedArray "data".
-def prepare_integrand_mask (option, data, grid, gtype='t', time_dependent=False):
+# Returns area, volume, or distance integrand (option='dA', 'dV', 'dx', or 'dy').
+def prepare_integrand (option, grid, gtype='t'):
     
     if option in ['dA','dV'] and gtype != 't':
-        print('Error (prepare_integrand_mask): non-tracer grids not yet supported')
+        print('Error (prepare_integrand): non-tracer grids not yet supported')
         sys.exit()
     elif option == 'dx' and gtype == 'u':
-        print('Error (prepare_integrand_mask): u-grid not yet supported for dx')
+        print('Error (prepare_integrand): u-grid not yet supported for dx')
         sys.exit()
     elif option == 'dy' and gtype == 'v':
-        print('Error (prepare_integrand_mask): v-grid not yet supported for dy')
+        print('Error (prepare_integrand): v-grid not yet supported for dy')
         sys.exit()
 
-    # Get the mask as 1s and 0s
-    if isinstance(data, np.ma.MaskedArray):
-        mask = np.invert(data.mask).astype(float)
-    else:
-        # No mask, just use 1s everywhere
-        mask = np.ones(data.shape)
-    # Get the integrand
     if option == 'dA':
-        integrand = grid.dA
+        return grid.dA
     elif option == 'dV':
-        integrand = grid.dV
+        return grid.dV
     elif option == 'dx':
-        integrand = grid.dx_s
+        return grid.dx_s
     elif option == 'dy':
-        integrand = grid.dy_w
+        return grid.dy_w
     else:
-        print(('Error (prepare_integrand_mask): invalid option ' + option))
-    if (len(integrand.shape)==2) and is_depth_dependent(data, time_dependent=time_dependent):
-        # There's also a depth dimension; tile in z
-        integrand = xy_to_xyz(integrand, grid)
-    if time_dependent:
-        # Tile in time
-        integrand = add_time_dim(integrand, data.shape[0])
-    return integrand, mask
+        print(('Error (prepare_integrand): invalid option ' + option))
+        sys.exit()
 
 
-# Returns depth integrand and hfac
-def prepare_dz_hfac (data, grid, gtype='t', time_dependent=False):
+# Returns depth integrand (1D, with singleton lat and lon dimensions for broadcasting) and hfac
+def prepare_dz_hfac (grid, gtype='t'):
 
     # Choose the correct integrand of depth
     if gtype == 'w':
         dz = grid.dz_t
     else:
         dz = grid.dz
-    # Make it 3D
-    dz = z_to_xyz(dz, grid)
-    # Get the correct hFac
-    hfac = grid.get_hfac(gtype=gtype)
-    if time_dependent:
-        # There's also a time dimension
-        dz = add_time_dim(dz, data.shape[0])
-        hfac = add_time_dim(hfac, data.shape[0])
-    return dz, hfac
-
+    return dz[:,None,None], grid.get_hfac(gtype=gtype)
 
-# Helper functions to average/integrate over depth, area, or volume (option='average' or 'integrate')
 
-def over_depth (option, data, grid, gtype='t', time_dependent=False):
+# Sum data*weights over the dimensions labelled by "dims" (the last dimensions of data and all dimensions of weights, in einsum notation), keeping the dimensions labelled by "keep". Whatever mask is already applied to the MaskedArray "data" is respected without building any float mask arrays. Returns the weighted sum, and the sum of the weights over the unmasked points. If data is masked, both are MaskedArrays which are masked wherever there were no unmasked points.
+def weighted_sum (data, weights, dims, keep=''):
 
-    dz, hfac = prepare_dz_hfac(data, grid, gtype=gtype, time_dependent=time_dependent)
+    subscripts = '...' + dims + ',' + dims + '->...' + keep
     if isinstance(data, np.ma.MaskedArray):
-        mask = np.invert(data.mask).astype(float)
+        valid = np.invert(np.ma.getmaskarray(data))
+        integral = np.einsum(subscripts, data.filled(0), weights)
+        total = np.einsum(subscripts, valid, weights)
+        # Mask anywhere there were no unmasked points
+        axes = tuple(range(-len(dims), -len(keep) if keep else 0))
+        no_data = np.invert(np.any(valid, axis=axes))
+        # Indexing with () turns 0-dimensional results back into scalars
+        return np.ma.masked_where(no_data, integral)[()], np.ma.masked_where(no_data, total)[()]
     else:
-        mask = np.ones(data.shape)
+        integral = np.einsum(subscripts, data, weights)
+        total = np.einsum(dims+'->'+keep, np.broadcast_to(weights, data.shape[-len(dims):]))
+        return integral, total
+
+
+# Helper functions to average/integrate over depth, area, or volume (option='average' or 'integrate'). Any time dimension is handled by broadcasting, so time_dependent is only kept for compatibility.
+
+def over_depth (option, data, grid, gtype='t', time_dependent=False):
+
+    dz, hfac = prepare_dz_hfac(grid, gtype=gtype)
+    integral, total = weighted_sum(data, dz*hfac, 'kji', keep='ji')
     if option == 'average':
-        return np.sum(data*dz*hfac*mask, axis=-3)/np.sum(dz*hfac*mask, axis=-3)
+        return integral/total
     elif option == 'integrate':
-        return np.sum(data*dz*hfac*mask, axis=-3)
+        return integral
     else:
         print(('Error (over_depth): invalid option ' + option))
         sys.exit()
@@ -87,11 +83,11 @@ def over_depth (option, data, grid, gtype='t', time_dependent=False):
 
 def over_area (option, data, grid, gtype='t', time_dependent=False):
 
-    dA, mask = prepare_integrand_mask('dA', data, grid, gtype=gtype, time_dependent=time_dependent)
+    integral, total = weighted_sum(data, prepare_integrand('dA', grid, gtype=gtype), 'ji')
     if option == 'average':
-        return np.sum(data*dA*mask, axis=(-2,-1))/np.sum(dA*mask, axis=(-2,-1))
+        return integral/total
     elif option == 'integrate':
-        return np.sum(data*dA*mask, axis=(-2,-1))
+        return integral
     else:
         print(('Error (over_area): invalid option ' + option))
         sys.exit()
@@ -99,16 +95,43 @@ def over_area (option, data, grid, gtype='t', time_dependent=False):
 
 def over_volume (option, data, grid, gtype='t', time_dependent=False):
 
-    dV, mask = prepare_integrand_mask('dV', data, grid, gtype=gtype, time_dependent=time_dependent)
+    integral, total = weighted_sum(data, prepare_integrand('dV', grid, gtype=gtype), 'kji')
     if option == 'average':
-        return np.sum(data*dV*mask, axis=(-3,-2,-1))/np.sum(dV*mask, axis=(-3,-2,-1))
+        return integral/total
     elif option == 'integrate':
-        return np.sum(data*dV*mask, axis=(-3,-2,-1))
+        return integral
     else:
         print(('Error (over_volume): invalid option ' + option))
         sys.exit()
 
 
+# Average or integrate (option='average' or 'integrate') over a fixed set of points given by flattened indices and area/volume weights (as returned by Grid.get_mask_index or Grid.get_region_index). The last 2 (or 3 if is_3d=True) dimensions of data are flattened and gathered at these points, and any other dimensions (eg time) are preserved. Any masked values in data are excluded.
+def over_index (option, data, index, weights, is_3d=False):
+
+    if is_3d:
+        num_dim = 3
+    else:
+        num_dim = 2
+    values = np.reshape(data, data.shape[:len(data.shape)-num_dim] + (-1,))[...,index]
+    if isinstance(values, np.ma.MaskedArray) and np.ma.is_masked(values):
+        # Remove masked points from the weights
+        weights = weights*np.invert(np.ma.getmaskarray(values))
+        values = values.filled(0)
+        integral = np.sum(values*weights, axis=-1)
+        total = np.sum(weights, axis=-1)
+    else:
+        values = np.ma.getdata(values)
+        integral = np.dot(values, weights)
+        total = np.sum(weights)
+    if option == 'average':
+        return integral/total
+    elif option == 'integrate':
+        return integral
+    else:
+        print(('Error (over_index): invalid option ' + option))
+        sys.exit()
+
+
 # Now here are the APIs.
 
 
@@ -140,10 +163,7 @@ def vertical_average_column (data, hfac, grid, gtype='t', time_dependent=False):
         dz = grid.dz_t
     else:
         dz = grid.dz
-    if time_dependent:
-        # Add time dimension to dz and hfac
-        dz = add_time_dim(dz, data.shape[0])
-        hfac = add_time_dim(hfac, data.shape[0])
+    # Any time dimension is handled by broadcasting
     return np.sum(data*dz*hfac, axis=-1)/np.sum(dz*hfac, axis=-1)
 
 
@@ -189,11 +209,26 @@ def volume_integral (data, grid, gtype='t', time_dependent=False):
     return over_volume('integrate', data, grid, gtype=gtype, time_dependent=time_dependent)
 
 
+# Area-average (or volume-average if is_3d=True) the given field over the given region (as in Grid.get_region_mask). The indices and weights for the region are only calculated once per Grid, so this is much faster than masking the data and calling area_average or volume_average.
+# data can have any number of leading dimensions (eg time), as long as the last 2 (or 3) are lat x lon (or depth x lat x lon).
+def region_average (data, grid, region, is_3d=False):
+
+    index, weights = grid.get_region_index(region, is_3d=is_3d)
+    return over_index('average', data, index, weights, is_3d=is_3d)
+
+
+# Like region_average, but for area or volume integrals.
+def region_integral (data, grid, region, is_3d=False):
+
+    index, weights = grid.get_region_index(region, is_3d=is_3d)
+    return over_index('integrate', data, index, weights, is_3d=is_3d)
+
+
 # Indefinite integral from south to north.
 def indefinite_ns_integral (data, grid, gtype='t', time_dependent=False):
 
-    dy, mask = prepare_integrand_mask('dy', data, grid, gtype=gtype, time_dependent=time_dependent)
-    return np.cumsum(data*dy*mask, axis=-2)
+    dy = prepare_integrand('dy', grid, gtype=gtype)
+    return np.cumsum(data*dy, axis=-2)
 
 
 # First-order derivatives (just forward difference with the last row/column copied over)
@@ -290,3 +325,84 @@ def time_integral (data, time):
 
     
     
+
+
+# Helper function for linear_trend: given the number of time indices n, the mean time t_mean and data y_mean, and the centred sums of squares and products s_tt = sum((t-t_mean)^2), s_ty = sum((t-t_mean)*(y-y_mean)), s_yy = sum((y-y_mean)^2), calculate the least-squares linear regression in the same way as scipy.stats.linregress. Everything except n and the time values can be arrays (one value per point).
+def trend_statistics (n, t_mean, y_mean, s_tt, s_ty, s_yy):
+
+    from scipy.stats import t as t_dist
+
+    df = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = s_ty/s_tt
+        intercept = y_mean - slope*t_mean
+        # Correlation coefficient is undefined (NaN) if the data is constant
+        r_value = s_ty/np.sqrt(s_tt*s_yy)
+        # Correct for round-off
+        r_value = np.clip(r_value, -1, 1)
+        # Two-sided p-value from the t-distribution
+        t_value = r_value*np.sqrt(df/((1-r_value)*(1+r_value)))
+        p_value = 2*t_dist.sf(np.abs(t_value), df)
+        std_err = np.sqrt((1-r_value**2)*s_yy/s_tt/df)
+    return slope, intercept, r_value, p_value, std_err
+
+
+# Calculate the least-squares linear trend of data (time x any other dimensions) with respect to time (1D array of numbers), at every point at once. Returns slope, intercept, r_value, p_value, std_err (each with the same dimensions as data minus time) just like scipy.stats.linregress, but without looping over points. Any mask on data is ignored (like linregress).
+# For the significance of the trend at each point, compare p_value to the threshold you want, eg p_value < 0.05.
+def linear_trend (time, data):
+
+    time = np.asarray(time, dtype=float)
+    data = np.ma.getdata(data)
+    n = time.size
+    t_mean = np.mean(time)
+    y_mean = np.mean(data, axis=0)
+    # Centre the time and data
+    time_cent = time - t_mean
+    data_cent = data - y_mean
+    s_tt = np.sum(time_cent**2)
+    s_ty = np.tensordot(time_cent, data_cent, axes=(0,0))
+    s_yy = np.sum(data_cent**2, axis=0)
+    return trend_statistics(n, t_mean, y_mean, s_tt, s_ty, s_yy)
+
+
+# Object to calculate the same linear trends as linear_trend, but one time index at a time, so the full timeseries never needs to be in memory. It just keeps running sums of t, t^2, y, t*y, and y^2 at each point. Call add(t, data) for each time index (data can be a scalar or an array of any shape, but it must be the same every time), and then trend() returns slope, intercept, r_value, p_value, std_err as in linear_trend.
+class TrendAccumulator:
+
+    def __init__ (self):
+
+        self.n = 0
+
+
+    def add (self, time, data):
+
+        data = np.ma.getdata(data).astype(float)
+        if self.n == 0:
+            # Sums are with respect to the first time and data values, to avoid losing precision in the sums of squares
+            self.t0 = time
+            self.y0 = np.copy(data)
+            self.sum_t = 0.
+            self.sum_tt = 0.
+            self.sum_y = np.zeros(data.shape)
+            self.sum_ty = np.zeros(data.shape)
+            self.sum_yy = np.zeros(data.shape)
+        t = time - self.t0
+        y = data - self.y0
+        self.n += 1
+        self.sum_t += t
+        self.sum_tt += t**2
+        self.sum_y += y
+        self.sum_ty += t*y
+        self.sum_yy += y**2
+
+
+    def trend (self):
+
+        t_mean = self.sum_t/self.n
+        y_mean = self.sum_y/self.n
+        s_tt = self.sum_tt - self.n*t_mean**2
+        s_ty = self.sum_ty - self.n*t_mean*y_mean
+        s_yy = np.maximum(self.sum_yy - self.n*y_mean**2, 0)
+        slope, intercept, r_value, p_value, std_err = trend_statistics(self.n, t_mean, y_mean, s_tt, s_ty, s_yy)
+        # Shift the intercept back to the original time and data values
+        intercept = intercept + self.y0 - slope*self.t0
+        return slope, intercept, r_value, p_value, std_err
@@ -6,8 +6,10 @@ import numpy as np
 import sys
 import os
 import datetime
+import hashlib
 
-from .utils import days_per_month, real_dir, is_depth_dependent, average_12_months
+from .utils import days_per_month, real_dir, is_depth_dependent
+from .resample import monthly_to_annual_average, month_lengths
 from .constants import months_per_year, days_per_year
 
 
@@ -48,18 +50,25 @@ def read_netcdf (file_path, var_name, time_index=None, t_start=None, t_end=None,
         print(('Error (function read_netcdf): you selected a specific time index (time_index=' + str(time_index) + '), and also want time averaging (time_average=True). Choose one or the other.'))
         sys.exit()
 
-    # Open the file
-    id = nc.Dataset(file_path, 'r')
-
-    # Figure out if this variable is time-dependent. We consider this to be the case if the name of its first dimension clearly looks like a time variable (not case sensitive) or if its first dimension is unlimited.
-    first_dim = id.variables[var_name].dimensions[0]
+    # Check if this variable has already been read into memory by preload_netcdf
+    cached = (file_path, var_name) in netcdf_cache and not return_info and not return_minmax
+    if cached:
+        var_id, time_dependent = netcdf_cache[(file_path, var_name)]
+        if time_dependent:
+            num_time = var_id.shape[0]
+    else:
+        # Open the file
+        id = nc.Dataset(file_path, 'r')
+        var_id = id.variables[var_name]
+        time_dependent = is_time_dependent(id, var_name)
+        if time_dependent:
+            num_time = id.dimensions[var_id.dimensions[0]].size
 
-    if first_dim.upper() in ['T', 'TIME', 'YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE', 'SECOND', 'TIME_INDEX', 'DELTAT'] or id.dimensions[first_dim].isunlimited():
+    if time_dependent:
         # Time-dependent
 
-        num_time = id.dimensions[first_dim].size
         # Check for 1D timeseries variables
-        timeseries = len(id.variables[var_name].shape) == 1
+        timeseries = len(var_id.shape) == 1
 
         # Choose range of time values to consider
         # If t_start and/or t_end are already set, use those bounds
@@ -72,18 +81,17 @@ def read_netcdf (file_path, var_name, time_index=None, t_start=None, t_end=None,
         # Now read the variable
         if time_index is not None:
             if timeseries:
-                data = id.variables[var_name][time_index]
+                data = var_id[time_index]
             else:
-                data = id.variables[var_name][time_index,:]
+                data = var_id[time_index,:]
+        elif time_average:
+            # Time-average one slab at a time, so the whole record is never in memory
+            data = time_average_slabs(iter_var_slabs(var_id, t_start, t_end))
         else:
             if timeseries:
-                data = id.variables[var_name][t_start:t_end]
+                data = var_id[t_start:t_end]
             else:
-                data = id.variables[var_name][t_start:t_end,:]
-
-        # Time-average if necessary
-        if time_average:
-            data = np.mean(data, axis=0)    
+                data = var_id[t_start:t_end,:]
 
     else:
         # Not time-dependent
@@ -93,11 +101,16 @@ def read_netcdf (file_path, var_name, time_index=None, t_start=None, t_end=None,
             sys.exit()
 
         # Read the variable
-        data = id.variables[var_name][:]
+        data = var_id[:]
 
     # Remove any one-dimensional entries
     data = np.squeeze(data)
 
+    if cached:
+        # Make sure the caller can't modify the cached array in place
+        data = data.copy()
+        return data
+
     if return_info:
         try:
             description = id.variables[var_name].description
@@ -119,6 +132,216 @@ def read_netcdf (file_path, var_name, time_index=None, t_start=None, t_end=None,
         return data
 
 
+# Maximum size in bytes of the time slabs read by iter_netcdf (and by read_netcdf when time-averaging), if the number of time indices per slab isn't given.
+max_slab_bytes = 2**28
+
+
+# Helper function for iter_var_slabs and iter_netcdf_list: choose the number of time indices per slab so that a slab of all the given variables (NetCDF Variables or arrays in memory, where the first dimension is time) is at most max_slab_bytes.
+def slab_length (var_ids):
+
+    record_bytes = sum([np.prod(var_id.shape[1:], dtype=int)*var_id.dtype.itemsize for var_id in var_ids])
+    return max(int(max_slab_bytes//max(record_bytes, 1)), 1)
+
+
+# Helper function for read_netcdf and iter_netcdf_list: given a variable (either a NetCDF Variable or an array in memory) where the first dimension is time, yield slabs of at most chunk time indices between t_start and t_end. If chunk is None, it will be chosen by slab_length.
+# As in read_netcdf, any other one-dimensional entries are removed (eg the Zd000001 dimension of 2D variables in files glued with gluemnc), but the time dimension is always kept.
+def iter_var_slabs (var_id, t_start=None, t_end=None, chunk=None):
+
+    t_start, t_end = slice(t_start, t_end).indices(var_id.shape[0])[:2]
+    if chunk is None:
+        chunk = slab_length([var_id])
+    # Dimensions to remove
+    squeeze_axes = tuple([n for n in range(1, len(var_id.shape)) if var_id.shape[n] == 1])
+    for t in range(t_start, t_end, chunk):
+        data = var_id[t:min(t+chunk, t_end),...]
+        if isinstance(var_id, np.ndarray):
+            # Make sure the caller can't modify the array in memory
+            data = data.copy()
+        yield np.squeeze(data, axis=squeeze_axes)
+
+
+# Given an iterator of slabs of data where the first dimension is time (eg from iter_netcdf), calculate the time-average as a running sum in double precision, so only one slab is in memory at once. Masked values are left out of the average as in np.mean, and points with no valid data are masked.
+def time_average_slabs (slabs):
+
+    data_sum = None
+    for data in slabs:
+        if data_sum is None:
+            dtype = data.dtype
+            masked = isinstance(data, np.ma.MaskedArray)
+            data_sum = np.zeros(data.shape[1:])
+            num_valid = np.zeros(data.shape[1:])
+        data_sum += np.sum(np.ma.filled(data, 0), axis=0, dtype=np.float64)
+        num_valid += np.sum(~np.ma.getmaskarray(data), axis=0)
+    if data_sum is None:
+        print('Error (time_average_slabs): no data to average')
+        sys.exit()
+    data = data_sum/np.maximum(num_valid, 1)
+    if masked:
+        data = np.ma.masked_where(num_valid==0, data)
+    if np.issubdtype(dtype, np.floating):
+        data = data.astype(dtype)
+    return data
+
+
+# Read the given variable from the given NetCDF file in slabs of time indices, without loading the whole record into memory. This is a generator which yields each slab in order, always with a time dimension (even if it has only one index), so the caller can reduce each slab before the next one is read. Variables preloaded by preload_netcdf are served from memory.
+
+# Arguments:
+# file_path, var_name: as in read_netcdf
+
+# Optional keyword arguments:
+# chunk: maximum number of time indices in each slab. Default is as many as fit in max_slab_bytes.
+# time_index, t_start, t_end, time_average: as in read_netcdf. If time_index is set or time_average=True, there will be a single slab with one time index.
+
+# Example: calculate the maximum temperature at each time index, one year of monthly data at a time
+# max_temp = []
+# for data in iter_netcdf('output.nc', 'THETA', chunk=12):
+#     max_temp.append(np.amax(data, axis=(1,2,3)))
+# max_temp = np.concatenate(max_temp)
+
+def iter_netcdf (file_path, var_name, chunk=None, time_index=None, t_start=None, t_end=None, time_average=False):
+
+    for [data] in iter_netcdf_list(file_path, [var_name], chunk=chunk, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        yield data
+
+
+# Like iter_netcdf, but for a list of variables which are read together: each iteration yields a list of slabs (one for each variable) covering the same time indices.
+def iter_netcdf_list (file_path, var_list, chunk=None, time_index=None, t_start=None, t_end=None, time_average=False):
+
+    import netCDF4 as nc
+
+    if time_index is not None or time_average:
+        # Only one record, which read_netcdf can deal with
+        yield [np.expand_dims(data, 0) for data in read_netcdf_list(file_path, var_list, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)]
+        return
+    id = None
+    try:
+        var_ids = []
+        for var_name in var_list:
+            if (file_path, var_name) in netcdf_cache:
+                var_id, time_dependent = netcdf_cache[(file_path, var_name)]
+            else:
+                if id is None:
+                    id = nc.Dataset(file_path, 'r')
+                var_id = id.variables[var_name]
+                time_dependent = is_time_dependent(id, var_name)
+            if not time_dependent:
+                print(('Error (iter_netcdf_list): variable ' + var_name + ' in file ' + file_path + ' does not appear to be time-dependent.'))
+                sys.exit()
+            var_ids.append(var_id)
+        if chunk is None:
+            chunk = slab_length(var_ids)
+        for data in zip(*[iter_var_slabs(var_id, t_start=t_start, t_end=t_end, chunk=chunk) for var_id in var_ids]):
+            yield list(data)
+    finally:
+        if id is not None:
+            id.close()
+
+
+# NetCDFReader object to read consecutive time slabs of variables from a single (eg multi-decade) NetCDF file, keeping the file open between reads. This avoids reopening the file for every slab like read_netcdf does, which would throw away the HDF5 chunk cache and parse the metadata again each time. After each read, the next slab of the same length is read in a background thread, so that it's ready by the time the caller has processed the current one. Only one thread ever reads from the file at a time.
+# Make sure you call close when you're done with the file.
+
+# Example: convert one year of daily data at a time
+# reader = NetCDFReader('TREFHT_1920-2005.nc')
+# for year in range(1920, 2005+1):
+#     t_start = (year-1920)*365
+#     data = reader.read('TREFHT', t_start, t_start+365)
+#     ...
+# reader.close()
+class NetCDFReader:
+
+    # Initialisation arguments:
+    # file_path: path to NetCDF file
+    def __init__ (self, file_path):
+
+        import netCDF4 as nc
+
+        self.file_path = file_path
+        self.id = nc.Dataset(file_path, 'r')
+        self.executor = None
+        # [var_name, t_start, t_end] of the slab being read in the background, and the Future which will return it
+        self.next_slab = None
+        self.future = None
+
+
+    # Helper function to read a slab of the given variable between t_start and t_end.
+    def read_slab (self, var_name, t_start, t_end):
+        return self.id.variables[var_name][t_start:t_end,...]
+
+
+    # Wait for any slab being read in the background, and return it along with its [var_name, t_start, t_end] (or None, None if there isn't one).
+    def finish_prefetch (self):
+
+        if self.future is None:
+            return None, None
+        data = self.future.result()
+        next_slab = self.next_slab
+        self.next_slab = None
+        self.future = None
+        return next_slab, data
+
+
+    # Read the given time-dependent variable between the time indices t_start and t_end (non-negative, following python conventions as in read_netcdf), with any one-dimensional entries removed.
+    # If prefetch=True (default), the next t_end-t_start time indices (if there are any left in the file) will then be read in the background. Set it to False if you won't need them, eg on the last slab you want.
+    def read (self, var_name, t_start, t_end, prefetch=True):
+
+        next_slab, data = self.finish_prefetch()
+        if next_slab != [var_name, t_start, t_end]:
+            # Didn't ask for the slab we prefetched
+            data = self.read_slab(var_name, t_start, t_end)
+        num_time = self.id.variables[var_name].shape[0]
+        if prefetch and t_end < num_time:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.next_slab = [var_name, t_end, min(2*t_end-t_start, num_time)]
+            self.future = self.executor.submit(self.read_slab, *self.next_slab)
+        return np.squeeze(data)
+
+
+    # Close the file, once any background read has finished.
+    def close (self):
+
+        self.finish_prefetch()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.id.close()
+
+
+# Helper function for read_netcdf and preload_netcdf: given an open NetCDF Dataset, figure out if the given variable is time-dependent. We consider this to be the case if the name of its first dimension clearly looks like a time variable (not case sensitive) or if its first dimension is unlimited.
+def is_time_dependent (id, var_name):
+
+    first_dim = id.variables[var_name].dimensions[0]
+    return first_dim.upper() in ['T', 'TIME', 'YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE', 'SECOND', 'TIME_INDEX', 'DELTAT'] or id.dimensions[first_dim].isunlimited()
+
+
+# Variables which have been read into memory by preload_netcdf, so that later calls to read_netcdf for the same file and variable don't have to go back to the disk. Keys are (file_path, var_name) and values are [data, time_dependent].
+netcdf_cache = {}
+
+
+# Read the given list of variables from the given NetCDF file in a single pass (opening the file once), and keep them in memory so that subsequent calls to read_netcdf for any of these variables in this file will be served from the cache. This is useful when many different calculations need the same variables from the same file, eg precompute_timeseries which would otherwise read THETA and SALT once for every timeseries type. Variables which aren't in the file are skipped.
+# Make sure you call clear_netcdf_cache when you're done, as the whole record of each variable is held in memory.
+def preload_netcdf (file_path, var_list):
+
+    import netCDF4 as nc
+
+    id = nc.Dataset(file_path, 'r')
+    for var_name in var_list:
+        if var_name not in id.variables or (file_path, var_name) in netcdf_cache:
+            continue
+        netcdf_cache[(file_path, var_name)] = [id.variables[var_name][:], is_time_dependent(id, var_name)]
+    id.close()
+
+
+# Remove everything from the cache built by preload_netcdf, and the time axes saved by netcdf_time. If file_path is set, only remove the variables from that file.
+def clear_netcdf_cache (file_path=None):
+
+    for cache in [netcdf_cache, netcdf_time_cache]:
+        for key in list(cache.keys()):
+            if file_path is None or key[0] == file_path:
+                del cache[key]
+
+
 # Read the time axis from a NetCDF file. The default behaviour is to read and return the entire axis as Date objects, but you can also select a subset of time indices, and/or return as scalars - see optional keyword arguments.
 
 # Arguments:
@@ -136,47 +359,35 @@ def netcdf_time (file_path, var_name='time', t_start=None, t_end=None, return_da
 
     import netCDF4 as nc
 
-    # Open the file and get the length of the record
-    id = nc.Dataset(file_path, 'r')
-    time_id = id.variables[var_name]
-    units = time_id.units
-    try:
-        calendar = time_id.calendar
-    except(AttributeError):
-        calendar = 'standard'
-    num_time = time_id.size
-
-    # Choose range of time values to consider
-    # If t_start and/or t_end are already set, use those bounds
-    # Otherwise, start at the first time_index and/or end at the last time_index in the file
-    if t_start is None:
-        t_start = 0
-    if t_end is None:
-        t_end = num_time
-
-    # Read the variable
     if return_date:
-        # Return as handy Date objects
-        time = nc.num2date(time_id[t_start:t_end], units=units, calendar=calendar)
+        # The whole axis is decoded once and saved in netcdf_time_cache, until the file is modified
+        key = (file_path, var_name, monthly)
+        mtime = os.path.getmtime(file_path)
+        if key not in netcdf_time_cache or netcdf_time_cache[key][0] != mtime:
+            id = nc.Dataset(file_path, 'r')
+            time_id = id.variables[var_name]
+            units = time_id.units
+            try:
+                calendar = time_id.calendar
+            except(AttributeError):
+                calendar = 'standard'
+            time = decode_time(time_id[:], units, calendar, monthly=monthly)
+            id.close()
+            netcdf_time_cache[key] = [mtime, time, units, calendar]
+        mtime, time, units, calendar = netcdf_time_cache[key]
+        # Select the range of time values (default everything), and make sure the caller can't modify the cached array in place
+        time = time[t_start:t_end].copy()
     else:
         # Return just as scalar values
+        id = nc.Dataset(file_path, 'r')
+        time_id = id.variables[var_name]
+        units = time_id.units
+        try:
+            calendar = time_id.calendar
+        except(AttributeError):
+            calendar = 'standard'
         time = time_id[t_start:t_end]
-    id.close()
-
-    if return_date:
-        # Want to convert to a datetime object
-        if monthly:
-            # Back up to previous month
-            for t in range(time.size):
-                month = time[t].month-1
-                year = time[t].year
-                if month < 1:
-                    month += 12
-                    year -= 1
-                time[t] = datetime.datetime(year, month, 1)
-        else:
-            for t in range(time.size):
-                time[t] = datetime.datetime(time[t].year, time[t].month, time[t].day)             
+        id.close()
 
     if return_units:
         return time, units, calendar
@@ -184,6 +395,53 @@ def netcdf_time (file_path, var_name='time', t_start=None, t_end=None, return_da
         return time
 
 
+# Time axes which have been decoded by netcdf_time. Keys are (file_path, var_name, monthly) and values are [modification time of the file, time, units, calendar].
+netcdf_time_cache = {}
+
+
+# Helper function for netcdf_time: convert an array of time values with the given units and calendar to an array of datetime objects, without looping over each time index. If monthly=True, subtract one month from each timestamp and set it to the first of the month; otherwise, truncate each timestamp to the day.
+def decode_time (values, units, calendar, monthly=True):
+
+    import netCDF4 as nc
+
+    values = np.ma.filled(np.asarray(values, dtype=float), np.nan)
+    # Number of seconds in each time unit
+    unit_seconds = {'second':1, 'seconds':1, 'sec':1, 'secs':1, 's':1, 'minute':60, 'minutes':60, 'min':60, 'mins':60, 'hour':3600, 'hours':3600, 'hr':3600, 'hrs':3600, 'h':3600, 'day':86400, 'days':86400, 'd':86400}
+    unit = units.split(' since ')[0].strip().lower()
+    ref = nc.num2date(0, units=units, calendar=calendar, only_use_cftime_datetimes=False)
+    if calendar in ['standard', 'gregorian', 'proleptic_gregorian'] and unit in unit_seconds and isinstance(ref, datetime.datetime) and ref.year > 1582 and np.all(values >= 0):
+        # Calendar matches numpy's: do the arithmetic directly with datetime64
+        offsets = np.round(values*unit_seconds[unit]*1e6).astype(np.int64).astype('timedelta64[us]')
+        time = np.datetime64(ref, 'us') + offsets
+        if monthly:
+            time = time.astype('datetime64[M]') - np.timedelta64(1, 'M')
+        else:
+            time = time.astype('datetime64[D]')
+    else:
+        # Decode with cftime, then just extract the dates
+        dates = nc.num2date(values, units=units, calendar=calendar)
+        years = np.array([date.year for date in dates])
+        months = np.array([date.month for date in dates])
+        if monthly:
+            time = ((years-1970)*12 + months-2).astype('datetime64[M]')
+        else:
+            # Make sure days which don't exist in the standard calendar (eg 30 February in a 360-day calendar) stay within the month
+            days = np.minimum(np.array([date.day for date in dates]), month_lengths(years, months))
+            time = ((years-1970)*12 + months-1).astype('datetime64[M]').astype('datetime64[D]') + (days-1).astype('timedelta64[D]')
+    # Convert to an array of datetime objects
+    return time.astype('datetime64[us]').astype(object)
+
+
+# Return a dictionary with the size, modification time and md5 checksum of the given file, to check later whether it has changed.
+def file_checksum (file_path, chunk_size=2**24):
+
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return {'size':os.path.getsize(file_path), 'mtime':os.path.getmtime(file_path), 'md5':md5.hexdigest()}
+
+
 # Given two NetCDF files, figure out which one the given variable is in.
 def find_variable (file_path_1, file_path_2, var_name):
 
@@ -225,6 +483,25 @@ def set_dtype (prec, endian):
     return dtype
 
 
+# Read-only memory-mapped array returned by read_binary with mmap=True. It behaves like a regular array, but nothing is read from disk until it is indexed, and then only the selected values are read (eg data[t,:] reads a single time record) and converted to native byte order. Calculations done on the whole array (eg np.mean(data, axis=0)) stream through the file and return regular arrays in memory.
+class BinaryMemmap (np.memmap):
+
+    def __getitem__ (self, index):
+        data = super(BinaryMemmap, self).__getitem__(index)
+        if isinstance(data, np.ndarray):
+            # Copy the selected values out of the file, in native byte order
+            data = np.array(data, dtype=data.dtype.newbyteorder('='))
+        return data
+
+    def __array_wrap__ (self, arr, context=None, return_scalar=False):
+        arr = super(BinaryMemmap, self).__array_wrap__(arr, context)
+        if arr is self:
+            return arr
+        if arr.shape == ():
+            return arr[()]
+        return arr.view(np.ndarray)
+
+
 # Read an array from a binary file and reshape to the correct dimensions. If it's an MITgcm array, use rdmds (built into MITgcmutils) instead.
 
 # Arguments:
@@ -235,8 +512,9 @@ def set_dtype (prec, endian):
 # Optional keyword arguments:
 # prec: precision of data: 32 (default) or 64
 # endian: endian-ness of data: 'big' (default) or 'little'
+# mmap: if True, don't read the file into memory, but return a read-only BinaryMemmap of the correct shape, which only reads the time records (or other subsets) which are actually accessed. This is much faster if you only need part of a big file, eg the last time index or a time-mean. Default False.
 
-def read_binary (filename, grid_sizes, dimensions, prec=32, endian='big'):
+def read_binary (filename, grid_sizes, dimensions, prec=32, endian='big', mmap=False):
 
     print(('Reading ' + filename))
 
@@ -252,8 +530,13 @@ def read_binary (filename, grid_sizes, dimensions, prec=32, endian='big'):
         print(('Error (read_binary): ' + dimensions + ' is depth-dependent, but your grid sizes are 2D.'))
         sys.exit()
 
-    # Read data
-    data = np.fromfile(filename, dtype=dtype)
+    if mmap:
+        # Don't read anything yet: just find the number of values in the file
+        data_size = os.path.getsize(filename)//np.dtype(dtype).itemsize
+    else:
+        # Read data
+        data = np.fromfile(filename, dtype=dtype)
+        data_size = data.size
 
     # Expected shape of data
     shape = []
@@ -272,26 +555,30 @@ def read_binary (filename, grid_sizes, dimensions, prec=32, endian='big'):
 
     if 't' in dimensions:
         # Time-dependent field; figure out how many timesteps
-        if np.mod(data.size, size0) != 0:
+        if np.mod(data_size, size0) != 0:
             print('Error (read_binary): incorrect dimensions or precision')
             sys.exit()
-        num_time = data.size//size0
+        num_time = data_size//size0
         shape = [num_time] + shape
     else:
         # Time-independent field; just do error checking
-        if data.size != size0:
+        if data_size != size0:
             print('Error (read_binary): incorrect dimensions or precision')
             sys.exit()
 
+    if mmap:
+        # Map the file with the correct shape
+        return BinaryMemmap(filename, dtype=dtype, mode='r', shape=tuple(shape))
     # Reshape the data and return
     return np.reshape(data, shape)            
 
         
 
-# Write an array ("data"), of any dimension, to a binary file ("file_path"). Optional keyword arguments ("prec" and "endian") are as in function read_binary.
-def write_binary (data, file_path, prec=32, endian='big'):
+# Write an array ("data"), of any dimension, to a binary file ("file_path"). Optional keyword arguments ("prec" and "endian") are as in function read_binary. If append=True, the data will be added to the end of the existing file (eg the next slab of time indices) instead of overwriting it.
+def write_binary (data, file_path, prec=32, endian='big', append=False):
 
-    print(('Writing ' + file_path))
+    if not append:
+        print(('Writing ' + file_path))
 
     if isinstance(data, np.ma.MaskedArray):
         # Need to remove the mask
@@ -302,7 +589,10 @@ def write_binary (data, file_path, prec=32, endian='big'):
     data = data.astype(dtype)
 
     # Write to file
-    id = open(file_path, 'w')
+    if append:
+        id = open(file_path, 'a')
+    else:
+        id = open(file_path, 'w')
     data.tofile(id)
     id.close()
 
@@ -314,12 +604,24 @@ class NCfile:
     # filename: name for desired NetCDF file
     # grid: Grid object
     # dimensions: string containing dimension characters in any order, eg 'xyz' or 'xyt'. Include all the dimensions (from x, y, z, t) that any of the variables in the file will need.
-    def __init__ (self, filename, grid, dimensions):
+
+    # Optional keyword arguments (defaults for every variable added with add_variable, which can also override them):
+    # zlib: boolean indicating to compress variables (default False)
+    # complevel: compression level from 1 to 9 (default 4)
+    # shuffle: boolean indicating to apply the HDF5 shuffle filter before compressing, which usually improves compression (default True)
+    # chunk_option: layout of the variables on disk, to match how they will be read - see function nc_chunk_shape. Default None uses the NetCDF library's chunking.
+    def __init__ (self, filename, grid, dimensions, zlib=False, complevel=4, shuffle=True, chunk_option=None):
 
         import netCDF4 as nc
 
         # Open the file
         self.id = nc.Dataset(filename, 'w')
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.chunk_option = chunk_option
+        # Number of time indices written so far to each time-dependent variable (the time dimension itself is shared, so can't tell us this)
+        self.num_written = {}
 
         # Set up the grid
         if 't' in dimensions:
@@ -362,7 +664,7 @@ class NCfile:
 
     # Arguments:
     # var_name: desired name for variable
-    # data: array of data for that variable
+    # data: array of data for that variable. If it's None, the variable is created but nothing is written yet, so that it can be filled one time slab at a time with append_time_slab.
     # dimensions: as in initialisation
 
     # Optional keyword arguments:
@@ -370,9 +672,14 @@ class NCfile:
     # long_name: descriptor for this variable
     # units: units for this variable
     # vmin, vmax: optional attributes
-    # dtype: data type of variable (default 'f8' which is float)
+    # dtype: data type of variable (default 'f8' which is float; 'f4' halves the size on disk)
+    # zlib, complevel, shuffle, chunk_option: as in initialisation; default is whatever was set there
+    # chunksizes: list of chunk sizes along each dimension, overriding chunk_option
+    # num_time: number of time indices the variable will have, if data is None and chunk_option='point'
+    # pack: boolean indicating to pack the data into 16-bit integers with float32 scale_factor and add_offset attributes (unpacked automatically when the file is read, eg by read_netcdf). This keeps about 4-5 significant digits. Default False.
+    # pack_range: [min, max] of the values to pack. Default is the range of data, so this must be set if data is None.
 
-    def add_variable (self, var_name, data, dimensions, gtype='t', long_name=None, units=None, calendar=None, vmin=None, vmax=None, dtype='f8'):
+    def add_variable (self, var_name, data, dimensions, gtype='t', long_name=None, units=None, calendar=None, vmin=None, vmax=None, dtype='f8', zlib=None, complevel=None, shuffle=None, chunk_option=None, chunksizes=None, num_time=None, pack=False, pack_range=None):
 
         # Sort out dimensions
         shape = []
@@ -395,8 +702,47 @@ class NCfile:
                 shape.append('X')
         shape = tuple(shape)
 
+        if zlib is None:
+            zlib = self.zlib
+        if complevel is None:
+            complevel = self.complevel
+        if shuffle is None:
+            shuffle = self.shuffle
+        if chunk_option is None:
+            chunk_option = self.chunk_option
+        time_dependent = 't' in dimensions
+        if chunksizes is None and chunk_option is not None:
+            # Get the size of each dimension, taking the length of the time axis from the data if there is any
+            sizes = [len(self.id.dimensions[dim]) for dim in shape]
+            if time_dependent:
+                if data is not None:
+                    sizes[0] = np.shape(data)[0]
+                elif num_time is not None:
+                    sizes[0] = num_time
+                elif chunk_option == 'point':
+                    print(('Error (add_variable): set num_time to chunk ' + var_name + ' for point timeseries before any data is written.'))
+                    sys.exit()
+            chunksizes = nc_chunk_shape(sizes, chunk_option, np.dtype(dtype).itemsize, time_dependent=time_dependent)
+        fill_value = None
+        if pack:
+            if pack_range is None:
+                if data is None:
+                    print(('Error (add_variable): set pack_range to pack ' + var_name + ' before any data is written.'))
+                    sys.exit()
+                pack_range = [np.ma.min(data), np.ma.max(data)]
+            dtype = 'i2'
+            # Reserve the smallest integer for missing values
+            fill_value = np.iinfo(np.int16).min
+            add_offset = np.float32(0.5*(pack_range[0] + pack_range[1]))
+            scale_factor = np.float32((pack_range[1] - pack_range[0])/(2.0**16 - 4))
+            if scale_factor == 0:
+                scale_factor = np.float32(1)
+
         # Initialise the variable
-        self.id.createVariable(var_name, dtype, shape)
+        self.id.createVariable(var_name, dtype, shape, zlib=zlib, complevel=complevel, shuffle=shuffle, chunksizes=chunksizes, fill_value=fill_value)
+        if pack:
+            self.id.variables[var_name].scale_factor = scale_factor
+            self.id.variables[var_name].add_offset = add_offset
         if long_name is not None:
             self.id.variables[var_name].long_name = long_name
         if units is not None:
@@ -408,8 +754,26 @@ class NCfile:
         if vmax is not None:
             self.id.variables[var_name].vmax = vmax
 
-        # Fill data
-        self.id.variables[var_name][:] = data
+        if time_dependent:
+            self.num_written[var_name] = 0
+        if data is not None:
+            if time_dependent:
+                self.append_time_slab(var_name, data)
+            else:
+                # Fill data
+                self.id.variables[var_name][:] = data
+
+
+    # Write the given slab of data to the end of the given time-dependent variable (already created by add_variable), so the whole record never has to be in memory at once. The slab can have a time dimension (of any length) or not, in which case it is a single time index.
+    def append_time_slab (self, var_name, data):
+
+        var_id = self.id.variables[var_name]
+        if np.ndim(data) < len(var_id.dimensions):
+            data = np.expand_dims(data, 0)
+        t_start = self.num_written[var_name]
+        t_end = t_start + np.shape(data)[0]
+        var_id[t_start:t_end,...] = data
+        self.num_written[var_name] = t_end
 
 
     # Special case to simplify writing the time variable.
@@ -440,6 +804,37 @@ class NCfile:
         self.id.close()
 
 
+# Target size in bytes of each chunk chosen by nc_chunk_shape.
+nc_chunk_bytes = 2**20
+
+
+# Helper function for NCfile: choose the chunk sizes for a variable of the given shape (with time as the first dimension if time_dependent=True) and size in bytes of each value, to match the way it will be read:
+# chunk_option='slab': each chunk is a single time index, so that one time index (or a slab of them) can be read without touching the rest of the file, eg for maps, animations or time-averaging with iter_netcdf. If one time index is bigger than nc_chunk_bytes, it is split along the outer spatial dimensions.
+# chunk_option='point': each chunk is the whole time axis at a small patch of horizontal points (and a single depth), so that the timeseries at a point can be read from one chunk.
+# Returns None (let the NetCDF library decide) for variables which have no time dimension, or only a time dimension in the 'slab' case.
+def nc_chunk_shape (shape, chunk_option, itemsize, time_dependent=True):
+
+    shape = [max(size, 1) for size in shape]
+    if not time_dependent or (chunk_option == 'slab' and len(shape) == 1):
+        return None
+    max_points = max(nc_chunk_bytes//itemsize, 1)
+    if chunk_option == 'slab':
+        chunks = [1] + shape[1:]
+        for n in range(1, len(shape)):
+            chunks[n] = max(min(chunks[n], max_points//int(np.prod(chunks[n+1:]))), 1)
+    elif chunk_option == 'point':
+        chunks = [1]*len(shape)
+        chunks[0] = min(shape[0], max_points)
+        # Square patch of points in the last two (horizontal) dimensions
+        side = max(int(np.sqrt(max_points//chunks[0])), 1)
+        for n in range(max(len(shape)-2, 1), len(shape)):
+            chunks[n] = min(shape[n], side)
+    else:
+        print(('Error (nc_chunk_shape): invalid chunk_option ' + str(chunk_option)))
+        sys.exit()
+    return chunks
+
+
 
 # Basic version of NCfile for a simple lat-lon file on any regular grid (eg intermediate domain generation steps, see make_domain.py).
 class NCfile_basiclatlon:
@@ -519,18 +914,88 @@ def write_netcdf_very_basic (data, var_name, filename, use_3d=False):
     id.variables[var_name][:] = data
     id.close()
 
+# MultiFileDataset object to treat a chronological list of NetCDF files (eg from segment_file_paths or get_output_files) as a single record with one time axis. The time axis of each file is only read once, at initialisation; after that, global time indices can be located, and slices of a variable read across file boundaries, without rescanning all the files.
+class MultiFileDataset:
+
+    # Initialisation arguments:
+    # file_paths: list of NetCDF files in chronological order
+    # var_name, monthly: as in function netcdf_time
+    def __init__ (self, file_paths, var_name='time', monthly=True):
+
+        self.file_paths = list(file_paths)
+        self.file_times = [netcdf_time(f, var_name=var_name, monthly=monthly) for f in self.file_paths]
+        self.num_time = np.array([time.size for time in self.file_times], dtype=int)
+        # Global time index at which each file starts, followed by the total number of time indices
+        self.offsets = np.concatenate(([0], np.cumsum(self.num_time)))
+        self.size = int(self.offsets[-1])
+        if self.size > 0:
+            self.time = np.concatenate(self.file_times)
+        else:
+            self.time = np.array([])
+
+
+    # Given a global time index (0-indexed relative to the beginning of the first file; negative values count back from the end), return the index of the file it falls within, and what that time index is relative to the beginning of that file.
+    def locate (self, time_index):
+
+        if time_index < 0:
+            time_index += self.size
+        if time_index < 0 or time_index >= self.size:
+            print(("Error (locate): this simulation isn't long enough to contain time_index=" + str(time_index)))
+            sys.exit()
+        # Files with no time indices are skipped
+        n = np.searchsorted(self.offsets, time_index, side='right') - 1
+        return int(n), int(time_index - self.offsets[n])
+
+
+    # Read the given variable between the global time indices t_start and t_end (following python conventions as in read_netcdf; default is the whole record) into a single array, preallocated and filled one file at a time. The time dimension is always kept.
+    def read (self, var_name, t_start=None, t_end=None):
+
+        import netCDF4 as nc
+
+        t_start, t_end, step = slice(t_start, t_end).indices(self.size)
+        if t_end <= t_start:
+            print(('Error (read): no time indices between ' + str(t_start) + ' and ' + str(t_end)))
+            sys.exit()
+        data = None
+        for n in range(self.locate(t_start)[0], self.locate(t_end-1)[0]+1):
+            # Range of time indices to read from this file
+            t0 = max(t_start-self.offsets[n], 0)
+            t1 = min(t_end-self.offsets[n], self.num_time[n])
+            if t1 <= t0:
+                continue
+            id = nc.Dataset(self.file_paths[n], 'r')
+            data_tmp = id.variables[var_name][t0:t1,...]
+            id.close()
+            if data is None:
+                data = np.ma.empty([t_end-t_start] + list(data_tmp.shape[1:]), dtype=data_tmp.dtype)
+            t_out = self.offsets[n] + t0 - t_start
+            data[t_out:t_out+t1-t0,...] = data_tmp
+        return data
+
+
+# MultiFileDataset objects built by get_multi_file_dataset. Keys are (file_paths, var_name, monthly) and values are [modification times of the files, MultiFileDataset].
+multi_file_cache = {}
+
+
+# Return a MultiFileDataset for the given list of files, reusing the one from a previous call if none of the files have been modified since (eg by a simulation which is still running).
+def get_multi_file_dataset (file_paths, var_name='time', monthly=True):
+
+    key = (tuple(file_paths), var_name, monthly)
+    mtimes = [os.path.getmtime(f) for f in file_paths]
+    if key not in multi_file_cache or multi_file_cache[key][0] != mtimes:
+        multi_file_cache[key] = [mtimes, MultiFileDataset(file_paths, var_name=var_name, monthly=monthly)]
+    return multi_file_cache[key][1]
+
+
 # Given a list of output files (chronological, could concatenate to make the entire simulation) and a time index we want relative to the beginning of the simulation (0-indexed), find the individual file that time index falls within, and what that time index is relative to the beginning of that file.
 def find_time_index (file_list, time_index):
 
-    for file_path in file_list:
-        num_time = netcdf_time(file_path).size
-        if num_time > time_index:
-            return file_path, time_index
-        else:
-            time_index -= num_time
-    # If we're still here, we didn't find it
-    print(("Error (find_time_index): this simulation isn't long enough to contain time_index=" + str(time_index)))
-    sys.exit()
+    data = get_multi_file_dataset(file_list)
+    if time_index >= data.size:
+        print(("Error (find_time_index): this simulation isn't long enough to contain time_index=" + str(time_index)))
+        sys.exit()
+    n, time_index = data.locate(time_index)
+    return data.file_paths[n], time_index
 
 
 # Given information about a CMIP6 dataset (path to model directory, ensemble member, experiment, variable, and time code eg 'day' or 'Omon'), return a list of the files containing this data, and the years covered by each file.
@@ -627,20 +1092,10 @@ def read_iceprod (file_path, time_index=None, t_start=None, t_end=None, time_ave
 # Calculate annual averages of the given variable in the given (chronological) list of files.
 def read_annual_average (var_name, file_paths, return_years=False):
 
-    # Inner function to calculate the average and save to data_annual
-    def update_data_annual (data_read, t0, year, data_annual):
-        data_avg = average_12_months(data_read, t0, calendar=calendar, year=year)
-        # Add a dummy time dimension
-        data_avg = np.expand_dims(data_avg, axis=0)
-        if data_annual is None:
-            data_annual = data_avg
-        else:
-            data_annual = np.concatenate((data_annual, data_avg), axis=0)
-        return data_annual
-
-    # Now read all the data
+    # Annual averages from each file, to be concatenated at the end
+    data_annual = []
+    # Partial year carried over from the end of the last file
     data_tmp = None
-    data_annual = None
     years = []
     for f in file_paths:
         time, units, calendar = netcdf_time(f, return_units=True)
@@ -654,26 +1109,29 @@ def read_annual_average (var_name, file_paths, return_years=False):
             if data.shape[0] < num_months:
                 print(('Error (read_annual_average): '+f+' has only '+str(data.shape[0])+' time indices. This is too short. Concatenate it with the next one and re-run.'))
                 sys.exit()
-            data_tmp2 = data[:num_months,...]
-            data_year = np.concatenate((data_tmp, data_tmp2), axis=0)
-            data_annual = update_data_annual(data_year, 0, time[0].year, data_annual)
+            data_year = np.concatenate((data_tmp, data[:num_months,...]), axis=0)
+            data_annual.append(monthly_to_annual_average(data_year, [time[0].year], calendar=calendar))
             t_start = num_months
         else:
             # This file starts at the beginning of a year
             t_start = 0
-        # Loop over complete years
-        for t in range(t_start, (time.size-t_start)//12*12, 12):
-            print((time[t].year))
-            years.append(time[t].year)
-            data_annual = update_data_annual(data, t, time[t].year, data_annual)
-        if t+12 < time.size:
+        # Average all the complete years at once
+        t_end = t_start + (time.size-t_start)//12*12
+        years_file = [time[t].year for t in range(t_start, t_end, 12)]
+        for year in years_file:
+            print(year)
+        years += years_file
+        if len(years_file) > 0:
+            data_annual.append(monthly_to_annual_average(data[t_start:t_end,...], years_file, calendar=calendar))
+        if t_end < time.size:
             # Read partial year from end
-            data_tmp = data[t+12:,...]
-            print((time[t+12].year))
-            years.append(time[t+12].year)
+            data_tmp = data[t_end:,...]
+            print((time[t_end].year))
+            years.append(time[t_end].year)
         else:
             # Reset
             data_tmp = None
+    data_annual = np.ma.concatenate(data_annual, axis=0)
 
     if return_years:
         return data_annual, years
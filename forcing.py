@@ -5,13 +5,14 @@
 import numpy as np
 import sys
 import os
+import json
 import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 
 from .grid import Grid, SOSEGrid, grid_check_split, choose_grid, ERA5Grid, UKESMGrid, PACEGrid, dA_from_latlon
-from .file_io import read_netcdf, write_binary, NCfile, netcdf_time, read_binary, find_cmip6_files, find_lens_file
-from .utils import real_dir, fix_lon_range, mask_land_ice, ice_shelf_front_points, dist_btw_points, days_per_month, split_longitude, xy_to_xyz, z_to_xyz
+from .file_io import read_netcdf, write_binary, NCfile, netcdf_time, read_binary, find_cmip6_files, find_lens_file, iter_netcdf, max_slab_bytes, NetCDFReader
+from .utils import real_dir, fix_lon_range, mask_land_ice, ice_shelf_front_points, distance_to_mask, days_per_month, split_longitude, xy_to_xyz, z_to_xyz, daily_to_monthly
 from .interpolation import interp_nonreg_xy, interp_reg, extend_into_mask, discard_and_fill, smooth_xy, interp_slice_helper, interp_reg_xy
 from .constants import temp_C2K, Lv, Rv, es0, sh_coeff, rho_fw, sec_per_year, kg_per_Gt
 from .calculus import area_integral
@@ -153,8 +154,134 @@ def sose_sss_restoring (grid_path, sose_dir, output_salt_file, output_mask_file,
         ncfile.close()
 
 
+# A unit of work for run_forcing_tasks (eg one variable for one year): calling function(*args, **kwargs) writes all the files in out_files. depends is a list of the names of other tasks which must finish first (eg because this task reads their output).
+class ForcingTask:
+
+    def __init__ (self, name, function, args=(), kwargs=None, out_files=None, depends=None):
+
+        self.name = name
+        self.function = function
+        self.args = args
+        if kwargs is None:
+            kwargs = {}
+        self.kwargs = kwargs
+        if out_files is None:
+            out_files = []
+        self.out_files = out_files
+        if depends is None:
+            depends = []
+        self.depends = depends
+
+    # Path to the marker file which records that the task finished, and the sizes of the files it wrote.
+    def marker_file (self):
+        return self.out_files[0] + '.done'
+
+    # Check whether the task has already finished: the marker file exists, and all the output files are still there with the sizes recorded in it. Output files without a marker don't count, as they might have been cut short (eg if the process was killed while writing them).
+    def is_done (self):
+        if len(self.out_files) == 0 or not os.path.isfile(self.marker_file()):
+            return False
+        try:
+            with open(self.marker_file()) as f:
+                sizes = json.load(f)
+        except(OSError, ValueError):
+            return False
+        return all([os.path.isfile(f) and sizes.get(f) == os.path.getsize(f) for f in self.out_files])
+
+    # Run the task, and write the marker file once all the output is complete. If it fails, remove any output it has written.
+    def run (self):
+        if len(self.out_files) > 0 and os.path.isfile(self.marker_file()):
+            os.remove(self.marker_file())
+        try:
+            self.function(*self.args, **self.kwargs)
+        except BaseException:
+            for f in self.out_files:
+                if os.path.isfile(f):
+                    os.remove(f)
+            raise
+        if len(self.out_files) == 0:
+            return
+        for f in self.out_files:
+            if not os.path.isfile(f):
+                print(('Error (ForcingTask): task ' + self.name + ' did not write ' + f))
+                sys.exit()
+        # Write to a temporary file and then rename it, so the marker is never incomplete
+        tmp_file = self.marker_file() + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(dict([(f_out, os.path.getsize(f_out)) for f_out in self.out_files]), f)
+        os.replace(tmp_file, self.marker_file())
+
+
+# Run the given list of ForcingTasks, each one as soon as all the tasks it depends on have finished.
+# With num_workers > 1, independent tasks run in parallel in a pool of processes. The functions and arguments must be picklable (eg module-level functions).
+# If skip_existing=True (default), tasks which have already finished (see ForcingTask.is_done) are skipped, so an interrupted conversion can just be restarted.
+def run_forcing_tasks (tasks, num_workers=1, skip_existing=True):
+
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names):
+        print('Error (run_forcing_tasks): task names must be unique')
+        sys.exit()
+    for task in tasks:
+        for name in task.depends:
+            if name not in names:
+                print(('Error (run_forcing_tasks): task ' + task.name + ' depends on unknown task ' + name))
+                sys.exit()
+
+    # Names of tasks which are finished, and the tasks which still need to run
+    done = set()
+    pending = []
+    for task in tasks:
+        if skip_existing and task.is_done():
+            print(('Skipping ' + task.name + ': already finished'))
+            done.add(task.name)
+        else:
+            pending.append(task)
+    print(('Running ' + str(len(pending)) + ' tasks with ' + str(max(num_workers, 1)) + ' workers'))
+
+    # Inner function to remove the tasks whose dependencies are all finished from the pending list, and return them
+    def ready_tasks ():
+        ready = [task for task in pending if all([name in done for name in task.depends])]
+        for task in ready:
+            pending.remove(task)
+        return ready
+
+    if num_workers <= 1:
+        while len(pending) > 0:
+            ready = ready_tasks()
+            if len(ready) == 0:
+                print('Error (run_forcing_tasks): circular dependencies')
+                sys.exit()
+            for task in ready:
+                print(('Running ' + task.name))
+                task.run()
+                done.add(task.name)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            for task in ready_tasks():
+                running[executor.submit(task.run)] = task
+            if len(running) == 0:
+                print('Error (run_forcing_tasks): circular dependencies')
+                sys.exit()
+            # Wait for at least one task to finish, since it might free up others
+            finished = wait(list(running), return_when=FIRST_COMPLETED)[0]
+            for future in finished:
+                task = running.pop(future)
+                # This will raise any error from the task
+                future.result()
+                print(('Finished ' + task.name))
+                done.add(task.name)
+
+
+# Names of the variables in the binary ERA5 forcing files written by process_era5.
+era5_var_names = ['apressure', 'atemp', 'aqh', 'uwind', 'vwind', 'precip', 'swdown', 'lwdown', 'evap']
+
+
 # Convert one year of ERA5 data to the format and units required by MITgcm.
-def process_era5 (in_dir, out_dir, year, six_hourly=True, first_year=False, last_year=False, prec=32):
+# The data is processed and written one slab of time indices at a time, so memory use is bounded no matter how long the record is. Set chunk to choose the number of time indices per slab; the default is as many as fit in max_slab_bytes (see file_io.py).
+def process_era5 (in_dir, out_dir, year, six_hourly=True, first_year=False, last_year=False, prec=32, chunk=None):
 
     in_dir = real_dir(in_dir)
     out_dir = real_dir(out_dir)
@@ -171,7 +298,7 @@ def process_era5 (in_dir, out_dir, year, six_hourly=True, first_year=False, last
         accum_flag = '_2'
     in_tail = '_' + str(year) + '.nc'
     out_head = out_dir + 'ERA5_'
-    var_out = ['apressure', 'atemp', 'aqh', 'uwind', 'vwind', 'precip', 'swdown', 'lwdown', 'evap']
+    var_out = era5_var_names
     out_tail = '_' + str(year)
 
     # Northermost latitude to keep
@@ -183,6 +310,9 @@ def process_era5 (in_dir, out_dir, year, six_hourly=True, first_year=False, last
     first_file = in_head + var_in[0] + in_tail
     lon = read_netcdf(first_file, 'longitude')
     lat = read_netcdf(first_file, 'latitude')
+    if chunk is None:
+        # Choose the number of time indices per slab, based on the size of one global record in double precision
+        chunk = max(max_slab_bytes//(lon.size*lat.size*8), 1)
     # Find the index of the last latitude we don't care about (remember that latitude goes from north to south in ERA files!)
     j_bound = np.nonzero(lat < lat0)[0][0] - 2
     # Trim and flip latitude
@@ -208,76 +338,116 @@ def process_era5 (in_dir, out_dir, year, six_hourly=True, first_year=False, last
         print(('var_nlat = ' + str(lat.size)))
         print('\n')
 
+    # Inner generator to read the given variable from the given file one slab of time indices at a time, trimmed and flipped over latitude. If num_repeat is set, the first num_repeat time indices are repeated at the beginning (to fill missing data). Every slab has chunk time indices except the last one, so slabs from files with the same number of time indices line up.
+    def read_slabs (in_file, var_name, num_repeat=0):
+        print(('Reading ' + in_file))
+        data_carry = None
+        if num_repeat > 0:
+            data_carry = next(iter_netcdf(in_file, var_name, chunk=num_repeat))[:,:j_bound:-1,:]
+        for data in iter_netcdf(in_file, var_name, chunk=chunk):
+            data = data[:,:j_bound:-1,:]
+            if data_carry is not None:
+                # Carry over the time indices left from the last slab
+                data = np.concatenate((data_carry, data), axis=0)
+            while data.shape[0] >= chunk:
+                yield data[:chunk,:]
+                data = data[chunk:,:]
+            data_carry = data
+        if data_carry is not None and data_carry.shape[0] > 0:
+            yield data_carry
+
+    # Inner generator for hourly accumulated variables: given slabs of data, yield each slab along with the data from the following hour. This is just shifted one timestep ahead, so the first time index of the next slab is carried over. The last slab needs the first time index of next year.
+    def next_hour_slabs (slabs, var_name):
+        data_prev = None
+        for data in slabs:
+            if data_prev is not None:
+                yield data_prev, np.concatenate((data_prev[1:,:], data[:1,:]), axis=0)
+            data_prev = data
+        if last_year:
+            # There is no such data; just copy the last hour of this year
+            data_next = data_prev[-1:,:]
+        else:
+            in_file_2 = in_head + var_name + '_' + str(year+1) + '.nc'
+            data_next = read_netcdf(in_file_2, var_name, time_index=0)
+            data_next = np.expand_dims(data_next[:j_bound:-1,:], 0)
+        yield data_prev, np.concatenate((data_prev[1:,:], data_next), axis=0)
+
     # Loop over variables
     for i in range(len(var_in)):
-        
-        in_file = in_head + var_in[i] + in_tail
-        print(('Reading ' + in_file))
-        data = read_netcdf(in_file, var_in[i])
-        
-        print('Processing')
-        # Trim and flip over latitude
-        data = data[:,:j_bound:-1,:]
-        
-        if var_in[i] == 'msl':
-            # Save pressure for later conversions
-            press = np.copy(data)
 
-        elif var_in[i] == 't2m':
-            # Convert from Kelvin to Celsius
-            data -= temp_C2K
+        in_file = in_head + var_in[i] + in_tail
+        out_file = out_head + var_out[i] + out_tail
+        print(('Processing ' + var_in[i]))
 
-        elif var_in[i] == 'd2m':
-            # Calculate specific humidity from dew point temperature and pressure
-            # Start with vapour pressure
-            e = es0*np.exp(Lv/Rv*(1/temp_C2K - 1/data))
-            data = sh_coeff*e/(press - (1-sh_coeff)*e)
-            
+        if var_in[i] == 'd2m':
+            # Need the pressure at the same time indices for the conversion
+            slabs = zip(read_slabs(in_file, var_in[i]), read_slabs(in_head + 'msl' + in_tail, 'msl'))
         elif var_in[i] in ['tp', 'ssrd', 'strd', 'e']:
             # Accumulated variables
             # This is more complicated
-            
-            if six_hourly:
-                # Need to read data from the following hour to interpolate to this hour. This was downloaded into separate files.
-                in_file_2 = in_head + var_in[i] + accum_flag + in_tail
-                print(('Reading ' + in_file_2))
-                data_2 = read_netcdf(in_file_2, var_in[i])
-                data_2 = data_2[:,:j_bound:-1,:]
-            # not six_hourly will be dealt with after the first_year check
-            
             if first_year:
                 # The first 7 hours of the accumulated variables are missing during the first year of ERA5. Fill this missing period with data from the next available time indices.
                 if six_hourly:
-                    # The first file is missing two indices (hours 0 and 6)
-                    data = np.concatenate((data[:2,:], data), axis=0)
-                    # The second file is missing one index (hour 1)
-                    data_2 = np.concatenate((data_2[:1,:], data_2), axis=0)
+                    # The first file is missing two indices (hours 0 and 6), and the second file is missing one index (hour 1)
+                    num_repeat = [2, 1]
                 else:
                     # The first file is missing 7 indices (hours 0 to 6)
-                    data = np.concatenate((data[:7,:], data), axis=0)
-                    
-            if not six_hourly:
-                # Now get data from the following hour. Just shift one timestep ahead.
-                # First need data from the first hour of next year
-                if last_year:
-                    # There is no such data; just copy the last hour of this year
-                    data_next = data[-1,:]
-                else:
-                    in_file_2 = in_head + var_in[i] + '_' + str(year+1) + '.nc'
-                    data_next = read_netcdf(in_file_2, var_in[i], time_index=0)
-                    data_next = data_next[:j_bound:-1,:]  
-                data_2 = np.concatenate((data[1:,:], np.expand_dims(data_next,0)), axis=0)
-                
-            # Now we can interpolate to the given hour: just the mean of either side
-            data = 0.5*(data + data_2)
-            # Convert from integrals to time-averages
-            data /= dt
-            if var_in[i] in ['ssrd', 'strd', 'e']:
-                # Swap sign on fluxes
-                data *= -1
+                    num_repeat = [7]
+            else:
+                num_repeat = [0, 0]
+            if six_hourly:
+                # Need to read data from the following hour to interpolate to this hour. This was downloaded into separate files.
+                in_file_2 = in_head + var_in[i] + accum_flag + in_tail
+                slabs = zip(read_slabs(in_file, var_in[i], num_repeat=num_repeat[0]), read_slabs(in_file_2, var_in[i], num_repeat=num_repeat[1]))
+            else:
+                # Get data from the following hour as we go
+                slabs = next_hour_slabs(read_slabs(in_file, var_in[i], num_repeat=num_repeat[0]), var_in[i])
+        else:
+            slabs = read_slabs(in_file, var_in[i])
+
+        # Convert each slab and append it to the output file
+        for n, data in enumerate(slabs):
+
+            if var_in[i] == 't2m':
+                # Convert from Kelvin to Celsius
+                data = data - temp_C2K
+
+            elif var_in[i] == 'd2m':
+                # Calculate specific humidity from dew point temperature and pressure
+                data, press = data
+                # Start with vapour pressure
+                e = es0*np.exp(Lv/Rv*(1/temp_C2K - 1/data))
+                data = sh_coeff*e/(press - (1-sh_coeff)*e)
+
+            elif var_in[i] in ['tp', 'ssrd', 'strd', 'e']:
+                data, data_2 = data
+                # Now we can interpolate to the given hour: just the mean of either side
+                data = 0.5*(data + data_2)
+                # Convert from integrals to time-averages
+                data /= dt
+                if var_in[i] in ['ssrd', 'strd', 'e']:
+                    # Swap sign on fluxes
+                    data *= -1
+
+            write_binary(data, out_file, prec=prec, append=n>0)
 
-        out_file = out_head + var_out[i] + out_tail
-        write_binary(data, out_file, prec=prec)
+
+# Call process_era5 for every year from start_year to end_year, with num_workers years at a time (see run_forcing_tasks). Years which have already been converted are skipped, unless skip_existing=False.
+# Each year only reads input files (including the start of next year's files, for hourly accumulated variables), so the years are independent. If last_year=True, end_year is the end of the ERA5 record, and afterwards era_dummy_year makes the dummy year which follows it.
+# first_year, last_year, six_hourly, prec, chunk: as in process_era5 (first_year and last_year refer to start_year and end_year respectively)
+def process_era5_all (in_dir, out_dir, start_year, end_year, six_hourly=True, first_year=False, last_year=False, prec=32, chunk=None, num_workers=1, skip_existing=True):
+
+    out_dir = real_dir(out_dir)
+
+    tasks = []
+    for year in range(start_year, end_year+1):
+        out_files = [out_dir + 'ERA5_' + var + '_' + str(year) for var in era5_var_names]
+        tasks.append(ForcingTask('ERA5 '+str(year), process_era5, args=(in_dir, out_dir, year), kwargs={'six_hourly':six_hourly, 'first_year':first_year and year==start_year, 'last_year':last_year and year==end_year, 'prec':prec, 'chunk':chunk}, out_files=out_files))
+    if last_year:
+        # Copied from the output of the last year
+        out_files = [out_dir + 'ERA5_' + var + '_' + str(end_year+1) for var in era5_var_names]
+        tasks.append(ForcingTask('ERA5 dummy '+str(end_year+1), era_dummy_year, args=(out_dir, end_year), kwargs={'option':'era5', 'prec':prec}, out_files=out_files, depends=['ERA5 '+str(end_year)]))
+    run_forcing_tasks(tasks, num_workers=num_workers, skip_existing=skip_existing)
 
 
 # If you run a simulation that goes until the end of the ERA-Interim or ERA5 record (eg 2017), it will die right before the end, because it needs the first time index of the next year (eg 2018) as an endpoint for interpolation.
@@ -312,7 +482,7 @@ def era_dummy_year (bin_dir, last_year, option='era5', nlon=None, nlat=None, out
 
     # Figure out the file paths
     if option == 'era5':
-        var_names = ['apressure', 'atemp', 'aqh', 'uwind', 'vwind', 'precip', 'swdown', 'lwdown', 'evap']
+        var_names = era5_var_names
         file_head = 'ERA5_'
     elif option == 'eraint':
         var_names = ['msl', 'tmp2m_degC', 'spfh2m', 'u10m', 'v10m', 'rain', 'dsw', 'dlw']
@@ -320,8 +490,8 @@ def era_dummy_year (bin_dir, last_year, option='era5', nlon=None, nlat=None, out
 
     for var in var_names:
         file_in = bin_dir + file_head + var + '_' + str(last_year)
-        # Select the last time index
-        data = read_binary(file_in, [nlon, nlat], 'xyt', prec=prec)[-1,:]
+        # Select the last time index, without reading the rest of the file
+        data = read_binary(file_in, [nlon, nlat], 'xyt', prec=prec, mmap=True)[-1,:]
         file_out = out_dir + file_head + var + '_' + str(last_year+1)
         write_binary(data, file_out, prec=prec)
 
@@ -444,21 +614,10 @@ def seaice_drag_scaling (grid_path, output_file, rd_scale=1, bb_scale=1, ft_scal
         scale_coast[index] = scale_factors[n]
 
     print('Calculating distance from the coast')
-    min_dist = None
-    nearest_scale = None
-    # Loop over all the coastal points
-    for i in range(lon_coast.size):
-        # Calculate distance of every point in the model grid to this specific coastal point, in km
-        dist_to_pt = dist_btw_points([lon_coast[i], lat_coast[i]], [grid.lon_2d, grid.lat_2d])*1e-3
-        if min_dist is None:
-            # Initialise the arrays
-            min_dist = dist_to_pt
-            nearest_scale = np.zeros(min_dist.shape) + scale_coast[i]
-        else:
-            # Figure out which cells have this coastal point as the closest one yet, and update the arrays
-            index = dist_to_pt < min_dist
-            min_dist[index] = dist_to_pt[index]
-            nearest_scale[index] = scale_coast[i]
+    # Find the distance to the closest coastal point (converting to km), and the scale factor at that point
+    min_dist, nearest_index = distance_to_mask(grid.lon_2d, grid.lat_2d, coast_mask, return_index=True)
+    min_dist *= 1e-3
+    nearest_scale = scale_coast[nearest_index]
     # Smooth the result, and mask out the land and ice shelves
     min_dist = mask_land_ice(min_dist, grid)
     nearest_scale = mask_land_ice(smooth_xy(nearest_scale, sigma=sigma), grid)
@@ -538,31 +697,66 @@ def cmip6_atm_forcing (var, expt, mit_start_year=None, mit_end_year=None, model_
         print(('Processing ' + file_path))        
         print(('Covers years '+str(start_years[t])+' to '+str(end_years[t])))
         
-        # Loop over years
-        t_start = 0  # Time index in file
-        t_end = t_start+days_per_year
-        for year in range(start_years[t], end_years[t]+1):
-            if year >= mit_start_year and year <= mit_end_year:
-                print(('Processing ' + str(year)))
-
-                # Read data
-                print(('Reading ' + str(year) + ' from indicies ' + str(t_start) + '-' + str(t_end)))
-                data = read_netcdf(file_path, var, t_start=t_start, t_end=t_end)
-                # Conversions if necessary
-                if var == 'tas':
-                    # Kelvin to Celsius
-                    data -= temp_C2K
-                elif var == 'pr':
-                    # kg/m^2/s to m/s
-                    data /= rho_fw
-                elif var in ['rsds', 'rlds']:
-                    # Swap sign on radiation fluxes
-                    data *= -1
-                # Write data
-                write_binary(data, out_dir+out_file_head+str(year))
-            # Update time range for next time
-            t_start = t_end
-            t_end = t_start + days_per_year
+        # Loop over years, keeping the file open until we're done with it
+        reader = None
+        try:
+            t_start = 0  # Time index in file
+            t_end = t_start+days_per_year
+            for year in range(start_years[t], end_years[t]+1):
+                if year >= mit_start_year and year <= mit_end_year:
+                    print(('Processing ' + str(year)))
+
+                    # Read data
+                    print(('Reading ' + str(year) + ' from indicies ' + str(t_start) + '-' + str(t_end)))
+                    if reader is None:
+                        reader = NetCDFReader(file_path)
+                    # Read the next year in the background, if we'll need it
+                    data = reader.read(var, t_start, t_end, prefetch=(year < min(end_years[t], mit_end_year)))
+                    # Conversions if necessary
+                    if var == 'tas':
+                        # Kelvin to Celsius
+                        data -= temp_C2K
+                    elif var == 'pr':
+                        # kg/m^2/s to m/s
+                        data /= rho_fw
+                    elif var in ['rsds', 'rlds']:
+                        # Swap sign on radiation fluxes
+                        data *= -1
+                    # Write data
+                    write_binary(data, out_dir+out_file_head+str(year))
+                # Update time range for next time
+                t_start = t_end
+                t_end = t_start + days_per_year
+        finally:
+            if reader is not None:
+                reader.close()
+
+
+# Call cmip6_atm_forcing for the given variables (default all of them) and every year, running num_workers (variable, input file) pairs at a time (see run_forcing_tasks), so that each file is only opened once. Files which have already been converted are skipped, unless skip_existing=False.
+# The other arguments are as in cmip6_atm_forcing (with the default out_file_head).
+def cmip6_all (expt, var_names=None, mit_start_year=None, mit_end_year=None, model_path='/badc/cmip6/data/CMIP6/CMIP/MOHC/UKESM1-0-LL/', ensemble_member='r1i1p1f2', out_dir='./', num_workers=1, skip_existing=True):
+
+    if var_names is None:
+        var_names = ['tas', 'huss', 'uas', 'vas', 'psl', 'pr', 'rsds', 'rlds']
+    out_dir = real_dir(out_dir)
+
+    tasks = []
+    for var in var_names:
+        # Find which years are in each file
+        start_years, end_years = find_cmip6_files(model_path, expt, ensemble_member, var, 'day')[1:]
+        for t in range(len(start_years)):
+            start_year = start_years[t]
+            if mit_start_year is not None:
+                start_year = max(start_year, mit_start_year)
+            end_year = end_years[t]
+            if mit_end_year is not None:
+                end_year = min(end_year, mit_end_year)
+            if end_year < start_year:
+                # None of the years we want are in this file
+                continue
+            out_files = [out_dir+expt+'_'+var+'_'+str(year) for year in range(start_year, end_year+1)]
+            tasks.append(ForcingTask(var+' '+str(start_year)+'-'+str(end_year), cmip6_atm_forcing, args=(var, expt), kwargs={'mit_start_year':start_year, 'mit_end_year':end_year, 'model_path':model_path, 'ensemble_member':ensemble_member, 'out_dir':out_dir}, out_files=out_files))
+    run_forcing_tasks(tasks, num_workers=num_workers, skip_existing=skip_existing)
 
 
 # Convert a series of 6-hourly ERA5 forcing files (1 file per year) to monthly files. This will convert one variable, based on file_head_in (followed by _yyyy in each filename).
@@ -574,22 +768,18 @@ def monthly_era5_files (file_head_in, start_year, end_year, file_head_out):
     for year in range(start_year, end_year+1):
         print(('Processing year ' + str(year)))
         data = read_binary(file_head_in+'_'+str(year), [grid.nx, grid.ny], 'xyt')
-        data_monthly = np.empty([12, grid.ny, grid.nx])
-        t = 0
-        for month in range(12):
-            nt = days_per_month(month+1, year)*per_day
-            print(('Indices ' + str(t) + ' to ' + str(t+nt-1)))
-            data_monthly[month,:] = np.mean(data[t:t+nt,:], axis=0)
-            t += nt
+        data_monthly = daily_to_monthly(data, year=year, per_day=per_day)
         write_binary(data_monthly, file_head_out+'_'+str(year))
 
 
-# Process atmospheric forcing from PACE for a single variable and single ensemble member.
-def pace_atm_forcing (var, ens, in_dir, out_dir):
+# Process atmospheric forcing from PACE for a single variable and single ensemble member. Set years to a list of years to process only those ones (default all of them).
+def pace_atm_forcing (var, ens, in_dir, out_dir, years=None):
 
     import netCDF4 as nc
     start_year = 1920
     end_year = 2013
+    if years is None:
+        years = list(range(start_year, end_year+1))
     days_per_year = 365
     months_per_year = 12
     ens_str = str(ens).zfill(2)
@@ -607,7 +797,7 @@ def pace_atm_forcing (var, ens, in_dir, out_dir):
         path += 'daily/'
     path += var + '/'
 
-    for year in range(start_year, end_year+1):
+    for year in years:
         print(('Processing ' + str(year)))
         # Construct the file based on the year (after 2006 use RCP 8.5) and whether it's monthly or daily
         if year < 2006:
@@ -658,20 +848,28 @@ def pace_atm_forcing (var, ens, in_dir, out_dir):
             # Convert from mixing ratio to specific humidity
             data = data/(1.0 + data)
         # Write data
-        out_file = real_dir(out_dir) + 'PACE_ens' + ens_str + '_' + var + '_' + str(year)
-        write_binary(data, out_file)    
+        write_binary(data, pace_atm_file(out_dir, ens, var, year))
 
 
-# Call pace_atm_forcing for all variables and ensemble members.
-def pace_all (in_dir, out_dir):
+# Path to the binary file written by pace_atm_forcing for the given ensemble member, variable and year.
+def pace_atm_file (out_dir, ens, var, year):
+    return real_dir(out_dir) + 'PACE_ens' + str(ens).zfill(2) + '_' + var + '_' + str(year)
+
+
+# Call pace_atm_forcing for all variables, ensemble members and years, running num_workers of these at a time (see run_forcing_tasks). Years which have already been converted are skipped, unless skip_existing=False.
+def pace_all (in_dir, out_dir, num_workers=1, skip_existing=True):
 
     var_names = ['TREFHT', 'QBOT', 'PSL', 'UBOT', 'VBOT', 'PRECT', 'FLDS', 'FSDS']
+    # Years as in pace_atm_forcing
+    start_year = 1920
+    end_year = 2013
 
+    tasks = []
     for ens in range(1,20+1):
-        print(('Processing ensemble member ' + str(ens)))
         for var in var_names:
-            print(('Processing ' + var))
-            pace_atm_forcing(var, ens, in_dir, out_dir)
+            for year in range(start_year, end_year+1):
+                tasks.append(ForcingTask('PACE ens'+str(ens)+' '+var+' '+str(year), pace_atm_forcing, args=(var, ens, in_dir, out_dir), kwargs={'years':[year]}, out_files=[pace_atm_file(out_dir, ens, var, year)]))
+    run_forcing_tasks(tasks, num_workers=num_workers, skip_existing=skip_existing)
 
 
 # Read forcing (var='wind' or 'thermo') from a given atmospheric dataset (source='ERA5', 'UKESM', or 'PACE'). Time-average, ensemble-average (if PACE) and interpolate to the MITgcm grid. Save the otuput to a NetCDF file. This will be used to create spatially-varying, time-constant bias correction files in the functions katabatic_correction and thermo_correction.
@@ -763,12 +961,7 @@ def process_forcing_for_correction (source, var, mit_grid_dir, out_file, in_dir=
                 data_tmp = read_binary(file_path, [forcing_grid.nx, forcing_grid.ny], 'xyt')
                 if monthly_clim:
                     # Average over each month
-                    data_sum = np.zeros([12, data_tmp.shape[1], data_tmp.shape[2]])
-                    t = 0
-                    for m in range(12):
-                        nt = days_per_month(m+1, year)*per_day
-                        data_sum[m,:] = np.mean(data_tmp[t:t+nt,:], axis=0)
-                        t += nt
+                    data_sum = daily_to_monthly(data_tmp, year=year, per_day=per_day)
                     num_time += 1  # in years
                 else:
                     # Integrate over entire year
@@ -895,18 +1088,6 @@ def katabatic_correction (grid_dir, cmip_file, era5_file, out_file_scale, out_fi
 
     print('Building grid')
     grid = Grid(grid_dir)
-    print('Selecting coastal points')
-    coast_mask = grid.get_coast_mask(ignore_iceberg=True)
-    lon_coast = grid.lon_2d[coast_mask].ravel()
-    lat_coast = grid.lat_2d[coast_mask].ravel()
-    if xmin is None:
-        xmin = np.amin(grid.lon_2d)
-    if xmax is None:
-        xmax = np.amax(grid.lon_2d)
-    if ymin is None:
-        ymin = np.amin(grid.lat_2d)
-    if ymax is None:
-        ymax = np.amax(grid.lat_2d)
 
     print('Calculating winds in polar coordinates')
     magnitudes = []
@@ -934,21 +1115,8 @@ def katabatic_correction (grid_dir, cmip_file, era5_file, out_file_scale, out_fi
     rotate = mask_land_ice(rotate, grid)
 
     print('Calculating distance from the coast')
-    min_dist = None
-    # Loop over all the coastal points
-    for i in range(lon_coast.size):
-        # Skip over any points that are out of bounds
-        if lon_coast[i] < xmin or lon_coast[i] > xmax or lat_coast[i] < ymin or lat_coast[i] > ymax:
-            continue
-        # Calculate distance of every point in the model grid to this specific coastal point, in km
-        dist_to_pt = dist_btw_points([lon_coast[i], lat_coast[i]], [grid.lon_2d, grid.lat_2d])*1e-3
-        if min_dist is None:
-            # Initialise the array
-            min_dist = dist_to_pt
-        else:
-            # Figure out which cells have this coastal point as the closest one yet, and update the array
-            index = dist_to_pt < min_dist
-            min_dist[index] = dist_to_pt[index]
+    # Only consider coastal points within the bounds; convert to km
+    min_dist = grid.get_coast_distance(ignore_iceberg=True, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)*1e-3
 
     print('Tapering function offshore')
     # Cosine function moving from scaling factor to 1 over distance of scale_dist km offshore
@@ -1106,51 +1274,86 @@ def merino_meltwater_addmass (in_file, out_file, grid_dir, seasonal=False):
     write_binary(mflux_3d, out_file, prec=64)
 
 
-# Process atmospheric forcing from LENS (same conventions as PACE) for a single variable and single ensemble member.
-def lens_atm_forcing (var, ens, in_dir, out_dir):
+# Process atmospheric forcing from LENS (same conventions as PACE) for a single variable and single ensemble member. Set years to a list of years to process only those ones (default all of them).
+def lens_atm_forcing (var, ens, in_dir, out_dir, years=None):
 
     import netCDF4 as nc
+    if years is None:
+        years = lens_atm_years(ens)
+    if var in ['FLDS', 'FSDS']:
+        freq = 'monthly'
+    else:
+        freq = 'daily'
+
+    # Each file covers several decades, so keep it open for all the years it contains
+    reader = None
+    try:
+        for n in range(len(years)):
+            year = years[n]
+            print(('Processing ' + str(year)))
+            file_path, t_start, t_end = find_lens_file(var, 'atm', freq, ens, year, base_dir=in_dir)
+            if reader is not None and reader.file_path != file_path:
+                reader.close()
+                reader = None
+            if reader is None:
+                reader = NetCDFReader(file_path)
+            print('Reading indices ' + str(t_start) + '-' + str(t_end-1) + ' from ' + file_path)
+            # Read data, and the next year in the background if we'll need it
+            data = reader.read(var, t_start, t_end, prefetch=(n+1 < len(years) and years[n+1] == year+1))
+            # Unit conversions
+            if var in ['FLDS', 'FSDS']:
+                # Swap sign
+                data *= -1
+            elif var == 'TREFHT':
+                # Convert from K to C
+                data -= temp_C2K
+            elif var == 'QBOT':
+                # Convert from mixing ratio to specific humidity
+                data = data/(1.0 + data)
+            # Write data
+            write_binary(data, lens_atm_file(out_dir, ens, var, year))
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+# Years of LENS atmospheric forcing available for the given ensemble member.
+def lens_atm_years (ens):
     if ens == 1:
         start_year = 1850
     else:
         start_year = 1920
     end_year = 2100
-    if var in ['FLDS', 'FSDS']:
-        freq = 'monthly'
-    else:
-        freq = 'daily'
+    return list(range(start_year, end_year+1))
 
-    for year in range(start_year, end_year+1):
-        print(('Processing ' + str(year)))
-        file_path, t_start, t_end = find_lens_file(var, 'atm', freq, ens, year)
-        print('Reading indices ' + str(t_start) + '-' + str(t_end-1) + ' from ' + file_path)
-        # Read data
-        data = read_netcdf(file_path, var, t_start=t_start, t_end=t_end)
-        # Unit conversions
-        if var in ['FLDS', 'FSDS']:
-            # Swap sign
-            data *= -1
-        elif var == 'TREFHT':
-            # Convert from K to C
-            data -= temp_C2K
-        elif var == 'QBOT':
-            # Convert from mixing ratio to specific humidity
-            data = data/(1.0 + data)
-        # Write data
-        out_file = real_dir(out_dir) + 'LENS_ens' + ens_str + '_' + var + '_' + str(year)
-        write_binary(data, out_file)
+
+# Path to the binary file written by lens_atm_forcing for the given ensemble member, variable and year.
+def lens_atm_file (out_dir, ens, var, year):
+    return real_dir(out_dir) + 'LENS_ens' + str(ens).zfill(3) + '_' + var + '_' + str(year)
 
 
-# Call lens_atm_forcing for all variables and the first n ensemble members (default 20, there are over 100 available to download)
-def lens_all (in_dir='/data/oceans_input/raw_input_data/CESM/LENS/', out_dir='/data/oceans_input/processed_input_data/CESM/LENS/', num_ens=20):
+# Call lens_atm_forcing for all variables, years and the first n ensemble members (default 20, there are over 100 available to download), running num_workers (member, variable, input file) units at a time (see run_forcing_tasks), so that each file is only opened once. Files which have already been converted are skipped, unless skip_existing=False.
+def lens_all (in_dir='/data/oceans_input/raw_input_data/CESM/LENS/', out_dir='/data/oceans_input/processed_input_data/CESM/LENS/', num_ens=20, num_workers=1, skip_existing=True):
 
     var_names = ['TREFHT', 'QBOT', 'PSL', 'UBOT', 'VBOT', 'PRECT', 'FLDS', 'FSDS']
 
+    tasks = []
     for ens in range(1,num_ens+1):
-        print(('Processing ensemble member ' + str(ens)))
         for var in var_names:
-            print(('Processing ' + var))
-            lens_atm_forcing(var, ens, in_dir, out_dir)
+            if var in ['FLDS', 'FSDS']:
+                freq = 'monthly'
+            else:
+                freq = 'daily'
+            # Group the years by the file they're in
+            file_years = {}
+            for year in lens_atm_years(ens):
+                file_path = find_lens_file(var, 'atm', freq, ens, year, base_dir=in_dir)[0]
+                if file_path not in file_years:
+                    file_years[file_path] = []
+                file_years[file_path].append(year)
+            for years in file_years.values():
+                tasks.append(ForcingTask('LENS ens'+str(ens)+' '+var+' '+str(years[0])+'-'+str(years[-1]), lens_atm_forcing, args=(var, ens, in_dir, out_dir), kwargs={'years':years}, out_files=[lens_atm_file(out_dir, ens, var, year) for year in years]))
+    run_forcing_tasks(tasks, num_workers=num_workers, skip_existing=skip_existing)
                 
     
             
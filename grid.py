@@ -10,9 +10,11 @@
 import numpy as np
 import sys
 import os
+import hashlib
+from collections import OrderedDict
 
 from .file_io import read_netcdf, find_cmip6_files
-from .utils import fix_lon_range, real_dir, split_longitude, xy_to_xyz, z_to_xyz, bdry_from_hfac, select_bottom, ice_shelf_front_points, wrap_periodic, mask_2d_to_3d
+from .utils import fix_lon_range, real_dir, split_longitude, xy_to_xyz, z_to_xyz, bdry_from_hfac, select_bottom, ice_shelf_front_points, wrap_periodic, mask_2d_to_3d, distance_to_mask
 from .constants import region_bounds, region_split, region_bathy_bounds, region_depth_bounds, sose_res, rEarth, deg2rad
 
 
@@ -44,7 +46,16 @@ class Grid:
     # file_path: path to NetCDF grid file OR directory containing binary files
     # x_is_lon: indicates that X indicates longitude. If True, max_lon will be enforced.
     # max_lon: will adjust longitude to be in the range (max_lon-360, max_lon). By default the code will work out whether (0, 360) or (-180, 180) is more appropriate.
-    def __init__ (self, path, x_is_lon=True, max_lon=None):
+    # use_cache: reuse a Grid previously built from the same (unmodified) path, either in memory or from the on-disk cache in grid_cache_dir if it's switched on. Default True.
+    def __init__ (self, path, x_is_lon=True, max_lon=None, use_cache=True):
+
+        cache_key = None
+        if use_cache:
+            cache_key = grid_cache_key(path, x_is_lon, max_lon)
+            grid_vars = load_grid_cache(cache_key)
+            if grid_vars is not None:
+                self.__dict__.update(grid_vars)
+                return
 
         if path.endswith('.nc'):
             use_netcdf=True
@@ -151,6 +162,9 @@ class Grid:
         self.ice_mask_u = self.build_ice_mask(self.hfac_w)
         self.ice_mask_v = self.build_ice_mask(self.hfac_s)
 
+        if cache_key is not None:
+            save_grid_cache(cache_key, self.__dict__)
+
         
     # Given a 3D hfac array on any grid, create the land mask.
     def build_land_mask (self, hfac):
@@ -289,8 +303,15 @@ class Grid:
     # 2. within the isobaths defining the region (optional),
     # 3. not ice shelf or land points (unless the region ends with "cavity", in which case only consider ice shelf points)
     # If is_3d=True, will return a 3D mask within the depth bounds of the given region.
+    # The mask is only built once for each Grid, see registry_mask.
     def get_region_mask(self, region, gtype='t', is_3d=False, include_iceberg=False):
 
+        return self.registry_mask(('region', region, gtype, is_3d, include_iceberg), lambda: self.build_region_mask(region, gtype=gtype, is_3d=is_3d, include_iceberg=include_iceberg))
+
+
+    # Helper function for get_region_mask, which does the actual work.
+    def build_region_mask (self, region, gtype='t', is_3d=False, include_iceberg=False):
+
         land_mask = self.get_land_mask(gtype=gtype)
         ice_mask = self.get_ice_mask(gtype=gtype)
         lon, lat = self.get_lon_lat(gtype=gtype)
@@ -342,6 +363,12 @@ class Grid:
     # This was written specifically for the sws_shelf region but could easily be edited to work for other regions.
     def get_region_bdry_mask (self, region, bdry, gtype='t', ignore_iceberg=True):
 
+        return self.registry_mask(('region_bdry', region, bdry, gtype, ignore_iceberg), lambda: self.build_region_bdry_mask(region, bdry, gtype=gtype, ignore_iceberg=ignore_iceberg))
+
+
+    # Helper function for get_region_bdry_mask, which does the actual work.
+    def build_region_bdry_mask (self, region, bdry, gtype='t', ignore_iceberg=True):
+
         from .interpolation import neighbours
 
         if region != 'sws_shelf':
@@ -400,6 +427,12 @@ class Grid:
     # Build and return a mask for the ice shelf front points of the given ice shelf.
     def get_icefront_mask (self, shelf='all', gtype='t', is_3d=False):
 
+        return self.registry_mask(('icefront', shelf, gtype, is_3d), lambda: self.build_icefront_mask(shelf=shelf, gtype=gtype, is_3d=is_3d))
+
+
+    # Helper function for get_icefront_mask, which does the actual work.
+    def build_icefront_mask (self, shelf='all', gtype='t', is_3d=False):
+
         if shelf == 'filchner':
             shelf_use = 'fris'
             [xmin, xmax, ymin, ymax] = region_bounds['filchner_front']
@@ -418,6 +451,30 @@ class Grid:
     
     # Build and return a mask for coastal points: open-ocean points with at least one neighbour that is land or ice shelf.
     def get_coast_mask (self, gtype='t', ignore_iceberg=True):
+
+        return self.registry_mask(('coast', gtype, ignore_iceberg), lambda: self.build_coast_mask(gtype=gtype, ignore_iceberg=ignore_iceberg))
+
+
+    # Return a 2D array of the distance (in m) from every point to the closest coastal point (as in get_coast_mask). Optionally only consider coastal points within the given lon-lat bounds. This is only calculated once for each Grid.
+    def get_coast_distance (self, gtype='t', ignore_iceberg=True, xmin=None, xmax=None, ymin=None, ymax=None):
+
+        def build_coast_distance ():
+            lon, lat = self.get_lon_lat(gtype=gtype)
+            coast_mask = self.get_coast_mask(gtype=gtype, ignore_iceberg=ignore_iceberg)
+            if xmin is not None:
+                coast_mask *= lon >= xmin
+            if xmax is not None:
+                coast_mask *= lon <= xmax
+            if ymin is not None:
+                coast_mask *= lat >= ymin
+            if ymax is not None:
+                coast_mask *= lat <= ymax
+            return distance_to_mask(lon, lat, coast_mask)
+        return self.registry_mask(('coast_distance', gtype, ignore_iceberg, xmin, xmax, ymin, ymax), build_coast_distance)
+
+
+    # Helper function for get_coast_mask, which does the actual work.
+    def build_coast_mask (self, gtype='t', ignore_iceberg=True):
         from .interpolation import neighbours
         open_ocean = self.get_open_ocean_mask(gtype=gtype)
         land_ice = 1 - open_ocean
@@ -436,6 +493,186 @@ class Grid:
         return coast_mask
 
 
+    # Masks are built from scratch using lots of full-size array operations, and the same ones are requested over and over (eg for every timeseries type and every segment), so they are saved in a registry the first time they are built.
+    # Look up the mask (or tuple of masks) with the given key in the registry, or build it with the given function and save it. A copy is returned so the caller is free to modify it.
+    def registry_mask (self, key, build_mask):
+
+        if not hasattr(self, 'mask_registry'):
+            self.mask_registry = {}
+        if key not in self.mask_registry:
+            self.mask_registry[key] = build_mask()
+        mask = self.mask_registry[key]
+        if isinstance(mask, tuple):
+            return tuple([np.copy(m) for m in mask])
+        else:
+            return np.copy(mask)
+
+
+    # Given a 2D (lat x lon) or 3D (depth x lat x lon) boolean mask on the tracer grid, return the flattened indices of the True points, and the area (2D) or volume (3D, considering partial cells) of each of these points. Area- or volume-averages over the mask then reduce to a gather and a dot product - see over_index in calculus.py.
+    def get_mask_index (self, mask):
+
+        index = np.flatnonzero(mask)
+        if len(mask.shape) == 2:
+            weights = self.dA.ravel()[index]
+        elif len(mask.shape) == 3:
+            weights = self.dV.ravel()[index]
+        else:
+            print('Error (get_mask_index): mask must be 2D or 3D')
+            sys.exit()
+        return index, weights
+
+
+    # Return the flattened indices and area or volume weights of the given region, as in get_mask_index. These are only calculated once for each Grid.
+    # For 2D regions, this excludes land and ice shelves as in get_region_mask; for 3D regions (is_3d=True) it excludes closed cells and anything outside the region's depth bounds.
+    def get_region_index (self, region, is_3d=False, include_iceberg=False):
+
+        if not hasattr(self, 'mask_registry'):
+            self.mask_registry = {}
+        key = ('region_index', region, is_3d, include_iceberg)
+        if key not in self.mask_registry:
+            self.mask_registry[key] = self.get_mask_index(self.get_region_mask(region, is_3d=is_3d, include_iceberg=include_iceberg))
+        index, weights = self.mask_registry[key]
+        return np.copy(index), np.copy(weights)
+
+
+# Building a Grid means reading lots of variables and recalculating volumes, bathymetry, and masks, which is slow for big grids. So every Grid is cached in memory (the grid_cache_size most recent ones), and optionally as a .npz file in grid_cache_dir. The cache is keyed by the path to the grid plus the Grid arguments, and invalidated whenever the grid file (or any file in the binary grid directory) is modified.
+# The on-disk cache is switched off by default (grid_cache_dir=None). It's worth switching on for grids which are built over and over again in separate sessions, eg by setting grid.grid_cache_dir = os.path.expanduser('~/.cache/mitgcm_python/grid') at the top of a script. Whenever the files in grid_cache_dir add up to more than grid_cache_max_bytes, the least recently used ones are deleted.
+# Set grid_cache_size to 0 to switch off the in-memory cache.
+grid_cache_dir = None
+grid_cache_max_bytes = 2**31
+grid_cache_size = 8
+grid_memory_cache = OrderedDict()
+
+
+# Helper function for the Grid cache: return a key identifying the grid built from this path with these arguments, including the last modification time. Return None if the path doesn't exist (Grid will deal with the error).
+def grid_cache_key (path, x_is_lon, max_lon):
+
+    if os.path.isfile(path):
+        mtime = os.path.getmtime(path)
+    elif os.path.isdir(path):
+        mtime = max([os.path.getmtime(path)] + [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path)])
+    else:
+        return None
+    return (os.path.abspath(path), x_is_lon, max_lon, mtime)
+
+
+# Helper function for the Grid cache: name of the .npz file for the given key. The modification time isn't part of the name, so an out-of-date file gets overwritten.
+def grid_cache_file (cache_key):
+
+    return os.path.join(grid_cache_dir, hashlib.md5(repr(cache_key[:3]).encode()).hexdigest() + '.npz')
+
+
+# Helper function for the Grid cache: copy all the arrays in a dictionary of Grid variables, so that one Grid can't modify the arrays of another.
+def copy_grid_vars (grid_vars):
+
+    grid_vars_copy = {}
+    for name in grid_vars:
+        if isinstance(grid_vars[name], np.ndarray):
+            grid_vars_copy[name] = grid_vars[name].copy()
+        else:
+            grid_vars_copy[name] = grid_vars[name]
+    return grid_vars_copy
+
+
+# Look up the Grid variables for the given key, first in memory and then on disk. Return None if they're not cached.
+def load_grid_cache (cache_key):
+
+    if cache_key is None:
+        return None
+    if cache_key in grid_memory_cache:
+        # Mark as most recently used
+        grid_memory_cache.move_to_end(cache_key)
+        return copy_grid_vars(grid_memory_cache[cache_key])
+    if grid_cache_dir is None or not os.path.isfile(grid_cache_file(cache_key)):
+        return None
+    try:
+        with np.load(grid_cache_file(cache_key), allow_pickle=False) as id:
+            if str(id['cache_key']) != repr(cache_key):
+                # Grid has been modified since it was cached
+                return None
+            grid_vars = {}
+            for name in id.files:
+                if name == 'cache_key' or name.endswith('__mask'):
+                    continue
+                if id[name].ndim == 0:
+                    # Scalar, eg nx or split
+                    grid_vars[name] = id[name].item()
+                elif name+'__mask' in id.files:
+                    grid_vars[name] = np.ma.masked_array(id[name], mask=id[name+'__mask'])
+                else:
+                    grid_vars[name] = id[name]
+        # Mark as most recently used, for prune_grid_cache
+        os.utime(grid_cache_file(cache_key))
+    except(OSError, ValueError, KeyError):
+        # Corrupted or incompatible cache file; just rebuild the Grid
+        return None
+    update_memory_cache(cache_key, grid_vars)
+    return copy_grid_vars(grid_vars)
+
+
+# Save the Grid variables for the given key in memory and on disk.
+def save_grid_cache (cache_key, grid_vars):
+
+    update_memory_cache(cache_key, copy_grid_vars(grid_vars))
+    if grid_cache_dir is None:
+        return
+    arrays = {'cache_key': repr(cache_key)}
+    for name in grid_vars:
+        arrays[name] = np.asarray(grid_vars[name])
+        if isinstance(grid_vars[name], np.ma.MaskedArray):
+            arrays[name+'__mask'] = np.ma.getmaskarray(grid_vars[name])
+    file_path = grid_cache_file(cache_key)
+    tmp_file = file_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        os.makedirs(grid_cache_dir, exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **arrays)
+        # Rename at the end so other processes never see a partially written file
+        os.replace(tmp_file, file_path)
+    except(OSError):
+        # Not allowed to write the cache; no big deal
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        return
+    prune_grid_cache()
+
+
+# Helper function for the Grid cache: delete the least recently used files in grid_cache_dir until they add up to no more than grid_cache_max_bytes.
+def prune_grid_cache ():
+
+    files = []
+    for fname in os.listdir(grid_cache_dir):
+        if fname.endswith('.npz'):
+            file_path = os.path.join(grid_cache_dir, fname)
+            try:
+                files.append([os.path.getmtime(file_path), os.path.getsize(file_path), file_path])
+            except(OSError):
+                # Deleted by another process in the meantime
+                continue
+    # Oldest first
+    files.sort()
+    total_bytes = sum([f[1] for f in files])
+    for mtime, size, file_path in files:
+        if total_bytes <= grid_cache_max_bytes:
+            break
+        try:
+            os.remove(file_path)
+        except(OSError):
+            pass
+        total_bytes -= size
+
+
+# Helper function for the Grid cache: add to the in-memory cache, dropping the least recently used grids if it's full.
+def update_memory_cache (cache_key, grid_vars):
+
+    if grid_cache_size <= 0:
+        return
+    grid_memory_cache[cache_key] = grid_vars
+    grid_memory_cache.move_to_end(cache_key)
+    while len(grid_memory_cache) > grid_cache_size:
+        grid_memory_cache.popitem(last=False)
+
+
 # Interface to Grid for situations such as read_plot_latlon where there are three possibilities:
 # (1) the Grid object is precomputed and saved in variable "grid"; nothing to do
 # (2) the Grid object is not precomputed, but file_path (where the model output is being read from in the master function) contains the grid variables; build the Grid from this file
@@ -992,8 +992,8 @@ def balance_obcs (grid, option='balance', in_dir='./', obcs_file_w_u=None, obcs_
             for i in range(len(files)):
                 if files[i][t] is not None:
                     print(('Processing ' + bdry_key[i] + ' boundary from ' + files[i][t]))
-                    # Read data
-                    vel = read_binary(files[i][t], [grid.nx, grid.ny, grid.nz], dimensions[i], prec=prec)
+                    # Map the file without reading it: we only need the time-mean or one month at a time
+                    vel = read_binary(files[i][t], [grid.nx, grid.ny, grid.nz], dimensions[i], prec=prec, mmap=True)
                     if num_months is None:
                         # Find number of time indices
                         num_months = vel.shape[0]
@@ -1101,7 +1101,7 @@ def balance_obcs (grid, option='balance', in_dir='./', obcs_file_w_u=None, obcs_
         for t in range(num_years):
             for i in range(len(files)):
                 if files[i][t] is not None:
-                    vel = read_binary(files[i][t], [grid.nx, grid.ny, grid.nz], dimensions[i], prec=prec)
+                    vel = read_binary(files[i][t], [grid.nx, grid.ny, grid.nz], dimensions[i], prec=prec, mmap=True)
                     if option == 'balance':
                         vel = np.mean(vel, axis=0)
                         net_transport_new[t] += np.sum(sign[i]*vel*dA_bdry[i])
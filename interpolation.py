@@ -4,8 +4,10 @@
 
 import numpy as np
 import sys
+import hashlib
+from collections import OrderedDict
 
-from .utils import mask_land, mask_land_ice, mask_3d, xy_to_xyz, z_to_xyz, is_depth_dependent
+from .utils import mask_land, mask_land_ice, mask_3d, is_depth_dependent, lonlat_to_cartesian
 from .grid import Grid
 
 
@@ -139,6 +141,94 @@ def neighbours_z (data, missing_val=-9999):
     return data_u, data_d, valid_u, valid_d, num_valid_neighbours_z
 
     
+# Helper function for extend_into_mask and discard_and_fill. Extend the data into the mask in passes: in each pass, every missing point with non-missing neighbours is set to the average of them (considering first the horizontal neighbours and then the vertical neighbours, or the other way around if preference='vertical'). Only the "frontier" of missing points next to points filled in the previous pass are considered each time, so the total work scales with the number of points filled rather than the number of passes times the size of the array.
+# Keep going until no more points can be filled, or max_passes is reached, or all the missing points within the boolean array "fill" are filled. If log=True, print the number of points left to fill in each pass.
+# Returns the updated data array, and the number of points within "fill" (or everywhere, if fill is None) which are still missing.
+def extend_frontier (data, missing_val=-9999, use_1d=False, use_3d=False, preference='horizontal', max_passes=None, fill=None, log=False):
+
+    shape = data.shape
+    num_dim = len(shape)
+    data_flat = np.ravel(data)
+    # Distance between neighbours in each dimension, in the flattened array
+    stride = [int(np.prod(shape[n+1:])) for n in range(num_dim)]
+    if use_1d:
+        dims_h = [num_dim-1]
+    else:
+        dims_h = [num_dim-2, num_dim-1]
+    dims_v = []
+    if use_3d:
+        dims_v = [num_dim-3]
+    if preference == 'vertical':
+        dims_first = dims_v
+        dims_second = dims_h
+    else:
+        dims_first = dims_h
+        dims_second = dims_v
+
+    # Inner function to find the flattened indices of all neighbours of the given points in the given dimensions, and whether they exist (ie aren't off the edge of the array).
+    def get_neighbours (points, dims):
+        coords = np.unravel_index(points, shape)
+        neighbour_points = []
+        exists = []
+        for n in dims:
+            for step in [-1, 1]:
+                neighbour_points.append(points + step*stride[n])
+                exists.append((coords[n]+step >= 0)*(coords[n]+step < shape[n]))
+        return neighbour_points, exists
+
+    # Inner function to find the sum of the non-missing neighbours of the given points in the given dimensions, and how many there are.
+    def sum_neighbours (points, dims):
+        total = np.zeros(points.size)
+        count = np.zeros(points.size)
+        for neighbour_points, exists in zip(*get_neighbours(points, dims)):
+            values = data_flat[np.where(exists, neighbour_points, points)]
+            valid = exists*(values != missing_val)
+            total += np.where(valid, values, 0)
+            count += valid
+        return total, count
+
+    # Inner function to sort an array of indices and remove duplicates (faster than np.unique for this).
+    def sort_unique (points):
+        points = np.sort(points)
+        return points[np.concatenate((points[:1] == points[:1], points[1:] != points[:-1]))]
+
+    # Inner function to find the unique missing points among all the neighbours of the given points in the given dimensions.
+    def missing_neighbours (points, dims):
+        neighbour_points, exists = get_neighbours(points, dims)
+        neighbour_points = np.concatenate([p[e] for p, e in zip(neighbour_points, exists)])
+        return sort_unique(neighbour_points[data_flat[neighbour_points] == missing_val])
+
+    if fill is None:
+        fill_flat = np.ones(data_flat.size, dtype=bool)
+    else:
+        fill_flat = np.ravel(fill).astype(bool)
+    # Start by considering every missing point
+    points = np.flatnonzero(data_flat == missing_val)
+    num_missing = np.count_nonzero(fill_flat[points])
+    num_passes = 0
+    while points.size > 0 and num_missing > 0 and (max_passes is None or num_passes < max_passes):
+        if log:
+            print('......' + str(num_missing) + ' points to fill')
+        # Fill any points which have neighbours in the first dimension(s)
+        total, count = sum_neighbours(points, dims_first)
+        index = count > 0
+        filled = points[index]
+        data_flat[filled] = total[index]/count[index]
+        if len(dims_second) > 0:
+            # Now consider the other dimension(s), for points which didn't have any neighbours in the first dimension(s). These are the rest of the frontier, plus any missing points next to those we just filled.
+            points_second = sort_unique(np.concatenate((points[~index], missing_neighbours(filled, dims_second))))
+            total, count = sum_neighbours(points_second, dims_second)
+            index = count > 0
+            data_flat[points_second[index]] = total[index]/count[index]
+            filled = np.concatenate((filled, points_second[index]))
+        num_missing -= np.count_nonzero(fill_flat[filled])
+        num_passes += 1
+        # The next frontier is any missing points next to those we just filled
+        points = missing_neighbours(filled, dims_first+dims_second)
+
+    return np.reshape(data_flat, shape), num_missing
+
+
 # Given an array with missing values, extend the data into the mask by setting missing values to the average of their non-missing neighbours, and repeating as many times as the user wants.
 # If "data" is a regular array with specific missing values, set missing_val (default -9999). If "data" is a MaskedArray, set masked=True instead.
 # Setting use_3d=True indicates this is a 3D array, and where there are no valid neighbours on the 2D plane, neighbours above and below should be used.
@@ -162,41 +252,11 @@ def extend_into_mask (data, missing_val=-9999, masked=False, use_1d=False, use_3
         data_unmasked[data.mask] = missing_val
         data = data_unmasked
 
-    for iter in range(num_iters):
-        # Find the neighbours of each point, whether or not they are missing, and how many non-missing neighbours there are.
-        # Then choose the points that can be filled.
-        # Then set them to the average of their non-missing neighbours.
-        if use_1d:
-            # Just consider horizontal neighbours in one direction
-            data_w, data_e, valid_w, valid_e, num_valid_neighbours = neighbours(data, missing_val=missing_val, use_1d=True)
-            index = (data == missing_val)*(num_valid_neighbours > 0)
-            data[index] = (data_w[index]*valid_w[index] + data_e[index]*valid_e[index])/num_valid_neighbours[index]
-        elif use_3d and preference == 'vertical':
-            # Consider vertical neighbours
-            data_d, data_u, valid_d, valid_u, num_valid_neighbours = neighbours_z(data, missing_val=missing_val)
-            index = (data == missing_val)*(num_valid_neighbours > 0)
-            data[index] = (data_u[index]*valid_u[index] + data_d[index]*valid_d[index])/num_valid_neighbours[index]
-        else:
-            # Consider horizontal neighbours in both directions
-            data_w, data_e, data_s, data_n, valid_w, valid_e, valid_s, valid_n, num_valid_neighbours = neighbours(data, missing_val=missing_val)
-            index = (data == missing_val)*(num_valid_neighbours > 0)
-            data[index] = (data_w[index]*valid_w[index] + data_e[index]*valid_e[index] + data_s[index]*valid_s[index] + data_n[index]*valid_n[index])/num_valid_neighbours[index]
-        if use_3d:
-            # Consider the other dimension(s). Find the points that haven't already been filled based on the first dimension(s) we checked, but could be filled now.
-            if preference == 'vertical':
-                # Look for horizontal neighbours
-                data_w, data_e, data_s, data_n, valid_w, valid_e, valid_s, valid_n, num_valid_neighbours_new = neighbours(data, missing_val=missing_val)
-                index = (data == missing_val)*(num_valid_neighbours == 0)*(num_valid_neighbours_new > 0)
-                data[index] = (data_w[index]*valid_w[index] + data_e[index]*valid_e[index] + data_s[index]*valid_s[index] + data_n[index]*valid_n[index])/num_valid_neighbours_new[index]
-            elif preference == 'horizontal':
-                # Look for vertical neighbours
-                data_d, data_u, valid_d, valid_u, num_valid_neighbours_new = neighbours_z(data, missing_val=missing_val)
-                index = (data == missing_val)*(num_valid_neighbours == 0)*(num_valid_neighbours_new > 0)
-                data[index] = (data_u[index]*valid_u[index] + data_d[index]*valid_d[index])/num_valid_neighbours_new[index]
+    data = extend_frontier(data, missing_val=missing_val, use_1d=use_1d, use_3d=use_3d, preference=preference, max_passes=num_iters)[0]
                 
     if masked:
         # Remask the MaskedArray
-        data = ma.masked_where(data==missing_val, data)
+        data = np.ma.masked_where(data==missing_val, data)
 
     return data
 
@@ -205,53 +265,59 @@ def extend_into_mask (data, missing_val=-9999, masked=False, use_1d=False, use_3
 
 # Arguments:
 # x, y: 1D arrays with x and y coordinates of source data (polar stereographic for BEDMAP2, lon and lat for GEBCO)
-# data: 2D array of source data
+# data: 2D array of source data, or a list of 2D arrays on the same grid (eg bathymetry, draft, and masks) which will share the same sub-grid points
 # x_interp, y_interp: 2D arrays with x and y coordinates of the EDGES of grid cells - the output array will be 1 smaller in each dimension
 
-# Optional keyword argument:
+# Optional keyword arguments:
 # n_subgrid: dimension of finer grid within each grid cell (default 10, i.e. 10 x 10 points per grid cell)
+# max_points: maximum number of sub-grid points to interpolate to at once. The grid is processed in blocks of rows to stay within this; each point needs about 50 bytes of memory, so the default of 5 million uses about 250 MB.
 
-# Output: data on centres of new grid
+# Output: data on centres of new grid (or a list of these, if data is a list)
 
-def interp_topo (x, y, data, x_interp, y_interp, n_subgrid=10):
+def interp_topo (x, y, data, x_interp, y_interp, n_subgrid=10, max_points=5000000):
 
     from scipy.interpolate import RectBivariateSpline
 
+    if isinstance(data, list):
+        data_list = data
+    else:
+        data_list = [data]
+
     # x_interp and y_interp are the edges of the grid cells, so the number of cells is 1 less
     num_j = y_interp.shape[0] -1
     num_i = x_interp.shape[1] - 1
-    data_interp = np.empty([num_j, num_i])
+    data_interp = [np.empty([num_j, num_i]) for data_tmp in data_list]
 
     # RectBivariateSpline needs (y,x) not (x,y) - this can really mess you up when BEDMAP2 is square!!
-    interpolant = RectBivariateSpline(y, x, data)
-
-    # Loop over grid cells (can't find a vectorised way to do this without overflowing memory)
-    for j in range(num_j):
-        for i in range(num_i):
-            # Make a finer grid within this grid cell (regular in x and y)
-            # First identify the boundaries so that x and y are strictly increasing
-            if x_interp[j,i] < x_interp[j,i+1]:
-                x_start = x_interp[j,i]
-                x_end = x_interp[j,i+1]
-            else:
-                x_start = x_interp[j,i+1]
-                x_end = x_interp[j,i]
-            if y_interp[j,i] < y_interp[j+1,i]:
-                y_start = y_interp[j,i]
-                y_end = y_interp[j+1,i]
-            else:
-                y_start = y_interp[j+1,i]
-                y_end = y_interp[j,i]
-            # Define edges of the sub-cells
-            x_edges = np.linspace(x_start, x_end, num=n_subgrid+1)
-            y_edges = np.linspace(y_start, y_end, num=n_subgrid+1)
-            # Calculate centres of the sub-cells
-            x_vals = 0.5*(x_edges[1:] + x_edges[:-1])
-            y_vals = 0.5*(y_edges[1:] + y_edges[:-1])
+    interpolants = [RectBivariateSpline(y, x, data_tmp) for data_tmp in data_list]
+
+    # Identify the boundaries of each cell so that x and y are strictly increasing
+    x_start = np.minimum(x_interp[:-1,:-1], x_interp[:-1,1:])
+    x_end = np.maximum(x_interp[:-1,:-1], x_interp[:-1,1:])
+    y_start = np.minimum(y_interp[:-1,:-1], y_interp[1:,:-1])
+    y_end = np.maximum(y_interp[:-1,:-1], y_interp[1:,:-1])
+    # Centres of the sub-cells (regular in x and y), as a fraction of the way across the cell
+    frac = (np.arange(n_subgrid)+0.5)/n_subgrid
+
+    # Loop over blocks of rows, with as many rows as will fit in max_points
+    num_rows = max(max_points//(num_i*n_subgrid**2), 1)
+    for j_start in range(0, num_j, num_rows):
+        j_end = min(j_start+num_rows, num_j)
+        # Make a finer grid within each grid cell in this block: dimension rows x cells x sub-cells in y x sub-cells in x
+        x_vals = x_start[j_start:j_end,:,None] + frac*(x_end-x_start)[j_start:j_end,:,None]
+        y_vals = y_start[j_start:j_end,:,None] + frac*(y_end-y_start)[j_start:j_end,:,None]
+        shape = [j_end-j_start, num_i, n_subgrid, n_subgrid]
+        x_vals = np.broadcast_to(x_vals[:,:,None,:], shape).ravel()
+        y_vals = np.broadcast_to(y_vals[:,:,:,None], shape).ravel()
+        for interpolant, data_interp_tmp in zip(interpolants, data_interp):
             # Interpolate to the finer grid, then average over those points to estimate the mean value of the original field over the entire grid cell
-            data_interp[j,i] = np.mean(interpolant(y_vals, x_vals))
+            data_sub = interpolant(y_vals, x_vals, grid=False)
+            data_interp_tmp[j_start:j_end,:] = np.mean(np.reshape(data_sub, [j_end-j_start, num_i, n_subgrid**2]), axis=-1)
 
-    return data_interp
+    if isinstance(data, list):
+        return data_interp
+    else:
+        return data_interp[0]
 
 
 # Given an array representing a mask (e.g. ocean mask where 1 is ocean, 0 is land), identify any isolated cells (i.e. 1 cell of ocean with land on 4 sides) and remove them (i.e. recategorise them as land).
@@ -282,22 +348,24 @@ def interp_reg_xy (source_lon, source_lat, source_data, target_lon, target_lat,
 
 
 # Like interp_reg_xy, but for lat-lon-depth grids.
+# Trilinear interpolation is the same as interpolating in depth and then bilinearly in lat-lon, so first interpolate every column to the target depths (see interp_depth_coeffs), and then do the horizontal interpolation for all depths at once with the same weights.
 def interp_reg_xyz (source_lon, source_lat, source_z, source_data, target_lon, target_lat, target_z, fill_value=-9999):
 
     from scipy.interpolate import RegularGridInterpolator
 
-    # Build an interpolant
-    # Make depth positive so it's strictly increasing
-    interpolant = RegularGridInterpolator((-source_z, source_lat, source_lon), source_data, bounds_error=False, fill_value=fill_value)
-    # Make target axes 3D    
+    # Interpolate to the target depths
+    k1, k2, c1, c2, outside = interp_depth_coeffs(source_z, target_z)
+    source_data = np.ma.getdata(source_data)
+    data_z = c1[:,None,None]*source_data[k1,:] + c2[:,None,None]*source_data[k2,:]
+    # Build an interpolant, with depth as the last dimension so it's carried along
+    interpolant = RegularGridInterpolator((source_lat, source_lon), np.moveaxis(data_z, 0, -1), bounds_error=False, fill_value=fill_value)
+    # Make target axes 2D
     if len(target_lon.shape) == 1:
         target_lon, target_lat = np.meshgrid(target_lon, target_lat)
-    dimensions = [target_lon.shape[1], target_lon.shape[0], target_z.size]
-    target_lon = xy_to_xyz(target_lon, dimensions)
-    target_lat = xy_to_xyz(target_lat, dimensions)
-    target_z = z_to_xyz(target_z, dimensions)
-    # Interpolate
-    data_interp = interpolant((-target_z, target_lat, target_lon))
+    # Interpolate, and move depth back to the first dimension
+    data_interp = np.moveaxis(interpolant((target_lat, target_lon)), -1, 0)
+    # Anything above or below the source depths is out of bounds
+    data_interp[outside,:] = fill_value
     return data_interp    
 
 
@@ -323,35 +391,14 @@ def interp_reg (source_grid, target_grid, source_data, dim=3, gtype='t', fill_va
 # Given data on a 3D grid (or 2D if you set use_3d=False), throw away any points indicated by the "discard" boolean mask (i.e. fill them with missing_val), and then extrapolate into any points indicated by the "fill" boolean mask (by calling extend_into_mask as many times as needed).
 def discard_and_fill (data, discard, fill, missing_val=-9999, use_1d=False, use_3d=True, preference='horizontal', log=True):
 
-    # import file_io for basic error output
-    #import .file_io as fio
- 
     # First throw away the points we don't trust
     data[discard] = missing_val
-    # Now fill the values we need to fill
-    num_missing = np.count_nonzero((data==missing_val)*fill)
-    while num_missing > 0:
-        if log:
-            print('......' + str(num_missing) + ' points to fill')
-        data = extend_into_mask(data, missing_val=missing_val, use_1d=use_1d, use_3d=use_3d, preference=preference)
-        num_missing_old = num_missing
-        num_missing = np.count_nonzero((data==missing_val)*fill)
-        if num_missing == num_missing_old:
-            # There are some disconnected regions. This can happen with coupling sometimes. Try using more iterations of extend_into_mask.
-            for iters in range(2, 100):
-                data = extend_into_mask(data, missing_val=missing_val, use_1d=use_1d, use_3d=use_3d, preference=preference, num_iters=iters)
-                num_missing_old = num_missing
-                num_missing = np.count_nonzero((data==missing_val)*fill)
-                if num_missing != num_missing_old:
-                    break
-            if num_missing == num_missing_old:
-                # If cannot complete discard and fill, write errors out to very basic file 
-                print('Error (discard_and_fill): some missing values cannot be filled')
-                print('Dumping data, discard, and fill data to error_fill_dump.nc') 
-                #fio.write_netcdf_very_basic(data,    'data',    'error_dump_data.nc', use_3d=use_3d)
-                #fio.write_netcdf_very_basic(discard, 'discard', 'error_dump_discard.nc', use_3d=use_3d)
-                #fio.write_netcdf_very_basic(fill,    'fill',    'error_dump_fill.nc', use_3d=use_3d)
-                sys.exit()
+    # Now fill the values we need to fill, until there are none left
+    data, num_missing = extend_frontier(data, missing_val=missing_val, use_1d=use_1d, use_3d=use_3d, preference=preference, fill=fill, log=log)
+    if num_missing > 0:
+        # There are some disconnected regions which can't be reached from any valid points
+        print('Error (discard_and_fill): some missing values cannot be filled')
+        sys.exit()
     return data
 
 
@@ -405,6 +452,28 @@ def interp_slice_helper (data, val0, lon=False, warn=True):
     return i1, i2, c1, c2
 
 
+# Helper function for interp_reg_xyz and interp_nonreg_xyz: find the indices k1, k2 and coefficients c1, c2 (each an array of the same size as target_z) such that c1*data[k1,:] + c2*data[k2,:] interpolates data from the depths source_z to the depths target_z. As in interp_to_depth, depths above the surface or below the bottom of source_z take the surface or bottom values; the last return value is a boolean array flagging these depths.
+def interp_depth_coeffs (source_z, target_z):
+
+    nz = target_z.size
+    k1 = np.zeros(nz, dtype=int)
+    k2 = np.zeros(nz, dtype=int)
+    c1 = np.ones(nz)
+    c2 = np.zeros(nz)
+    outside = (target_z > source_z[0]) + (target_z < source_z[-1])
+    for k in range(nz):
+        if target_z[k] > source_z[0]:
+            # Surface layer
+            k1[k] = k2[k] = 0
+        elif target_z[k] < source_z[-1]:
+            # Bottom layer
+            k1[k] = k2[k] = source_z.size-1
+        else:
+            # Make depth positive so array is increasing and we can get right coefficients
+            k1[k], k2[k], c1[k], c2[k] = interp_slice_helper(-source_z, -target_z[k])
+    return k1, k2, c1, c2, outside
+
+
 # Interpolate an array "data" to a point (lon0, lat0). Other dimensions (eg time, depth) will be preserved.
 # Can also set return_hfac=True to return the column of hFac values interpolated to this point. If any of the neighbouring points are fully closed (i.e. land), the interpolated hFac will be zero there too.
 def interp_bilinear (data, lon0, lat0, grid, gtype='t', return_hfac=False):
@@ -519,13 +588,71 @@ def interp_to_depth (data, z0, grid, time_dependent=False, gtype='t'):
         return c1*data[k1,...] + c2*data[k2,...]
 
 
+# Object which linearly interpolates from a set of scattered source points (nx2 array) to a set of target points (mx2 array), in the same way as griddata with method='linear'. The source points are triangulated only once, and the barycentric weights of each target point are stored in a sparse matrix, so interpolating any number of fields is just a matrix product. If fill_mask=True, target points outside the triangulation take the value of the nearest source point (as in griddata with method='nearest').
+class NonRegInterpolator:
+
+    def __init__ (self, source_points, target_points, fill_mask=False):
+
+        from scipy.spatial import Delaunay, cKDTree
+        from scipy.sparse import csr_matrix
+
+        self.num_source = source_points.shape[0]
+        self.num_target = target_points.shape[0]
+        self.fill_mask = fill_mask
+        tri = Delaunay(source_points)
+        # Find the triangle containing each target point (-1 if outside)
+        simplex = tri.find_simplex(target_points)
+        self.inside = simplex >= 0
+        index = np.nonzero(self.inside)[0]
+        # Calculate barycentric coordinates within these triangles
+        transform = tri.transform[simplex[index]]
+        bary = np.einsum('ijk,ik->ij', transform[:,:2,:], target_points[index,:] - transform[:,2,:])
+        bary = np.concatenate((bary, 1-np.sum(bary, axis=1, keepdims=True)), axis=1)
+        rows = np.repeat(index, 3)
+        cols = tri.simplices[simplex[index]].ravel()
+        weights = bary.ravel()
+        if fill_mask:
+            # Points outside the triangulation take the value of the nearest source point
+            outside = np.nonzero(np.invert(self.inside))[0]
+            nearest = cKDTree(source_points).query(target_points[outside,:])[1]
+            rows = np.concatenate((rows, outside))
+            cols = np.concatenate((cols, nearest))
+            weights = np.concatenate((weights, np.ones(outside.size)))
+        self.matrix = csr_matrix((weights, (rows, cols)), shape=(self.num_target, self.num_source))
+
+
+    # Interpolate the values at the source points (1D array, or 2D array with one column for each field) to the target points. Anything which can't be interpolated is set to fill_value.
+    def interp (self, source_values, fill_value=-9999):
+
+        data_interp = self.matrix.dot(source_values)
+        if not self.fill_mask:
+            data_interp[np.invert(self.inside),...] = fill_value
+        return data_interp
+
+
+# Cache of NonRegInterpolator objects, so the same source and target points are only triangulated once. Keep up to interp_cache_size of them in memory, discarding the least recently used.
+interp_cache_size = 8
+interp_cache = OrderedDict()
+
+# Return a NonRegInterpolator for the given source and target points, reusing a cached one if these exact points have been seen before (for example, the same grid with the same mask of missing values).
+def get_nonreg_interpolator (source_points, target_points, fill_mask=False):
+
+    key = (hashlib.md5(np.ascontiguousarray(source_points)).hexdigest(), hashlib.md5(np.ascontiguousarray(target_points)).hexdigest(), source_points.shape, target_points.shape, fill_mask)
+    if key in interp_cache:
+        interp_cache.move_to_end(key)
+    else:
+        interp_cache[key] = NonRegInterpolator(source_points, target_points, fill_mask=fill_mask)
+        while len(interp_cache) > interp_cache_size:
+            interp_cache.popitem(last=False)
+    return interp_cache[key]
+
+
 # Interpolate from a non-regular grid (structured but not regular in lat-lon, e.g. curvilinear) to a another grid (regular or non-regular is fine).
 # The input lat and lon arrays should be 2D for the source grid, and either 1D (if regular) or 2D for the target grid.
 # Fill anything outside the bounds of the source grid with fill_value. If fill_mask=True, fill them with the nearest neighbours instead.
+# The triangulation of the source points is cached (see get_nonreg_interpolator), so repeated calls with the same grids and the same missing values are much faster.
 def interp_nonreg_xy (source_lon, source_lat, source_data, target_lon, target_lat, fill_value=-9999, fill_mask=False):
 
-    from scipy.interpolate import griddata
-
     # Check for missing values
     if isinstance(source_data, np.ma.MaskedArray):
         missing = source_data.mask + (source_data == fill_value)
@@ -538,49 +665,51 @@ def interp_nonreg_xy (source_lon, source_lat, source_data, target_lon, target_la
         target_lon, target_lat = np.meshgrid(target_lon, target_lat)
 
     # Set up an nx2 array containing the coordinates of each point in the source grid
-    source_points = np.stack((np.ravel(source_lon[~missing]), np.ravel(source_lat[~missing])), axis=-1)
+    source_points = np.stack((np.ravel(source_lon[~missing]), np.ravel(source_lat[~missing])), axis=-1).astype(float)
     # Same for the target grid
-    target_points = np.stack((np.ravel(target_lon), np.ravel(target_lat)), axis=-1)
+    target_points = np.stack((np.ravel(target_lon), np.ravel(target_lat)), axis=-1).astype(float)
     # Also flatten the data
-    source_values = np.ravel(source_data[~missing])
+    source_values = np.ma.getdata(np.ravel(source_data[~missing])).astype(float)
     
     # Interpolate
-    data_interp = griddata(source_points, source_values, target_points, method='linear', fill_value=fill_value)
-    if fill_mask:
-        data_interp_2 = griddata(source_points, source_values, target_points, method='nearest')
-        index = data_interp==fill_value
-        data_interp[index] = data_interp_2[index]
+    interpolant = get_nonreg_interpolator(source_points, target_points, fill_mask=fill_mask)
+    data_interp = interpolant.interp(source_values, fill_value=fill_value)
     # Un-flatten the result
     return np.reshape(data_interp, target_lon.shape)
 
 
 # Interpolate a 3D field on a grid which is non-regular in the lat-lon direction, but has a normal z-axis.
+# First interpolate every column to the target depths (see interp_depth_coeffs), extrapolating the surface and bottom layers if needed. Then do the horizontal interpolation for all depths which have the same missing points at once, with the same triangulation (see interp_nonreg_xy).
 def interp_nonreg_xyz (source_lon, source_lat, source_z, source_data, target_lon, target_lat, target_z, fill_value=-9999):
 
-    # Find dimensions of grid
+    # Make target axes 2D
     if len(target_lon.shape) == 1 and len(target_lat.shape) == 1:
-        nx = target_lon.size
-        ny = target_lat.size
-    else:
-        nx = target_lon.shape[1]
-        ny = target_lon.shape[0]
+        target_lon, target_lat = np.meshgrid(target_lon, target_lat)
     nz = target_z.size
+    [ny, nx] = target_lon.shape
 
-    # Interpolate each depth individually
-    data_interp = np.ma.empty([nz, ny, nx])
+    # Interpolate to the target depths
+    k1, k2, c1, c2 = interp_depth_coeffs(source_z, target_z)[:4]
+    data_z = c1[:,None,None]*source_data[k1,:] + c2[:,None,None]*source_data[k2,:]
+    # Check for missing values
+    if isinstance(data_z, np.ma.MaskedArray):
+        missing = np.ma.getmaskarray(data_z) + (data_z == fill_value)
+    else:
+        missing = data_z == fill_value
+    # Group depths with the same missing values together
+    levels = {}
     for k in range(nz):
-        print('...depth ' + str(k+1) + ' of ' + str(nz))
-        if k==0 and target_z[k] > source_z[0]:
-            # Target grid's surface layer is too shallow - extrapolate
-            source_data_2d = source_data[0,:]
-        elif k==nz-1 and target_z[-1] < source_z[-1]:
-            # Target grid's bottom layer is too deep - extrapolate
-            source_data_2d = source_data[-1,:]
-        else:        
-            # Extract a lon-lat slice of source data, at this depth
-            source_data_2d = interp_to_depth(source_data, target_z[k], source_z)
-        # Now interpolate in 2D
-        data_interp[k,:] = interp_nonreg_xy(source_lon, source_lat, source_data_2d, target_lon, target_lat, fill_value=fill_value)
+        levels.setdefault(missing[k,:].tobytes(), []).append(k)
+
+    target_points = np.stack((np.ravel(target_lon), np.ravel(target_lat)), axis=-1).astype(float)
+    data_interp = np.ma.empty([nz, ny, nx])
+    for k_vals in levels.values():
+        missing_2d = missing[k_vals[0],:]
+        source_points = np.stack((np.ravel(source_lon[~missing_2d]), np.ravel(source_lat[~missing_2d])), axis=-1).astype(float)
+        # One column for each depth
+        source_values = np.ma.getdata(data_z[k_vals,:][:,~missing_2d]).T.astype(float)
+        interpolant = get_nonreg_interpolator(source_points, target_points)
+        data_interp[k_vals,:] = np.reshape(interpolant.interp(source_values, fill_value=fill_value).T, [len(k_vals), ny, nx])
 
     return data_interp
 
@@ -657,33 +786,55 @@ def extract_slice_nonreg (data, direction, i1, i2, c1, c2):
     return data_slice
 
 
-# Fill missing values in the given array with a distance-weighted mean of its num_neighbours nearest neighbours (default 10).
-# For now only works with a 2D array and using index values as distance (rather than lat/lon or Cartesian distance or something), for the purposes of T/S space.
+# Fill missing values in the given array with a distance-weighted mean of its num_neighbours nearest neighbours (default 10). If there are ties for the furthest neighbour, all of the tied points are included.
+# Only works with a 2D array. By default it uses index values as distance, for the purposes of T/S space. You can instead pass 2D arrays x and y with the coordinates of each point: either Cartesian (eg polar stereographic) or lon and lat in degrees (set lonlat=True).
 # You can either pass a MaskedArray or set a specific missing value.
 # Can also pass an additional weighting array (eg log of volume)
-def distance_weighted_nearest_neighbours (data, weights=None, num_neighbours=10, missing_val=-9999):
+def distance_weighted_nearest_neighbours (data, weights=None, num_neighbours=10, missing_val=-9999, x=None, y=None, lonlat=False):
+
+    from scipy.spatial import cKDTree
 
     if isinstance(data, np.ma.MaskedArray):
-        mask = data.mask
+        mask = np.ma.getmaskarray(data)
     else:
         mask = data==missing_val
     if weights is None:
         weights = np.ones(data.shape)
-    i_vals, j_vals = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
+    if x is None or y is None:
+        # Use index values
+        x, y = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
+        lonlat = False
+    if lonlat:
+        points = lonlat_to_cartesian(x, y)
+    else:
+        points = np.stack((x, y), axis=-1).astype(float)
+    if not mask.any():
+        # Nothing to fill
+        return np.ma.getdata(data).astype(float)
+    data_valid = np.ma.getdata(data)[~mask]
+    weights_valid = weights[~mask]
+    num_valid = data_valid.size
+    if num_valid == 0:
+        print('Error (distance_weighted_nearest_neighbours): there are no valid points to fill the missing ones from')
+        sys.exit()
+    # Build a tree of the valid points only
+    tree = cKDTree(points[~mask])
+    missing_points = points[mask]
+    # Find the distance to the num_neighbours'th closest valid point
+    kth_distance = tree.query(missing_points, k=[min(num_neighbours, num_valid)])[0][:,0]
+    # Allow for round-off so that ties are caught
+    kth_distance *= 1+1e-10
+    # Count how many points are this close (more than num_neighbours if there are ties), and find them all
+    num_close = tree.query_ball_point(missing_points, kth_distance, return_length=True)
+    distance, index = tree.query(missing_points, k=[k+1 for k in range(np.amax(num_close))])
+    close = distance <= kth_distance[:,None]
+    # Points which don't exist have index num_valid and infinite distance; they will get zero weight
+    index = np.minimum(index, num_valid-1)
+    # Calculate the distance-weighted mean over these points, including additional weights
+    neighbour_weights = np.where(close, 1/distance, 0)*weights_valid[index]
     data_filled = np.empty(data.shape)
-    # Loop over missing points
-    for i0, j0 in zip(i_vals[mask], j_vals[mask]):
-        # Get the distance of every other point to this point
-        distance = np.sqrt((i_vals-i0)**2 + (j_vals-j0)**2)
-        # Apply the mask so we only consider distances to valid points
-        distance = np.ma.masked_where(mask, distance)
-        # Select the num_neighbours closest points
-        neighbours = distance <= np.sort(distance[~mask])[num_neighbours-1]
-        # Calculate 1/distance for weighting
-        inv_distance = 1/distance
-        # Calculate the distance-weighted mean over these points, including additional weights
-        data_filled[j0,i0] = np.sum(data[neighbours]*inv_distance[neighbours]*weights[neighbours])/np.sum(inv_distance[neighbours]*weights[neighbours])
-    data_filled[~mask] = data[~mask]
+    data_filled[mask] = np.sum(data_valid[index]*neighbour_weights, axis=-1)/np.sum(neighbour_weights, axis=-1)
+    data_filled[~mask] = data_valid
     return data_filled
     
 
@@ -182,15 +182,9 @@ def interp_bedmap2 (lon, lat, topo_dir, nc_out, bed_file=None, grounded_iceberg=
     lon_2d, lat_2d = np.meshgrid(lon, lat_b)
     x_interp, y_interp = polar_stereo(lon_2d, lat_2d)
 
-    # Interpolate fields
-    print('Interpolating bathymetry')
-    bathy_interp = interp_topo(x, y, bathy, x_interp, y_interp)
-    print('Interpolating ice shelf draft')
-    draft_interp = interp_topo(x, y, draft, x_interp, y_interp)
-    print('Interpolating ocean mask')
-    omask_interp = interp_topo(x, y, omask, x_interp, y_interp)
-    print('Interpolating ice mask')
-    imask_interp = interp_topo(x, y, imask, x_interp, y_interp)
+    # Interpolate fields, all at the same time so they share the sub-grid points
+    print('Interpolating bathymetry, ice shelf draft, ocean mask, and ice mask')
+    bathy_interp, draft_interp, omask_interp, imask_interp = interp_topo(x, y, [bathy, draft, omask, imask], x_interp, y_interp)
 
     if use_gebco:
         print('Filling in section north of 60S with GEBCO data')
@@ -24,16 +24,55 @@ from .calculus import area_average
 from .timeseries import trim_and_diff, timeseries_ismr, calc_annual_averages
 
 
+# Helper function to set up num_bins bins spanning the given bounds (plus a little extra on either side). Returns the edges and centres of the bins.
+def set_ts_bins (bounds, num_bins=1000):
+    eps = (bounds[1]-bounds[0])*1e-3
+    edges = np.linspace(bounds[0]-eps, bounds[1]+eps, num=num_bins+1)
+    centres = 0.5*(edges[:-1] + edges[1:])
+    return edges, centres
+
+
+# Helper function to add up the volume of water in each temperature and salinity bin. temp and salt are 1D arrays of values at each point, or 2D (time x points) to bin each time index separately. dV is the 1D array of volume at each point. All the values must be within the bin edges.
+# Returns an array of dimension temp bins x salt bins (with a leading time dimension if temp and salt are 2D). If volume is set (to an array of this shape), the new values are added to it in place and it is returned, so you can accumulate the volume over many files or time indices.
+def ts_bin_volume (temp, salt, dV, temp_edges, salt_edges, volume=None):
+
+    # Masked values (if any) get zero volume in the first bin
+    valid = np.invert(np.ma.getmaskarray(temp) + np.ma.getmaskarray(salt))
+    dV = dV*valid
+    temp = np.ma.filled(temp, temp_edges[0])
+    salt = np.ma.filled(salt, salt_edges[0])
+    num_temp = temp_edges.size-1
+    num_salt = salt_edges.size-1
+    # Find the index of each value in the bins: the same as the last edge which is <= the value
+    temp_index = np.searchsorted(temp_edges, temp, side='right')-1
+    salt_index = np.searchsorted(salt_edges, salt, side='right')-1
+    if np.any(temp_index < 0) or np.any(temp_index >= num_temp) or np.any(salt_index < 0) or np.any(salt_index >= num_salt):
+        print('Error (ts_bin_volume): some values are outside the bins')
+        sys.exit()
+    # Flatten to a single index into the temp x salt bins, and sum the volume in each with bincount
+    bin_index = temp_index*num_salt + salt_index
+    num_time = 1
+    if len(temp.shape) == 2:
+        # Separate set of bins for each time index
+        num_time = temp.shape[0]
+        bin_index += np.arange(num_time)[:,None]*num_temp*num_salt
+    volume_new = np.bincount(bin_index.ravel(), weights=np.broadcast_to(dV, temp.shape).ravel(), minlength=num_time*num_temp*num_salt)
+    if len(temp.shape) == 2:
+        volume_new = np.reshape(volume_new, [num_time, num_temp, num_salt])
+    else:
+        volume_new = np.reshape(volume_new, [num_temp, num_salt])
+    if volume is None:
+        return volume_new
+    volume += volume_new
+    return volume
+
+
 # Helper function to split temperature and salinity in the given region (set by mask) into bins, to get the volume in m^3 of each bin. The arrays can be time-dependent if you want. You can set the bounds of the bins, but they must be at least as permissive as the bounds of the data in that region.
 def ts_binning (temp, salt, grid, mask, time_dependent=False, num_bins=1000, tmin=None, tmax=None, smin=None, smax=None, bdry=False, dV_bdry=None):
 
     if len(mask.shape)==2 and not bdry:
         # Get 3D version of 2D mask
         mask = mask_2d_to_3d(mask, grid)
-    if time_dependent:
-        num_time = time.size
-    else:
-        num_time = 1
     if bdry:
         dV = dV_bdry
         if dV_bdry is None:
@@ -42,21 +81,19 @@ def ts_binning (temp, salt, grid, mask, time_dependent=False, num_bins=1000, tmi
     else:
         dV = grid.dV            
 
-    # Inner function to get min and max values in region
-    def get_vmin_vmax (data):
-        vmin = np.amax(data)
-        vmax = np.amin(data)
-        for t in range(num_time):
-            if time_dependent:
-                data_tmp = data[t,:]
-            else:
-                data_tmp = data
-            vmin = min(vmin, np.amin(data_tmp[mask]))
-            vmax = max(vmax, np.amax(data_tmp[mask]))
-        return [vmin, vmax]
+    # Select the points in the region, for all time indices at once
+    if time_dependent:
+        temp = temp[:,mask]
+        salt = salt[:,mask]
+    else:
+        temp = temp[mask]
+        salt = salt[mask]
+    dV = np.ma.getdata(dV[mask])
+
+    # Get min and max values in region
     print('Calculating bounds')
-    temp_bounds = get_vmin_vmax(temp)
-    salt_bounds = get_vmin_vmax(salt)
+    temp_bounds = [np.amin(temp), np.amax(temp)]
+    salt_bounds = [np.amin(salt), np.amax(salt)]
     if tmin is not None:
         if tmin > temp_bounds[0]:
             print('Error (ts_binning): tmin is too high')
@@ -79,35 +116,12 @@ def ts_binning (temp, salt, grid, mask, time_dependent=False, num_bins=1000, tmi
         salt_bounds[1] = smax            
 
     # Set up bins
-    def set_bins (bounds):
-        eps = (bounds[1]-bounds[0])*1e-3
-        edges = np.linspace(bounds[0]-eps, bounds[1]+eps, num=num_bins+1)
-        centres = 0.5*(edges[:-1] + edges[1:])
-        return edges, centres
-    temp_edges, temp_centres = set_bins(temp_bounds)
-    salt_edges, salt_centres = set_bins(salt_bounds)
-    if time_dependent:
-        volume = np.zeros([num_time, num_bins, num_bins])
-    else:
-        volume = np.zeros([num_bins, num_bins])
+    temp_edges, temp_centres = set_ts_bins(temp_bounds, num_bins=num_bins)
+    salt_edges, salt_centres = set_ts_bins(salt_bounds, num_bins=num_bins)
 
     # Now categorise the values
     print('Binning T and S')
-    for t in range(num_time):
-        if time_dependent:
-            print(('...time index '+str(t+1)+' of '+str(num_time)))
-            temp_tmp = temp[t,:]
-            salt_tmp = salt[t,:]
-        else:
-            temp_tmp = temp
-            salt_tmp = salt
-        for temp_val, salt_val, grid_val in zip(temp_tmp[mask], salt_tmp[mask], dV[mask]):
-            temp_index = np.nonzero(temp_edges > temp_val)[0][0]-1
-            salt_index = np.nonzero(salt_edges > salt_val)[0][0]-1
-            if time_dependent:
-                volume[t, temp_index, salt_index] += grid_val
-            else:
-                volume[temp_index, salt_index] += grid_val
+    volume = ts_bin_volume(temp, salt, dV, temp_edges, salt_edges)
     # Mask bins with zero volume
     volume = np.ma.masked_where(volume==0, volume)
     return volume, temp_centres, salt_centres, temp_edges, salt_edges           
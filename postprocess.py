@@ -7,11 +7,13 @@ import sys
 import numpy as np
 import shutil
 import netCDF4 as nc
+import json
+from functools import partial
 
 from .grid import Grid
-from .file_io import NCfile, netcdf_time, find_time_index, read_netcdf, read_iceprod
-from .timeseries import calc_timeseries, calc_special_timeseries, set_parameters
-from .utils import real_dir, days_per_month, str_is_int, mask_3d, mask_except_ice, mask_land, mask_land_ice, select_top, select_bottom, mask_outside_box, var_min_max, add_time_dim, apply_mask
+from .file_io import NCfile, netcdf_time, get_multi_file_dataset, file_checksum, read_netcdf, iter_netcdf, read_iceprod, preload_netcdf, clear_netcdf_cache
+from .timeseries import calc_special_timeseries, set_parameters, timeseries_variables
+from .utils import real_dir, days_per_month, str_is_int, mask_3d, mask_except_ice, mask_land, mask_land_ice, select_top, select_bottom, mask_outside_box, var_min_max, apply_mask
 from .constants import deg_string, region_names
 from .calculus import area_average
 from .diagnostics import density
@@ -228,16 +230,18 @@ def select_common_time (output_files_1, output_files_2, option='last_year', mont
         print('Error (select_common_time): need monthly output to correctly select the last year.')
         sys.exit()
 
-    # Concatenate the time arrays from all files
-    time_1 = calc_timeseries(output_files_1, option='time')
-    time_2 = calc_timeseries(output_files_2, option='time')
+    # Scan the time axes from all files
+    data_1 = get_multi_file_dataset(output_files_1, monthly=monthly)
+    data_2 = get_multi_file_dataset(output_files_2, monthly=monthly)
     # Find the last time index in the shortest simulation
-    time_index = min(time_1.size, time_2.size) - 1
-    file_path_1, time_index_1 = find_time_index(output_files_1, time_index)
-    file_path_2, time_index_2 = find_time_index(output_files_2, time_index)
+    time_index = min(data_1.size, data_2.size) - 1
+    n_1, time_index_1 = data_1.locate(time_index)
+    n_2, time_index_2 = data_2.locate(time_index)
+    file_path_1 = data_1.file_paths[n_1]
+    file_path_2 = data_2.file_paths[n_2]
     if check_match:
         # Make sure we got this right
-        if netcdf_time(file_path_1, monthly=monthly)[time_index_1] != netcdf_time(file_path_2, monthly=monthly)[time_index_2]:
+        if data_1.time[time_index] != data_2.time[time_index]:
             print('Error (select_common_time): something went wrong when matching time indices between the two files.')
             sys.exit()
     if option == 'last_year':
@@ -451,6 +455,10 @@ def set_update_time (id, mit_file, monthly=True, time_average=False):
     if time_average:
         # Only save the first one
         time = np.array([time[0]])
+    return set_update_time_values(id, time, time_units, calendar)
+
+# Define or update the time axis, given the Date objects, units and calendar (eg as saved by calc_precompute_timeseries).
+def set_update_time_values (id, time, time_units, calendar):
     if isinstance(id, nc.Dataset):
         # File is being updated
         # Update the units to match the old time array
@@ -510,36 +518,272 @@ def precompute_timeseries (mit_file, timeseries_file, timeseries_types=None, mon
     # Build the grid
     if grid is None:
         grid = Grid(mit_file)
-    if any (['density' in s for s in timeseries_types]):
-        # Precompute density so we don't have to re-calculate it for each density variable. If there's only one density variable, this won't make a difference.
-        temp = read_netcdf(mit_file, 'THETA', time_average=time_average)
-        salt = read_netcdf(mit_file, 'SALT', time_average=time_average)
-        rho = density(eosType, salt, temp, 0, rhoConst=rhoConst, Tref=Tref, Sref=Sref, tAlpha=tAlpha, sBeta=sBeta)
-    else:
-        rho = None
 
-    # Set up or update the file and time axis
-    id = set_update_file(timeseries_file, grid, 't')
-    num_time = set_update_time(id, mit_file, monthly=monthly, time_average=time_average)
+    results = calc_precompute_timeseries(mit_file, timeseries_types, monthly=monthly, lon0=lon0, lat0=lat0, eosType=eosType, rhoConst=rhoConst, Tref=Tref, Sref=Sref, tAlpha=tAlpha, sBeta=sBeta, time_average=time_average, grid=grid)
+    write_precomputed(timeseries_file, results, 't', grid=grid)
+
+
+# Helper function for precompute_timeseries: calculate all the timeseries from the given file, without writing anything. Returns a dictionary containing the path to the MITgcm file ('mit_file'), its time axis ('time', 'time_units', 'calendar'), the timeseries types ('types'), and a list of [var_name, data, title, units] for each variable to save ('variables').
+# This is a separate function so it can be called by worker processes (see precompute_segments).
+def calc_precompute_timeseries (mit_file, timeseries_types, monthly=True, lon0=None, lat0=None, eosType='MDJWF', rhoConst=None, Tref=None, Sref=None, tAlpha=None, sBeta=None, time_average=False, grid=None):
+
+    if grid is None:
+        grid = Grid(mit_file)
 
-    # Now process all the timeseries
+    # Work out which variables are needed by more than one timeseries type, and read each of these from the file just once.
+    # Note this means the whole record of each shared variable (eg THETA and SALT) is held in memory while the file is processed, and iter_netcdf serves their slabs from there: only the variables used by a single timeseries type are streamed from the file one slab at a time.
+    var_count = {}
     for ts_name in timeseries_types:
-        print(('Processing ' + ts_name))
-        # Get information about the variable; only care about title and units
-        title, units = set_parameters(ts_name)[2:4]
-        if ts_name == 'fris_mass_balance':
-            melt, freeze = calc_special_timeseries(ts_name, mit_file, grid=grid, monthly=monthly, time_average=time_average)[1:]
-            # We need two titles now
-            title_melt = 'Total melting beneath FRIS'
-            title_freeze = 'Total refreezing beneath FRIS'
-            # Update two variables
-            set_update_var(id, num_time, melt, 't', 'fris_total_melt', title_melt, units)
-            set_update_var(id, num_time, freeze, 't', 'fris_total_freeze', title_freeze, units)
+        for var in timeseries_variables(ts_name):
+            var_count[var] = var_count.get(var, 0) + 1
+    try:
+        preload_netcdf(mit_file, [var for var in var_count if var_count[var] > 1])
+
+        if any (['density' in s for s in timeseries_types]):
+            # Precompute density so we don't have to re-calculate it for each density variable. If there's only one density variable, this won't make a difference.
+            temp = read_netcdf(mit_file, 'THETA', time_average=time_average)
+            salt = read_netcdf(mit_file, 'SALT', time_average=time_average)
+            rho = density(eosType, salt, temp, 0, rhoConst=rhoConst, Tref=Tref, Sref=Sref, tAlpha=tAlpha, sBeta=sBeta)
         else:
-            data = calc_special_timeseries(ts_name, mit_file, grid=grid, lon0=lon0, lat0=lat0, monthly=monthly, rho=rho, time_average=time_average)[1]
-            set_update_var(id, num_time, data, 't', ts_name, title, units)
+            rho = None
+
+        # Time axis
+        time, time_units, calendar = netcdf_time(mit_file, return_units=True, monthly=monthly)
+        if time_average:
+            # Only save the first one
+            time = np.array([time[0]])
+        results = {'mit_file':mit_file, 'time':time, 'time_units':time_units, 'calendar':calendar, 'types':list(timeseries_types), 'variables':[]}
+
+        # Now process all the timeseries
+        for ts_name in timeseries_types:
+            print(('Processing ' + ts_name))
+            # Get information about the variable; only care about title and units
+            title, units = set_parameters(ts_name)[2:4]
+            if ts_name == 'fris_mass_balance':
+                melt, freeze = calc_special_timeseries(ts_name, mit_file, grid=grid, monthly=monthly, time_average=time_average)[1:]
+                # We need two variables, with two titles
+                results['variables'].append(['fris_total_melt', melt, 'Total melting beneath FRIS', units])
+                results['variables'].append(['fris_total_freeze', freeze, 'Total refreezing beneath FRIS', units])
+            else:
+                data = calc_special_timeseries(ts_name, mit_file, grid=grid, lon0=lon0, lat0=lat0, monthly=monthly, rho=rho, time_average=time_average)[1]
+                results['variables'].append([ts_name, data, title, units])
+    finally:
+        # Free the memory even if something went wrong
+        clear_netcdf_cache(mit_file)
+    return results
+
+
+# Name of the global attribute in precomputed timeseries and Hovmoller files which keeps a record of what has been processed (see read_manifest).
+manifest_attr = 'precompute_manifest'
 
+
+# Read the manifest saved in a precomputed file by write_precomputed. It is a dictionary with the types which have been processed ('types') and a list of the segments which have been processed, in order ('segments'). Each segment is a dictionary with the path to the MITgcm file ('file', relative to the directory of the precomputed file), its number of time indices ('num_time') and its checksum when it was processed ('size', 'mtime', 'md5', as in file_checksum).
+# Returns None if the file doesn't exist, or was created before manifests were introduced.
+def read_manifest (precomputed_file):
+
+    if not os.path.isfile(precomputed_file):
+        return None
+    id = nc.Dataset(precomputed_file, 'r')
+    if manifest_attr in id.ncattrs():
+        manifest = json.loads(id.getncattr(manifest_attr))
+    else:
+        manifest = None
     id.close()
+    return manifest
+
+
+# Helper functions to convert between the paths of MITgcm files saved in a manifest (relative to the precomputed file, so the whole directory can be moved) and absolute paths.
+def manifest_path (precomputed_file, mit_file):
+    return os.path.relpath(os.path.abspath(mit_file), os.path.dirname(os.path.abspath(precomputed_file)))
+
+def manifest_abspath (precomputed_file, path):
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(precomputed_file)), path))
+
+
+# Write the results from calc_precompute_timeseries or calc_precompute_hovmoller to the given file: create it (with the given dimensions, eg 't' or 'zt') if it doesn't exist, otherwise append to it. If the file needs to be created and grid isn't set, the grid will be built from the MITgcm file the results came from.
+# The new segment is recorded in the manifest (see read_manifest), unless the file was created before manifests were introduced. The whole update is written to a temporary copy which then replaces the original file, so if anything goes wrong the original file is left as it was.
+def write_precomputed (precomputed_file, results, dimensions, grid=None):
+
+    if os.path.isfile(precomputed_file):
+        manifest = read_manifest(precomputed_file)
+    else:
+        if grid is None:
+            grid = Grid(results['mit_file'])
+        manifest = {'types':[], 'segments':[]}
+    tmp_file = precomputed_file + '.tmp'
+    if os.path.isfile(precomputed_file):
+        shutil.copyfile(precomputed_file, tmp_file)
+    id = None
+    try:
+        id = set_update_file(tmp_file, grid, dimensions)
+        num_time = set_update_time_values(id, results['time'], results['time_units'], results['calendar'])
+        for var_name, data, title, units in results['variables']:
+            set_update_var(id, num_time, data, dimensions, var_name, title, units)
+        if manifest is not None:
+            # Record this segment
+            for ts_name in results['types']:
+                if ts_name not in manifest['types']:
+                    manifest['types'].append(ts_name)
+            segment = {'file':manifest_path(precomputed_file, results['mit_file']), 'num_time':len(results['time'])}
+            if 'checksum' in results:
+                segment.update(results['checksum'])
+            else:
+                segment.update(file_checksum(results['mit_file']))
+            manifest['segments'].append(segment)
+            set_manifest(id, manifest)
+        id.close()
+    except BaseException:
+        # Roll back
+        if id is not None:
+            id.close()
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, precomputed_file)
+
+
+# Save the manifest to the given NetCDF file (either an NCfile or a Dataset).
+def set_manifest (id, manifest):
+    if isinstance(id, NCfile):
+        id = id.id
+    id.setncattr(manifest_attr, json.dumps(manifest))
+
+
+# Helper function for update_precomputed: calculate the given types for one file, as well as its checksum. kind is 'timeseries' (types are as in precompute_timeseries) or 'hovmoller' (types are location_variable, eg 'pine_island_bay_temp').
+# This is a separate function so it can be called by worker processes (see precompute_segments).
+def calc_precompute_types (mit_file, types, kind='timeseries', monthly=True, time_average=False, grid=None):
+
+    print(('Processing ' + mit_file))
+    if kind == 'timeseries':
+        results = calc_precompute_timeseries(mit_file, types, monthly=monthly, time_average=time_average, grid=grid)
+    elif kind == 'hovmoller':
+        # Group the locations by variable
+        results = None
+        for v in ['temp', 'salt']:
+            loc = [ts_name[:-len('_'+v)] for ts_name in types if ts_name.endswith('_'+v)]
+            if len(loc) == 0:
+                continue
+            results_v = calc_precompute_hovmoller(mit_file, loc=loc, var=[v], monthly=monthly)
+            if results is None:
+                results = results_v
+            else:
+                results['types'] += results_v['types']
+                results['variables'] += results_v['variables']
+    else:
+        print(('Error (calc_precompute_types): invalid kind ' + kind))
+        sys.exit()
+    results['checksum'] = file_checksum(mit_file)
+    return results
+
+
+# Bring a precomputed timeseries or Hovmoller file (kind='timeseries' or 'hovmoller') up to date with the given segment files, using the manifest saved in the file (see read_manifest) to work out what still needs to be done:
+# (1) types which haven't been processed before are calculated for the segments already in the file, and added to it, without recomputing anything else;
+# (2) segments which aren't in the file yet are processed (for all the types in the file) and appended, in order.
+# Each segment is appended atomically (see write_precomputed), so if this is interrupted, re-running it will carry on from the last complete segment. Segments which have changed since they were processed are reported, but not recomputed.
+# If the file was created before manifests were introduced, all the given files are just appended as before.
+# monthly, time_average, grid: as in precompute_timeseries (only monthly applies to Hovmollers)
+# num_workers, max_memory: as in precompute_segments
+def update_precomputed (precomputed_file, file_paths, types, kind='timeseries', monthly=True, time_average=False, grid=None, num_workers=1, max_memory=None):
+
+    if kind == 'timeseries':
+        dimensions = 't'
+    else:
+        dimensions = 'zt'
+    manifest = read_manifest(precomputed_file)
+    if manifest is None and os.path.isfile(precomputed_file):
+        print(('Warning: ' + precomputed_file + ' has no manifest, so all the given files will be appended to it'))
+        new_files = file_paths
+    else:
+        if manifest is None:
+            manifest = {'types':[], 'segments':[]}
+        old_files = [manifest_abspath(precomputed_file, segment['file']) for segment in manifest['segments']]
+        # Check if any segments have changed since they were processed
+        for file_path, segment in zip(old_files, manifest['segments']):
+            if os.path.isfile(file_path) and (os.path.getsize(file_path) != segment['size'] or os.path.getmtime(file_path) != segment['mtime']):
+                if file_checksum(file_path)['md5'] != segment['md5']:
+                    print(('Warning: ' + file_path + ' has changed since it was processed. Delete ' + precomputed_file + ' if you want to recompute it.'))
+        # Add any new types to the existing segments
+        new_types = [ts_name for ts_name in types if ts_name not in manifest['types']]
+        if len(new_types) > 0 and len(old_files) > 0:
+            print(('Adding ' + ', '.join(new_types) + ' to ' + precomputed_file))
+            add_precomputed_types(precomputed_file, old_files, new_types, kind=kind, monthly=monthly, time_average=time_average, grid=grid, num_workers=num_workers, max_memory=max_memory)
+        types = manifest['types'] + new_types
+        # Find the segments which haven't been processed yet
+        new_files = [f for f in file_paths if os.path.abspath(f) not in old_files]
+    if len(new_files) == 0:
+        print((precomputed_file + ' is up to date'))
+        return
+
+    compute_function = partial(calc_precompute_types, types=types, kind=kind, monthly=monthly, time_average=time_average, grid=grid)
+    def write_function (results):
+        write_precomputed(precomputed_file, results, dimensions, grid=grid)
+    precompute_segments(compute_function, new_files, write_function, num_workers=num_workers, max_memory=max_memory)
+
+
+# Helper function for update_precomputed: calculate the given new types for all the segments which are already in the precomputed file, and add them as new variables. This is done in a temporary copy which only replaces the original file when everything has finished.
+def add_precomputed_types (precomputed_file, file_paths, types, kind='timeseries', monthly=True, time_average=False, grid=None, num_workers=1, max_memory=None):
+
+    if kind == 'timeseries':
+        dim_names = ('time',)
+    else:
+        dim_names = ('time', 'Z')
+    manifest = read_manifest(precomputed_file)
+    tmp_file = precomputed_file + '.tmp'
+    shutil.copyfile(precomputed_file, tmp_file)
+    id = nc.Dataset(tmp_file, 'a')
+    # Time index at which the next segment starts, and the number of segments written
+    progress = [0, 0]
+
+    def write_function (results):
+        num_time = manifest['segments'][progress[1]]['num_time']
+        if len(results['time']) != num_time:
+            print(('Error (add_precomputed_types): ' + results['mit_file'] + ' has a different number of time indices than when it was processed'))
+            sys.exit()
+        for var_name, data, title, units in results['variables']:
+            if var_name not in id.variables:
+                id.createVariable(var_name, 'f8', dim_names)
+                id.variables[var_name].long_name = title
+                id.variables[var_name].units = units
+            id.variables[var_name][progress[0]:progress[0]+num_time] = data
+        progress[0] += num_time
+        progress[1] += 1
+
+    try:
+        compute_function = partial(calc_precompute_types, types=types, kind=kind, monthly=monthly, time_average=time_average, grid=grid)
+        precompute_segments(compute_function, file_paths, write_function, num_workers=num_workers, max_memory=max_memory)
+        manifest['types'] += types
+        set_manifest(id, manifest)
+        id.close()
+    except BaseException:
+        # Roll back
+        if id.isopen():
+            id.close()
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, precomputed_file)
+
+
+# Call compute_function for each of the given files (eg the segments of a coupled simulation, in chronological order), and pass each result to write_function in the same order.
+# With num_workers > 1, the files are processed in parallel by a pool of processes. There is still only one writer (this process), which writes each result as soon as it and all the results before it are ready, so the output files are always in chronological order. compute_function must be picklable, eg a module-level function or a functools.partial of one.
+# max_memory (GB) caps the number of workers, assuming each one needs about as much memory as the largest file.
+def precompute_segments (compute_function, file_paths, write_function, num_workers=1, max_memory=None):
+
+    if max_memory is not None and len(file_paths) > 0:
+        file_size = max([os.path.getsize(f) for f in file_paths])*1e-9
+        num_workers = max(min(num_workers, int(max_memory//max(file_size, 1e-9))), 1)
+    num_workers = min(num_workers, len(file_paths))
+
+    if num_workers <= 1:
+        for file_path in file_paths:
+            write_function(compute_function(file_path))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    print(('Processing ' + str(len(file_paths)) + ' files with ' + str(num_workers) + ' workers'))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(compute_function, file_path) for file_path in file_paths]
+        # Write in order
+        for future in futures:
+            write_function(future.result())
 
 
 # Precompute ocean timeseries from a coupled UaMITgcm simulation.
@@ -547,10 +791,11 @@ def precompute_timeseries (mit_file, timeseries_file, timeseries_types=None, mon
 # output_dir: path to master output directory for experiment. Default the current directory.
 # timeseries_file: as in precompute_timeseries. Default 'timeseries.nc'.
 # file_name: name of the output NetCDF file within the output/XXXXXX/MITgcm/ directories. Default 'output.nc'.
-# segment_dir: list of date codes, in chronological order, corresponding to the subdirectories within output_dir. This must be specified if timeseries_file already exists. If it is not specified, all available subdirectories of output_dir will be used.
+# segment_dir: list of date codes, in chronological order, corresponding to the subdirectories within output_dir. If it is not specified, all available subdirectories of output_dir will be used. Either way, any segments which have already been processed (according to the manifest in timeseries_file, see update_precomputed) will be skipped. This must be specified if timeseries_file already exists but was created before manifests were introduced.
 # timeseries_types: as in precompute_timeseries
 # time_average: Average each year to create an annually averaged timeseries
-def precompute_timeseries_coupled (output_dir='./', timeseries_file='timeseries.nc', hovmoller_file='hovmoller.nc', file_name='output.nc', segment_dir=None, timeseries_types=None, hovmoller_loc=None, key='PAS', time_average=False):
+# num_workers, max_memory: process the segments in parallel with this many workers, and an approximate memory cap in GB (see precompute_segments)
+def precompute_timeseries_coupled (output_dir='./', timeseries_file='timeseries.nc', hovmoller_file='hovmoller.nc', file_name='output.nc', segment_dir=None, timeseries_types=None, hovmoller_loc=None, key='PAS', time_average=False, num_workers=1, max_memory=None):
 
     if timeseries_types is None:
         if key == 'WSFRIS':
@@ -572,18 +817,20 @@ def precompute_timeseries_coupled (output_dir='./', timeseries_file='timeseries.
 
     output_dir = real_dir(output_dir)
 
-    if segment_dir is None and os.path.isfile(output_dir+timeseries_file):
-        print(('Error (precompute_timeseries_coupled): since ' + timeseries_file + ' exists, you must specify segment_dir'))
-        sys.exit()
+    precomputed_files = [output_dir+timeseries_file]
+    if len(hovmoller_loc) > 0:
+        precomputed_files.append(output_dir+hovmoller_file)
+    for f in precomputed_files:
+        if segment_dir is None and os.path.isfile(f) and read_manifest(f) is None:
+            print(('Error (precompute_timeseries_coupled): since ' + f + ' exists and has no manifest, you must specify segment_dir'))
+            sys.exit()
     segment_dir = check_segment_dir(output_dir, segment_dir)
     file_paths = segment_file_paths(output_dir, segment_dir, file_name)
 
-    # Call precompute_timeseries for each segment
-    for file_path in file_paths:
-        print(('Processing ' + file_path))
-        precompute_timeseries(file_path, output_dir+timeseries_file, timeseries_types=timeseries_types, monthly=True, time_average=time_average)
-        if len(hovmoller_loc) > 0 and hovmoller_loc is not None:
-            precompute_hovmoller(file_path, output_dir+hovmoller_file, loc=hovmoller_loc)
+    # Process any new segments (and new types), in parallel if num_workers > 1
+    update_precomputed(output_dir+timeseries_file, file_paths, timeseries_types, kind='timeseries', monthly=True, time_average=time_average, num_workers=num_workers, max_memory=max_memory)
+    if len(hovmoller_loc) > 0:
+        update_precomputed(output_dir+hovmoller_file, file_paths, [l+'_'+v for v in ['temp', 'salt'] for l in hovmoller_loc], kind='hovmoller', num_workers=num_workers, max_memory=max_memory)
 
 
 # Make animations of lat-lon variables throughout a coupled UaMITgcm simulation, and also images of the first and last frames.
@@ -817,6 +1064,30 @@ def time_dependent_variables (file_name):
     return var_names
 
 
+# Helper function for average_monthly_files: time-average the given variables over the given files, where file_indices is a list of (t_start, t_end, ndays) for each file: the range of time indices to include and the number of days in each of them. Each file is opened once, and all the time indices needed for each variable are read at once. Sums are in double precision. Returns a dictionary of the averaged data for each variable.
+# This is a separate function so it can be called by worker processes.
+def average_monthly_variables (input_files, var_names, file_indices):
+
+    data = {}
+    total_days = 0
+    for file_name, (t_start, t_end, ndays) in zip(input_files, file_indices):
+        print(('...' + file_name))
+        id_in = nc.Dataset(file_name, 'r')
+        for var in var_names:
+            # Integrate over all time indices at once
+            data_int = np.tensordot(ndays, np.ma.getdata(id_in.variables[var][t_start:t_end]).astype(np.float64), axes=(0,0))
+            if var in data:
+                data[var] += data_int
+            else:
+                data[var] = data_int
+        id_in.close()
+        total_days += np.sum(ndays)
+    # Now convert from integral to average
+    for var in var_names:
+        data[var] /= total_days
+    return data
+
+
 # Do a proper time-average of files with monthly output, where each month is weighted with the number of days it represents. Make sure you load NCO before calling this function.
 
 # Arguments:
@@ -827,10 +1098,11 @@ def time_dependent_variables (file_name):
 # t_start: index (0-based) of the time record to start the average in input_files[0].
 # t_end: index (0-based) of the time record to end the average in input_files[-1]. In python convention, this is the first index to ignore.
 # leap_years: boolean (default true) for whether to consider leap years
+# num_workers: number of processes to split the variables between (default 1, i.e. no parallelisation)
 # For example, to average from month 7 (index 6) of the first file to month 10 (index 9)  of the last file, do
 # average_monthly_files(input_files, output_file, t_start=6, t_end=10)
 
-def average_monthly_files (input_files, output_file, t_start=0, t_end=None, leap_years=True):
+def average_monthly_files (input_files, output_file, t_start=0, t_end=None, leap_years=True, num_workers=1):
 
     from nco import Nco
     from nco.custom import Limit
@@ -847,68 +1119,55 @@ def average_monthly_files (input_files, output_file, t_start=0, t_end=None, leap
 
     # Get the starting date
     time0 = netcdf_time(output_file)
-    year0 = time0[0].year
-    month0 = time0[0].month    
+    year = time0[0].year
+    month = time0[0].month    
 
     # Find all the time-dependent variables
     var_names = time_dependent_variables(output_file)
 
-    # Time-average each variable
+    # Figure out which time indices to use from each file, and the number of days in each
+    file_indices = []
+    for i in range(len(input_files)):
+        id_in = nc.Dataset(input_files[i], 'r')
+        num_time = id_in.variables[var_names[0]].shape[0]
+        id_in.close()
+        # Special cases for first and last files, if t_start or t_end are set
+        if i == 0:
+            t_start_curr = t_start
+        else:
+            t_start_curr = 0
+        if i == len(input_files)-1 and t_end is not None:
+            t_end_curr = t_end
+        else:
+            t_end_curr = num_time
+        ndays = []
+        for t in range(t_start_curr, t_end_curr):
+            ndays.append(days_per_month(month, year, allow_leap=leap_years))
+            # Increment month (and year if needed)
+            month += 1
+            if month == 13:
+                month = 1
+                year += 1
+        file_indices.append((t_start_curr, t_end_curr, np.array(ndays, dtype=np.float64)))
+
+    # Time-average all the variables
+    if num_workers > 1 and len(var_names) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        # Split the variables between the workers
+        var_groups = [var_names[n::num_workers] for n in range(min(num_workers, len(var_names)))]
+        print(('Processing ' + str(len(var_names)) + ' variables with ' + str(len(var_groups)) + ' workers'))
+        data = {}
+        with ProcessPoolExecutor(max_workers=len(var_groups)) as executor:
+            for data_group in executor.map(average_monthly_variables, [input_files]*len(var_groups), var_groups, [file_indices]*len(var_groups)):
+                data.update(data_group)
+    else:
+        print(('Processing ' + ', '.join(var_names)))
+        data = average_monthly_variables(input_files, var_names, file_indices)
+
+    # Overwrite each variable in the output file
     id_out = nc.Dataset(output_file, 'a')
     for var in var_names:
-        print(('Processing ' + var))
-
-        # Reset time
-        year = year0
-        month = month0
-        # Set up accumulation array of the right dimension for this variable
-        shape = id_out.variables[var].shape[1:]
-        data = np.zeros(shape)
-        # Also accumulate total number of days
-        total_days = 0
-
-        # Loop over input files
-        for i in range(len(input_files)):
-
-            file_name = input_files[i]
-            print(('...' + file_name))
-            
-            # Figure out how many time indices there are
-            id_in = nc.Dataset(file_name, 'r')
-            num_time = id_in.variables[var].shape[0]
-
-            # Choose which indices we will loop over: special cases for first and last files, if t_start or t_end are set
-            if i == 0:
-                t_start_curr = t_start
-            else:
-                t_start_curr = 0
-            if i == len(input_files)-1 and t_end is not None:
-                t_end_curr = t_end
-            else:
-                t_end_curr = num_time
-
-            # Now loop over time indices
-            for t in range(t_start_curr, t_end_curr):
-                # Integrate
-                ndays = days_per_month(month, year)
-                if month==2 and not leap_years:
-                    # Remove any leap day in February
-                    ndays = 28
-                data += id_in.variables[var][t,:]*ndays
-                total_days += ndays
-                # Increment month (and year if needed)
-                month += 1
-                if month == 13:
-                    month = 1
-                    year += 1
-
-            id_in.close()
-
-        # Now convert from integral to average
-        data /= total_days
-        # Overwrite this variable in the output file
-        id_out.variables[var][0,:] = data
-
+        id_out.variables[var][0,:] = data[var]
     id_out.close()
 
 
@@ -951,7 +1210,8 @@ def simple_average_files (input_files, output_file, t_start=0, t_end=None):
 # Optional keyword arguments:
 # in_dir: path to directory containing output_*.nc files
 # out_dir: path to directory to save the annually averaged files
-def make_annual_averages (in_dir='./', out_dir='./'):
+# num_workers: as in average_monthly_files
+def make_annual_averages (in_dir='./', out_dir='./', num_workers=1):
 
     in_dir = real_dir(in_dir)
     out_dir = real_dir(out_dir)
@@ -994,7 +1254,7 @@ def make_annual_averages (in_dir='./', out_dir='./'):
             t_start = t
             t_end = t+12
             print(('Processing all of ' + str(year) + ' from ' + file_names[i] + ', indices ' + str(t_start) + ' to ' + str(t_end-1)))
-            average_monthly_files(files_to_average, out_dir+str(year)+'_avg.nc', t_start=t_start, t_end=t_end)
+            average_monthly_files(files_to_average, out_dir+str(year)+'_avg.nc', t_start=t_start, t_end=t_end, num_workers=num_workers)
             files_to_average = []
             t_start = None
             t += 12
@@ -1028,7 +1288,7 @@ def make_annual_averages (in_dir='./', out_dir='./'):
                 sys.exit()
             t_end = t+12-tmp_months
             print(('Processing end of ' + str(year) + ' from ' + file_names[i] + ', indices ' + str(t) + ' to ' + str(t_end-1)))
-            average_monthly_files(files_to_average, out_dir+str(year)+'_avg.nc', t_start=t_start, t_end=t_end)
+            average_monthly_files(files_to_average, out_dir+str(year)+'_avg.nc', t_start=t_start, t_end=t_end, num_workers=num_workers)
             files_to_average = []
             t_start = None
             t += 12-tmp_months
@@ -1105,6 +1365,13 @@ def calc_ice_prod (file_path, out_file, monthly=True):
 # Precompute Hovmoller plots (time x depth) for each of the given variables (default temperature and salinity), area-averaged over each of the given regions (default boxes in Pine Island Bay and in front of Dotson).
 def precompute_hovmoller (mit_file, hovmoller_file, loc=['pine_island_bay', 'dotson_bay', 'amundsen_west_shelf_break'], var=['temp', 'salt'], monthly=True):
 
+    results = calc_precompute_hovmoller(mit_file, loc=loc, var=var, monthly=monthly)
+    write_precomputed(hovmoller_file, results, 'zt')
+
+
+# Helper function for precompute_hovmoller: calculate all the Hovmollers from the given file, without writing anything. Returns a dictionary in the same format as calc_precompute_timeseries, where the types are location_variable (eg 'pine_island_bay_temp').
+def calc_precompute_hovmoller (mit_file, loc=['pine_island_bay', 'dotson_bay', 'amundsen_west_shelf_break'], var=['temp', 'salt'], monthly=True):
+
     if isinstance(loc, str):
         # Make it a list
         loc = [loc]
@@ -1112,9 +1379,17 @@ def precompute_hovmoller (mit_file, hovmoller_file, loc=['pine_island_bay', 'dot
     # Build the grid
     grid = Grid(mit_file)
 
-    # Set up or update the file and time axis
-    id = set_update_file(hovmoller_file, grid, 'zt')
-    num_time = set_update_time(id, mit_file, monthly=monthly)
+    # Time axis
+    time, time_units, calendar = netcdf_time(mit_file, return_units=True, monthly=monthly)
+    results = {'mit_file':mit_file, 'time':time, 'time_units':time_units, 'calendar':calendar, 'types':[l+'_'+v for v in var for l in loc], 'variables':[]}
+
+    # Region to average over for each location
+    masks = []
+    for l in loc:
+        if l == 'filchner_front':
+            masks.append(grid.get_icefront_mask(shelf='filchner'))
+        else:
+            masks.append(grid.get_region_mask(l))
 
     for v in var:
         print(('Processing ' + v))
@@ -1126,46 +1401,38 @@ def precompute_hovmoller (mit_file, hovmoller_file, loc=['pine_island_bay', 'dot
             var_name = 'SALT'
             title = 'Salinity'
             units = 'psu'
-        # Read data
-        data_full = read_netcdf(mit_file, var_name)
-        if netcdf_time(mit_file).size == 1:
-            # Need a dummy time dimension
-            data_full = add_time_dim(data_full, 1)
-        # Mask land/ice shelves
-        data_full = mask_3d(data_full, grid, time_dependent=True)
-        for l in loc:
+        # Area-averages over each region, from each slab of time indices
+        data_loc = [[] for l in loc]
+        # Read data one slab at a time, so the full record is never in memory
+        for data_full in iter_netcdf(mit_file, var_name):
+            # Mask land/ice shelves
+            data_full = mask_3d(data_full, grid, time_dependent=True)
+            for mask, data_slabs in zip(masks, data_loc):
+                # Average over the correct region
+                data = apply_mask(data_full, np.invert(mask), time_dependent=True, depth_dependent=True)
+                data_slabs.append(area_average(data, grid, time_dependent=True))
+        for l, data_slabs in zip(loc, data_loc):
             print(('...at ' + l))
             loc_name = region_names[l]
-            # Average over the correct region
-            if l == 'filchner_front':
-                mask = grid.get_icefront_mask(shelf='filchner')
-            else:
-                mask = grid.get_region_mask(l)
-            data = apply_mask(data_full, np.invert(mask), time_dependent=True, depth_dependent=True)
-            data = area_average(data, grid, time_dependent=True)
-            set_update_var(id, num_time, data, 'zt', l+'_'+v, loc_name+' '+title, units)
+            results['variables'].append([l+'_'+v, np.ma.concatenate(data_slabs, axis=0), loc_name+' '+title, units])
 
-    # Finished
-    if isinstance(id, nc.Dataset):
-        id.close()
-    elif isinstance(id, NCfile):
-        id.close()
+    return results
 
 
-# Call precompute_hovmoller for every segment in a coupled simulation.
-def precompute_hovmoller_all_coupled (output_dir='./', hovmoller_file='hovmoller.nc', file_name='output.nc', segment_dir=None, loc=['filchner_trough'], var=['temp', 'salt'], monthly=True):
+# Call precompute_hovmoller for every segment in a coupled simulation which hasn't been processed yet (see update_precomputed). Set num_workers (and optionally max_memory) to process the segments in parallel, as in precompute_segments.
+def precompute_hovmoller_all_coupled (output_dir='./', hovmoller_file='hovmoller.nc', file_name='output.nc', segment_dir=None, loc=['filchner_trough'], var=['temp', 'salt'], monthly=True, num_workers=1, max_memory=None):
 
     output_dir = real_dir(output_dir)
-    if segment_dir is None and os.path.isfile(output_dir+hovmoller_file):
-        print(('Error (precompute_hovmoller_all_coupled): since ' + hovmoller_file + ' exists, you must specify segment_dir'))
+    if segment_dir is None and os.path.isfile(output_dir+hovmoller_file) and read_manifest(output_dir+hovmoller_file) is None:
+        print(('Error (precompute_hovmoller_all_coupled): since ' + hovmoller_file + ' exists and has no manifest, you must specify segment_dir'))
         sys.exit()
     segment_dir = check_segment_dir(output_dir, segment_dir)
     file_paths = segment_file_paths(output_dir, segment_dir, file_name)
 
-    # Call precompute_hovmoller for each segment
-    for file_path in file_paths:
-        print(('Processing ' + file_path))
-        precompute_hovmoller(file_path, output_dir+hovmoller_file, loc=loc, var=var, monthly=monthly)
+    # Process any new segments (and new locations/variables), in parallel if num_workers > 1
+    if isinstance(loc, str):
+        loc = [loc]
+    update_precomputed(output_dir+hovmoller_file, file_paths, [l+'_'+v for v in var for l in loc], kind='hovmoller', monthly=monthly, num_workers=num_workers, max_memory=max_memory)
         
 
 # Make figures to compare two simulations (generally 3-panel figures with 1, 2, and 2-1).
@@ -1241,52 +1508,33 @@ def get_output_files (output_dir):
     return fnames
 
 
-# Calculate the long-term mean of a simulation between the given years (inclusive). Return the name of the generated file. Load NCO before you run this.
-def long_term_mean (output_dir, year_start, year_end, proper_weighting=True, leap_years=True):
+# Calculate the long-term mean of a simulation between the given years (inclusive). Return the name of the generated file. Load NCO before you run this. With proper_weighting=True, you can set num_workers to split the variables between processes (see average_monthly_files).
+def long_term_mean (output_dir, year_start, year_end, proper_weighting=True, leap_years=True, num_workers=1):
 
     # Read all the output files, and sort them by number
     output_dir = real_dir(output_dir)
     fnames = get_output_files(output_dir)
 
-    # Loop through to find filenames and indices to start and end
-    start_file = None
-    end_file = None
-    files_to_avg = []
-    for f in fnames:
-        file_path = output_dir + f
-        time = netcdf_time(file_path)
-        if start_file is None:
-            # Look for start file
-            if ((time[0].year < year_start) or (time[0].year == year_start and time[0].month == 1)) and (time[-1].year >= year_start):
-                # This is the right file
-                start_file = file_path
-                files_to_avg.append(file_path)
-                # Now find the index of Jan year_start
-                for t in range(time.size):
-                    if time[t].year == year_start and time[t].month == 1:
-                        t_start = t
-                        break
-        else:
-            # Have already found start_file, so we know we need this file
-            files_to_avg.append(file_path)
-            # Now look for end file
-            if (time[-1].year > year_end) or (time[-1].year == year_end and time[-1].month == 12):
-                # This is the right file
-                end_file = file_path
-                # Now find the index of Dec year_end and add one (as per python convention for first index to ignore)
-                for t in range(time.size):
-                    if time[t].year == year_end and time[t].month == 12:
-                        t_end = t+1
-                        break
-                break
-
+    # Find the global time indices of January year_start and December year_end
+    data = get_multi_file_dataset([output_dir + f for f in fnames])
+    years = np.array([time.year for time in data.time])
+    months = np.array([time.month for time in data.time])
+    index_start = np.flatnonzero((years == year_start) & (months == 1))
+    index_end = np.flatnonzero((years == year_end) & (months == 12))
     # Make sure we found them
-    if start_file is None:
+    if index_start.size == 0:
         print(('Error (long_term_mean): simulation finishes before ' + str(year_start)))
         sys.exit()
-    if end_file is None:
+    if index_end.size == 0:
         print(('Error (long_term_mean): simulation ends before the end of ' + str(year_end)))
         sys.exit()
+    # Now find the files these fall within, and the indices within those files (adding one to the end index as per python convention for first index to ignore)
+    n_start, t_start = data.locate(index_start[0])
+    n_end, t_end = data.locate(index_end[0])
+    t_end += 1
+    start_file = data.file_paths[n_start]
+    end_file = data.file_paths[n_end]
+    files_to_avg = data.file_paths[n_start:n_end+1]
 
     # Now average them
     print(('Averaging from index ' + str(t_start) + ' of ' + start_file + ' to index ' + str(t_end) + ' of ' + end_file))
@@ -1295,14 +1543,14 @@ def long_term_mean (output_dir, year_start, year_end, proper_weighting=True, lea
         print('Already exists')
     else:
         if proper_weighting:
-            average_monthly_files(files_to_avg, out_file, t_start=t_start, t_end=t_end, leap_years=leap_years)
+            average_monthly_files(files_to_avg, out_file, t_start=t_start, t_end=t_end, leap_years=leap_years, num_workers=num_workers)
         else:
             simple_average_files(files_to_avg, out_file, t_start=t_start, t_end=t_end)        
     return out_file
 
 
-# Precompute both timeseries and Hovmollers for all output files in the (standalone) simulation, or the files in fnames (if set).
-def precompute_all (output_dir='./', fnames=None, timeseries_file='timeseries.nc', hovmoller_file='hovmoller.nc', timeseries_types=None, hovmoller_loc=None, obs_file=None, key='PAS', grid=None, time_average=False):
+# Precompute both timeseries and Hovmollers for all output files in the (standalone) simulation, or the files in fnames (if set), skipping any which have already been processed (see update_precomputed). Set num_workers (and optionally max_memory) to process the files in parallel, as in precompute_segments.
+def precompute_all (output_dir='./', fnames=None, timeseries_file='timeseries.nc', hovmoller_file='hovmoller.nc', timeseries_types=None, hovmoller_loc=None, obs_file=None, key='PAS', grid=None, time_average=False, num_workers=1, max_memory=None):
 
     if key == 'PAS':
         if timeseries_types is None:
@@ -1318,14 +1566,13 @@ def precompute_all (output_dir='./', fnames=None, timeseries_file='timeseries.nc
 
     if fnames is None:
         fnames = get_output_files(output_dir)
-    for f in fnames:
-        file_path = output_dir + f
-        if grid is None:
-            grid = Grid(file_path)
-        print(('Processing ' + file_path))
-        precompute_timeseries(file_path, output_dir+timeseries_file, timeseries_types=timeseries_types, grid=grid, time_average=time_average)
-        if len(hovmoller_loc) > 0:
-            precompute_hovmoller(file_path, output_dir+hovmoller_file, loc=hovmoller_loc)            
+    file_paths = [output_dir + f for f in fnames]
+    if grid is None and len(file_paths) > 0:
+        grid = Grid(file_paths[0])
+    # Process any new files (and new types), in parallel if num_workers > 1
+    update_precomputed(output_dir+timeseries_file, file_paths, timeseries_types, kind='timeseries', time_average=time_average, grid=grid, num_workers=num_workers, max_memory=max_memory)
+    if len(hovmoller_loc) > 0:
+        update_precomputed(output_dir+hovmoller_file, file_paths, [l+'_'+v for v in ['temp', 'salt'] for l in hovmoller_loc], kind='hovmoller', num_workers=num_workers, max_memory=max_memory)
     
 
 # All the steps to analyse a newly finished ERA5 run and matching PACE ensemble!
@@ -22,7 +22,7 @@ from ..plot_utils.colours import set_colours
 from ..plot_utils.labels import reduce_cbar_labels
 from ..plot_misc import ts_binning, hovmoller_plot
 from ..interpolation import interp_slice_helper, interp_slice_helper_nonreg, extract_slice_nonreg, interp_bdry, fill_into_mask, distance_weighted_nearest_neighbours
-from ..postprocess import precompute_timeseries_coupled
+from ..postprocess import precompute_timeseries_coupled, read_manifest
 from ..diagnostics import potential_density
 
 
@@ -38,10 +38,11 @@ def update_lens_timeseries (num_ens=5, base_dir='./', sim_dir=None):
     timeseries_file = 'timeseries.nc'
 
     for n in range(num_ens):
-        if not os.path.isfile(sim_dir[n]+timeseries_file):
-            # Start fresh
+        if not os.path.isfile(sim_dir[n]+timeseries_file) or read_manifest(sim_dir[n]+timeseries_file) is not None:
+            # Start fresh, or let the manifest in the timeseries file work out which segments are new
             segment_dir = None
         else:
+            # Timeseries file was created before manifests were introduced
             # Work out the first year based on where the timeseries file left off
             start_year = netcdf_time(sim_dir[n]+timeseries_file, monthly=False)[-1].year+1
             # Work on the last year based on the contents of the output directory
@@ -30,7 +30,7 @@ from ..plot_misc import hovmoller_plot, ts_animation, ts_binning
 from ..timeseries import calc_annual_averages, set_parameters
 from ..postprocess import get_output_files, check_segment_dir, segment_file_paths, set_update_file, set_update_time, set_update_var, precompute_timeseries_coupled
 from ..diagnostics import adv_heat_wrt_freezing, potential_density, thermocline
-from ..calculus import time_derivative, time_integral, vertical_average, area_average
+from ..calculus import time_derivative, time_integral, vertical_average, area_average, linear_trend, TrendAccumulator
 from ..interpolation import interp_reg_xy, interp_reg_xyz, interp_to_depth, interp_grid, interp_slice_helper, interp_nonreg_xy, discard_and_fill
 
 # Global variables
@@ -101,19 +101,20 @@ def calc_climatologies (era5_dir, pace_dir, out_dir, wind_speed=False):
                 # Read wind components and calculate magnitude
                 def read_comp_era5 (var_comp):
                     file_path = real_dir(era5_dir) + file_head_era5 + var_comp + '_' + str(year)
-                    return read_binary(file_path, [era5_grid.nx, era5_grid.ny], 'xyt')
+                    return read_binary(file_path, [era5_grid.nx, era5_grid.ny], 'xyt', mmap=True)
                 data_u = read_comp_era5(wind_comp_era5[0])
                 data_v = read_comp_era5(wind_comp_era5[1])
                 data = np.sqrt(data_u**2 + data_v**2)
             else:
                 file_path = real_dir(era5_dir) + file_head_era5 + var_name_era5 + '_' + str(year)
-                data = read_binary(file_path, [era5_grid.nx, era5_grid.ny], 'xyt')
+                # Map the file rather than reading it all at once: the averages below stream through it
+                data = read_binary(file_path, [era5_grid.nx, era5_grid.ny], 'xyt', mmap=True)
             if monthly:
                 # Monthly averages
                 data = daily_to_monthly(data, year=year, per_day=per_day)
             else:
-                # Average over each day
-                data = np.mean(np.reshape(data, (per_day, data.shape[0]//per_day, era5_grid.ny, era5_grid.nx), order='F'), axis=0)
+                # Average over each day (reshaping in C order so it's still a view of the file)
+                data = np.mean(np.reshape(data, (data.shape[0]//per_day, per_day, era5_grid.ny, era5_grid.nx)), axis=1)
                 if data.shape[0] == days_per_year+1:
                     # Remove leap day
                     data = np.concatenate((data[:leap_day,:], data[leap_day+1:,:]), axis=0)
@@ -166,13 +167,13 @@ def calc_climatologies (era5_dir, pace_dir, out_dir, wind_speed=False):
                 if var_pace[n] == 'speed':
                     def read_comp_pace (var_comp):
                         file_path = real_dir(pace_dir) + file_head_pace + ens_str + '_' + var_comp + '_' + str(year)
-                        return read_binary(file_path, [pace_grid.nx, pace_grid.ny], 'xyt')
+                        return read_binary(file_path, [pace_grid.nx, pace_grid.ny], 'xyt', mmap=True)
                     data_u = read_comp_pace(wind_comp_pace[0])
                     data_v = read_comp_pace(wind_comp_pace[1])
                     data = np.sqrt(data_u**2 + data_v**2)
                 else:
                     file_path = real_dir(pace_dir) + file_head_pace + ens_str + '_' + var_pace[n] + '_' + str(year)
-                    data = read_binary(file_path, [pace_grid.nx, pace_grid.ny], 'xyt')
+                    data = read_binary(file_path, [pace_grid.nx, pace_grid.ny], 'xyt', mmap=True)
                 data_accum += data
             data_clim = data_accum/num_years
             file_path = real_dir(out_dir) + file_head_pace + ens_str + '_' + var_pace[n] + file_tail
@@ -622,7 +623,7 @@ def read_calc_trends (var, file_path, option, percent=False, year_start=1920, ye
         data = data[:new_size]
         time, data = calc_annual_averages(time, data)
     # Calculate trends per decade
-    slope, intercept, r_value, p_value, std_err = linregress(time, data)
+    slope, intercept, r_value, p_value, std_err = linear_trend(time, data)
     sig = p_value < p0
     return slope, sig
 
@@ -1183,140 +1184,146 @@ def make_trend_file (var_name, region, sim_dir, grid_dir, out_file, dim=3, gtype
         swfrac = 0.62*np.exp(z_edges_3d[:-1,:]/0.6) + (1-0.62)*np.exp(z_edges_3d[:-1,:]/20.)
         swfrac1 = 0.62*np.exp(z_edges_3d[1:,:]/0.6) + (1-0.62)*np.exp(z_edges_3d[1:,:]/20.)
 
-    data_save = None
-    # Loop over ensemble member
-    for m in range(num_ens):
-        print(('Processing ' + sim_dir[m]))
-        # Get all the file paths (assume one for each year)
+    # Inner function to read annually-averaged data from the given file, at each point in the mask
+    def read_data (file_path):
+        long_name = None
+        units = None
+        if var_name == 'advection_3d':
+            data_x, long_name, units = read_netcdf(file_path, 'ADVx_TH', return_info=True)
+            data_y = read_netcdf(file_path, 'ADVy_TH')
+            data_z = read_netcdf(file_path, 'ADVr_TH')
+            data = np.ma.zeros(data_x.shape)
+            data[:,:-1,:-1,:-1] = data_x[:,:-1,:-1,:-1] - data_x[:,:-1,:-1,1:] + data_y[:,:-1,:-1,:-1] - data_y[:,:-1,1:,:-1] + data_z[:,1:,:-1,:-1] - data_z[:,:-1,:-1,:-1]
+            data = np.mean(data, axis=0)
+            long_name = 'net advection of heat'                
+        elif var_name == 'diffusion_kpp':
+            data1, long_name, units = read_netcdf(file_path, 'DFrI_TH', return_info=True)
+            data2 = read_netcdf(file_path, 'KPPg_TH')
+            data = np.ma.zeros(data1.shape)
+            data[:,:-1,:] = data1[:,1:,:] - data1[:,:-1,:] + data2[:,1:,:] - data2[:,:-1,:]
+            data = np.mean(data, axis=0)
+            long_name = 'net vertical implicit diffusion and KPP transport of heat'
+        elif var_name == 'adv_plus_dif':
+            # Sum of previous two
+            data_x, long_name, units = read_netcdf(file_path, 'ADVx_TH', return_info=True)
+            data_y = read_netcdf(file_path, 'ADVy_TH')
+            data_z = read_netcdf(file_path, 'ADVr_TH') + read_netcdf(file_path, 'DFrI_TH') + read_netcdf(file_path, 'KPPg_TH')
+            data = np.ma.zeros(data_x.shape)
+            data[:,:-1,:-1,:-1] = data_x[:,:-1,:-1,:-1] - data_x[:,:-1,:-1,1:] + data_y[:,:-1,:-1,:-1] - data_y[:,:-1,1:,:-1] + data_z[:,1:,:-1,:-1] - data_z[:,:-1,:-1,:-1]
+            data = np.mean(data, axis=0)
+            long_name = 'net advection, diffusion, and KPP transport of heat'
+        elif var_name == 'shortwave_pen':
+            data_sw = read_netcdf(file_path, 'oceQsw', time_average=True)
+            data = xy_to_xyz(data_sw, grid)*(swfrac-swfrac1)*dA_3d/(rhoConst*Cp_sw)
+            long_name = 'heat from shortwave penetration'
+            units = 'degC.m^3/s'
+        elif var_name == 'hb_total':
+            # Sum of previous three
+            data_x, long_name, units = read_netcdf(file_path, 'ADVx_TH', return_info=True)
+            data_y = read_netcdf(file_path, 'ADVy_TH')
+            data_z = read_netcdf(file_path, 'ADVr_TH') + read_netcdf(file_path, 'DFrI_TH') + read_netcdf(file_path, 'KPPg_TH')
+            data = np.ma.zeros(data_x.shape)
+            data[:,:-1,:-1,:-1] = data_x[:,:-1,:-1,:-1] - data_x[:,:-1,:-1,1:] + data_y[:,:-1,:-1,:-1] - data_y[:,:-1,1:,:-1] + data_z[:,1:,:-1,:-1] - data_z[:,:-1,:-1,:-1]
+            data = np.mean(data, axis=0)
+            data_sw = read_netcdf(file_path, 'oceQsw', time_average=True)
+            data += xy_to_xyz(data_sw, grid)*(swfrac-swfrac1)*dA_3d/(rhoConst*Cp_sw)
+            long_name = 'total heat budget in interior'                            
+        elif var_name == 'ismr':
+            data = convert_ismr(read_netcdf(file_path, 'SHIfwFlx', time_average=True))
+            long_name = 'ice shelf melt rate'
+            units = 'm/y'
+        elif var_name == 'sst':
+            data = read_netcdf(file_path, 'THETA', time_average=True)[0,:]
+            long_name = 'sea surface temperature'
+            units = 'degC'
+        elif var_name == 'sss':
+            data = read_netcdf(file_path, 'SALT', time_average=True)[0,:]
+            long_name = 'sea surface salinity'
+            units = 'psu'
+        elif var_name == 'wind_speed':
+            # Calculate speed from monthly values, then take the time-mean
+            u = read_netcdf(file_path, 'EXFuwind')
+            v = read_netcdf(file_path, 'EXFvwind')
+            data = np.mean(np.sqrt(u**2 + v**2), axis=0)
+            long_name = 'wind speed'
+            units = 'm/s'
+        elif var_name == 'speed':
+            u = read_netcdf(file_path, 'UVEL')
+            v = read_netcdf(file_path, 'VVEL')
+            data = np.mean(np.sqrt(u**2 + v**2), axis=0)
+            long_name = 'speed of ocean velocity'
+            units = 'm/s'
+        elif var_name == 'thermocline':
+            temp = read_netcdf(file_path, 'THETA')
+            num_time = temp.shape[0]
+            data_time = np.ma.empty([num_time, grid.ny, grid.nx])
+            for tt in range(num_time):
+                data_time[tt,:] = thermocline(temp[tt,:], grid)
+            data = np.mean(data_time, axis=0)
+            long_name = 'thermocline depth'
+            units = 'm'
+        elif var_name.startswith('temp_btw') or var_name.startswith('temp_below'):
+            temp, long_name, units = read_netcdf(file_path, 'THETA', time_average=True, return_info=True)
+            if var_name.startswith('temp_btw'):
+                z_vals = var_name[len('temp_btw_'):-1]
+                z_shallow = -1*int(z_vals[:z_vals.index('_')])
+                z_deep = -1*int(z_vals[z_vals.index('_')+1:])
+            elif var_name.startswith('temp_below'):
+                z_shallow = -1*int(var_name[len('temp_below_'):-1])
+                z_deep = None
+            mask_3d = mask_2d_to_3d(mask, grid, zmin=z_deep, zmax=z_shallow)
+            temp = apply_mask(temp, np.invert(mask_3d))
+            data = vertical_average(temp, grid)                
+        else:
+            data, long_name, units = read_netcdf(file_path, var_name, time_average=True, return_info=True)
+        if len(data.shape) != dim:
+            print('Error (make_trend_file): wrong dimension for this variable.')
+            sys.exit()
+        if var_name == 'ADVx_TH':
+            # Need to convert to heat advection relative to freezing point
+            u = read_netcdf(file_path, 'UVEL', time_average=True)
+            [data, tmp] = adv_heat_wrt_freezing([data, None], [u, None], grid)
+        elif var_name == 'ADVy_TH':
+            v = read_netcdf(file_path, 'VVEL', time_average=True)
+            [tmp, data] = adv_heat_wrt_freezing([None, data], [None, v], grid)
+        return np.ma.getdata(data[mask]), long_name, units
+
+    # Inner function to get the file paths for the given ensemble member (assume one for each year)
+    def member_file_paths (m):
         file_paths = segment_file_paths(sim_dir[m]+'/output/')
         t_start = file_paths.index(sim_dir[m]+'/output/'+str(start_year)+'01/MITgcm/output.nc')
-        file_paths = file_paths[t_start:]
-        num_years = len(file_paths)
-        if data_save is None:
-            data_save = np.empty([num_ens, num_years, num_pts])
-        # Read annually-averaged data at each point in the mask
-        for t in range(num_years):
-            print(('...Reading ' + file_paths[t]))
-            if var_name == 'advection_3d':
-                data_x, long_name, units = read_netcdf(file_paths[t], 'ADVx_TH', return_info=True)
-                data_y = read_netcdf(file_paths[t], 'ADVy_TH')
-                data_z = read_netcdf(file_paths[t], 'ADVr_TH')
-                data = np.ma.zeros(data_x.shape)
-                data[:,:-1,:-1,:-1] = data_x[:,:-1,:-1,:-1] - data_x[:,:-1,:-1,1:] + data_y[:,:-1,:-1,:-1] - data_y[:,:-1,1:,:-1] + data_z[:,1:,:-1,:-1] - data_z[:,:-1,:-1,:-1]
-                data = np.mean(data, axis=0)
-                long_name = 'net advection of heat'                
-            elif var_name == 'diffusion_kpp':
-                data1, long_name, units = read_netcdf(file_paths[t], 'DFrI_TH', return_info=True)
-                data2 = read_netcdf(file_paths[t], 'KPPg_TH')
-                data = np.ma.zeros(data1.shape)
-                data[:,:-1,:] = data1[:,1:,:] - data1[:,:-1,:] + data2[:,1:,:] - data2[:,:-1,:]
-                data = np.mean(data, axis=0)
-                long_name = 'net vertical implicit diffusion and KPP transport of heat'
-            elif var_name == 'adv_plus_dif':
-                # Sum of previous two
-                data_x, long_name, units = read_netcdf(file_paths[t], 'ADVx_TH', return_info=True)
-                data_y = read_netcdf(file_paths[t], 'ADVy_TH')
-                data_z = read_netcdf(file_paths[t], 'ADVr_TH') + read_netcdf(file_paths[t], 'DFrI_TH') + read_netcdf(file_paths[t], 'KPPg_TH')
-                data = np.ma.zeros(data_x.shape)
-                data[:,:-1,:-1,:-1] = data_x[:,:-1,:-1,:-1] - data_x[:,:-1,:-1,1:] + data_y[:,:-1,:-1,:-1] - data_y[:,:-1,1:,:-1] + data_z[:,1:,:-1,:-1] - data_z[:,:-1,:-1,:-1]
-                data = np.mean(data, axis=0)
-                long_name = 'net advection, diffusion, and KPP transport of heat'
-            elif var_name == 'shortwave_pen':
-                data_sw = read_netcdf(file_paths[t], 'oceQsw', time_average=True)
-                data = xy_to_xyz(data_sw, grid)*(swfrac-swfrac1)*dA_3d/(rhoConst*Cp_sw)
-                long_name = 'heat from shortwave penetration'
-                units = 'degC.m^3/s'
-            elif var_name == 'hb_total':
-                # Sum of previous three
-                data_x, long_name, units = read_netcdf(file_paths[t], 'ADVx_TH', return_info=True)
-                data_y = read_netcdf(file_paths[t], 'ADVy_TH')
-                data_z = read_netcdf(file_paths[t], 'ADVr_TH') + read_netcdf(file_paths[t], 'DFrI_TH') + read_netcdf(file_paths[t], 'KPPg_TH')
-                data = np.ma.zeros(data_x.shape)
-                data[:,:-1,:-1,:-1] = data_x[:,:-1,:-1,:-1] - data_x[:,:-1,:-1,1:] + data_y[:,:-1,:-1,:-1] - data_y[:,:-1,1:,:-1] + data_z[:,1:,:-1,:-1] - data_z[:,:-1,:-1,:-1]
-                data = np.mean(data, axis=0)
-                data_sw = read_netcdf(file_paths[t], 'oceQsw', time_average=True)
-                data += xy_to_xyz(data_sw, grid)*(swfrac-swfrac1)*dA_3d/(rhoConst*Cp_sw)
-                long_name = 'total heat budget in interior'                            
-            elif var_name == 'ismr':
-                data = convert_ismr(read_netcdf(file_paths[t], 'SHIfwFlx', time_average=True))
-                long_name = 'ice shelf melt rate'
-                units = 'm/y'
-            elif var_name == 'sst':
-                data = read_netcdf(file_paths[t], 'THETA', time_average=True)[0,:]
-                long_name = 'sea surface temperature'
-                units = 'degC'
-            elif var_name == 'sss':
-                data = read_netcdf(file_paths[t], 'SALT', time_average=True)[0,:]
-                long_name = 'sea surface salinity'
-                units = 'psu'
-            elif var_name == 'wind_speed':
-                # Calculate speed from monthly values, then take the time-mean
-                u = read_netcdf(file_paths[t], 'EXFuwind')
-                v = read_netcdf(file_paths[t], 'EXFvwind')
-                data = np.mean(np.sqrt(u**2 + v**2), axis=0)
-                long_name = 'wind speed'
-                units = 'm/s'
-            elif var_name == 'speed':
-                u = read_netcdf(file_paths[t], 'UVEL')
-                v = read_netcdf(file_paths[t], 'VVEL')
-                data = np.mean(np.sqrt(u**2 + v**2), axis=0)
-                long_name = 'speed of ocean velocity'
-                units = 'm/s'
-            elif var_name == 'thermocline':
-                temp = read_netcdf(file_paths[t], 'THETA')
-                num_time = temp.shape[0]
-                data_time = np.ma.empty([num_time, grid.ny, grid.nx])
-                for t in range(num_time):
-                    data_time[t,:] = thermocline(temp[t,:], grid)
-                data = np.mean(data_time, axis=0)
-                long_name = 'thermocline depth'
-                units = 'm'
-            elif var_name.startswith('temp_btw') or var_name.startswith('temp_below'):
-                temp, long_name, units = read_netcdf(file_paths[t], 'THETA', time_average=True, return_info=True)
-                if var_name.startswith('temp_btw'):
-                    z_vals = var_name[len('temp_btw_'):-1]
-                    z_shallow = -1*int(z_vals[:z_vals.index('_')])
-                    z_deep = -1*int(z_vals[z_vals.index('_')+1:])
-                elif var_name.startswith('temp_below'):
-                    z_shallow = -1*int(var_name[len('temp_below_'):-1])
-                    z_deep = None
-                mask_3d = mask_2d_to_3d(mask, grid, zmin=z_deep, zmax=z_shallow)
-                temp = apply_mask(temp, np.invert(mask_3d))
-                data = vertical_average(temp, grid)                
-            else:
-                data, long_name, units = read_netcdf(file_paths[t], var_name, time_average=True, return_info=True)
-            if len(data.shape) != dim:
-                print('Error (make_trend_file): wrong dimension for this variable.')
-                sys.exit()
-            if var_name == 'ADVx_TH':
-                # Need to convert to heat advection relative to freezing point
-                u = read_netcdf(file_paths[t], 'UVEL', time_average=True)
-                [data, tmp] = adv_heat_wrt_freezing([data, None], [u, None], grid)
-            elif var_name == 'ADVy_TH':
-                v = read_netcdf(file_paths[t], 'VVEL', time_average=True)
-                [tmp, data] = adv_heat_wrt_freezing([None, data], [None, v], grid)
-            data_save[m,t,:] = data[mask]
+        return file_paths[t_start:]
+
     if time_integral_anomaly:
-        # Calculate the anomaly from the base period ensemble mean
+        # Need a first pass to calculate the base period ensemble mean
+        print('Calculating base period ensemble mean')
         num_base_years = end_base_year - start_year + 1
-        data_mean = np.mean(data_save[:,:num_base_years,:], axis=(0,1))
-        data_save -= data_mean[None,None,:]
-        # Now time-integrate
-        dt = 365*sec_per_day
-        # Loop over ensemble members, otherwise it's too much memory
+        data_mean = np.zeros(num_pts)
         for m in range(num_ens):
-            data_save[m,:] = np.cumsum(data_save[m,:]*dt, axis=0)
+            for file_path in member_file_paths(m)[:num_base_years]:
+                print(('...Reading ' + file_path))
+                data_mean += read_data(file_path)[0]
+        data_mean /= num_ens*num_base_years
+        dt = 365*sec_per_day
 
-    # Now loop over ensemble members again and calculate the trend at each point
-    print('Calculating trends')
+    # Loop over ensemble members, reading one year at a time and calculating the trend at all points as we go. This way only running sums need to be kept in memory, not the whole timeseries at every point.
     for m in range(num_ens):
-        print(('...member '+str(m+1)))
-        trends_tmp = np.empty(num_pts)
-        for p in range(num_pts):
-            slope, intercept, r_value, p_value, std_err = linregress(np.arange(num_years), data_save[m,:,p])
-            trends_tmp[p] = slope
+        print(('Processing ' + sim_dir[m]))
+        file_paths = member_file_paths(m)
+        num_years = len(file_paths)
+        trend_acc = TrendAccumulator()
+        if time_integral_anomaly:
+            data_int = np.zeros(num_pts)
+        for t in range(num_years):
+            print(('...Reading ' + file_paths[t]))
+            data, long_name, units = read_data(file_paths[t])
+            if time_integral_anomaly:
+                # Anomaly from the base period ensemble mean, time-integrated
+                data_int += (data - data_mean)*dt
+                data = data_int
+            trend_acc.add(t, data)
         # Save to master array
-        trends[m,mask] = trends_tmp
+        trends[m,mask] = trend_acc.trend()[0]
     # Mask master array outside the given region (where it's still zero)
     trends = np.ma.masked_where(trends==0, trends)
 
@@ -1325,7 +1332,8 @@ def make_trend_file (var_name, region, sim_dir, grid_dir, out_file, dim=3, gtype
         file_dim = 'xyt'
     elif dim == 3:
         file_dim = 'xyzt'
-    ncfile = NCfile(out_file, grid, file_dim)
+    # Compress, and store each ensemble member's map in its own chunks
+    ncfile = NCfile(out_file, grid, file_dim, zlib=True, chunk_option='slab')
     ncfile.add_time(np.arange(num_ens)+1, units='ensemble member')
     ncfile.add_variable(var_name+'_trend', trends, file_dim, gtype=gtype, long_name='trend in '+long_name, units=units+'/y')
     ncfile.close()
@@ -1599,24 +1607,26 @@ def precompute_ts_ensemble_mean (sim_dir, grid_dir, out_file, start_year=1920, e
     units = ['degC', 'psu']
     num_var = len(var_names)
     num_ens = len(sim_dir)
-    num_years = end_year-start_year+1
     grid = Grid(grid_dir)
 
-    final_data = np.ma.zeros([num_var, num_years, grid.nz, grid.ny, grid.nx])
-    for d in sim_dir:
-        for year in range(start_year, end_year+1):
-            file_path = real_dir(d) + 'output/' + str(year)+ '01/MITgcm/output.nc'
-            print(('Reading ' + file_path))
-            for n in range(num_var):
-                final_data[n,year-start_year,:] += read_netcdf(file_path, var_names[n], time_average=True)
-    # Divide by number of simulations to get ensemble mean
-    final_data /= num_ens
-
     print(('Writing ' + out_file))
-    ncfile = NCfile(out_file, grid, 'xyzt')
+    ncfile = NCfile(out_file, grid, 'xyzt', zlib=True, chunk_option='slab')
     ncfile.add_time(np.arange(start_year, end_year+1), units='year')
     for n in range(num_var):
-        ncfile.add_variable(var_names[n], final_data[n,:], 'xyzt', units=units)
+        ncfile.add_variable(var_names[n], None, 'xyzt', units=units[n])
+
+    # Calculate the ensemble mean one year at a time and append it to the file, so only one year is in memory
+    for year in range(start_year, end_year+1):
+        data = np.ma.zeros([num_var, grid.nz, grid.ny, grid.nx])
+        for d in sim_dir:
+            file_path = real_dir(d) + 'output/' + str(year)+ '01/MITgcm/output.nc'
+            print(('Reading ' + file_path))
+            for n in range(num_var):
+                data[n,:] += read_netcdf(file_path, var_names[n], time_average=True)
+        # Divide by number of simulations to get ensemble mean
+        data /= num_ens
+        for n in range(num_var):
+            ncfile.append_time_slab(var_names[n], data[n,:])
     ncfile.close()
 
 
@@ -2184,7 +2194,7 @@ def calc_all_trends (base_dir='./', timeseries_file='timeseries_final.nc'):
 
     time = None
     for v in range(num_var):
-        trends = []
+        data_ens = []
         for n in range(num_ens):
             # Read data
             file_path = sim_dir[n] + timeseries_file
@@ -2201,9 +2211,9 @@ def calc_all_trends (base_dir='./', timeseries_file='timeseries_final.nc'):
                 time_decades = time_sec/(365*sec_per_day*10)
             else:
                 data = moving_average(data_tmp, smooth)
-            # Calculate trend
-            slope, intercept, r_value, p_value, std_err = linregress(time_decades, data)
-            trends.append(slope)
+            data_ens.append(data)
+        # Calculate trend for all ensemble members at once
+        trends = linear_trend(time_decades, np.transpose(np.array(data_ens)))[0]
         # Calculate significance
         p_val = ttest_1samp(trends, 0)[1]
         sig = (1-p_val)*100
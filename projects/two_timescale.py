@@ -29,7 +29,7 @@ from ..postprocess import segment_file_paths, precompute_timeseries_coupled
 from ..constants import deg_string, vaf_to_gmslr, temp_C2K, bedmap_dim, bedmap_bdry, bedmap_res, deg2rad, region_bounds
 from ..plot_latlon import latlon_plot, read_plot_latlon_comparison, latlon_comparison_plot
 from ..plot_1d import read_plot_timeseries_ensemble, timeseries_multi_plot
-from ..plot_misc import read_plot_hovmoller_ts, hovmoller_ts_plot
+from ..plot_misc import read_plot_hovmoller_ts, hovmoller_ts_plot, set_ts_bins, ts_bin_volume
 from ..plot_slices import get_loc, slice_plot
 from ..timeseries import calc_annual_averages
 from ..plot_ua import read_ua_difference, check_read_gl, read_ua_bdry, ua_plot
@@ -759,13 +759,8 @@ def precompute_ts_animation_fields (expt, output_dir='./', out_file='ts_animatio
     num_bins = 1000
     
     # Set up bins
-    def set_bins (bounds):
-        eps = (bounds[1]-bounds[0])*1e-3
-        edges = np.linspace(bounds[0]-eps, bounds[1]+eps, num=num_bins+1)
-        centres = 0.5*(edges[:-1] + edges[1:])
-        return edges, centres
-    temp_edges, temp_centres = set_bins(temp_bounds)
-    salt_edges, salt_centres = set_bins(salt_bounds)
+    temp_edges, temp_centres = set_ts_bins(temp_bounds, num_bins=num_bins)
+    salt_edges, salt_centres = set_ts_bins(salt_bounds, num_bins=num_bins)
     volume = np.zeros([num_years, num_bins, num_bins])
 
     # Loop over years
@@ -777,11 +772,8 @@ def precompute_ts_animation_fields (expt, output_dir='./', out_file='ts_animatio
         # Read data
         temp = read_netcdf(file_paths[t], 'THETA', time_average=True)
         salt = read_netcdf(file_paths[t], 'SALT', time_average=True)
-        # Loop over valid cells and categorise them into bins
-        for temp_val, salt_val, grid_val in zip(temp[loc_index], salt[loc_index], grid.dV[loc_index]):
-            temp_index = np.nonzero(temp_edges > temp_val)[0][0]-1
-            salt_index = np.nonzero(salt_edges > salt_val)[0][0]-1
-            volume[t, temp_index, salt_index] += grid_val
+        # Categorise the valid cells into bins, adding to this year's volume
+        ts_bin_volume(temp[loc_index], salt[loc_index], grid.dV[loc_index], temp_edges, salt_edges, volume=volume[t,:])
     # Mask bins with zero volume
     volume = np.ma.masked_where(volume==0, volume)
 
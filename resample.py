@@ -0,0 +1,92 @@
+#######################################################
+# Calendar-aware resampling of timeseries
+# (daily to monthly, monthly to annual)
+#######################################################
+
+import numpy as np
+
+# Days per month in non-leap years
+month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+# Return the number of days in each month for the given arrays of years and months (indexed 1-12), which will be broadcast against each other.
+# calendar can be 'standard' (or 'gregorian', 'proleptic_gregorian'), 'noleap' (or '365_day'), or '360_day' (or '360-day').
+def month_lengths (years, months, calendar='standard'):
+
+    years, months = np.broadcast_arrays(np.asarray(years), np.asarray(months))
+    if calendar in ['360_day', '360-day']:
+        return np.full(months.shape, 30)
+    days = month_days[months-1]
+    if calendar not in ['noleap', '365_day']:
+        leap = (years%4 == 0) & ((years%100 != 0) | (years%400 == 0)) & (months == 2)
+        days = days + leap
+    return days
+
+
+# Given an array of Date objects, return the number of days in each month, taking the calendar into account.
+def time_month_lengths (time, calendar='standard'):
+
+    years = np.array([t.year for t in time])
+    months = np.array([t.month for t in time])
+    return month_lengths(years, months, calendar=calendar)
+
+
+# Return the starting index of each group of consecutive equal values in the given 1D array of keys (eg years or months).
+def group_starts (keys):
+
+    keys = np.asarray(keys)
+    if keys.size == 0:
+        return np.zeros(0, dtype=int)
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+
+# Return the starting index of each month within one year of data with per_day records per day.
+def month_starts (year=1979, per_day=1, calendar='standard'):
+
+    days = month_lengths(year, np.arange(1, 12+1), calendar=calendar)*per_day
+    return np.concatenate(([0], np.cumsum(days)[:-1]))
+
+
+# Calculate the (weighted) average of each segment of data along the first (time) dimension, where each segment begins at the given start index and continues until the next one (or the end of the array).
+# weights (optional) is a 1D array of weights for each time index, eg days per month.
+# Masked arrays are supported: masked values get zero weight, and segments with no valid data are masked in the result. Otherwise the result is a regular array.
+def segment_average (data, starts, weights=None):
+
+    starts = np.asarray(starts, dtype=int)
+    num_time = data.shape[0]
+    unweighted = weights is None
+    if unweighted:
+        weights = np.ones(num_time)
+    weights = np.reshape(np.asarray(weights, dtype=float), [num_time] + [1]*(data.ndim-1))
+    if isinstance(data, np.ma.MaskedArray):
+        valid = ~np.ma.getmaskarray(data)
+        data_sum = np.add.reduceat(np.ma.getdata(data)*(weights*valid), starts, axis=0)
+        weight_sum = np.add.reduceat(np.broadcast_to(weights, data.shape)*valid, starts, axis=0)
+        empty = weight_sum == 0
+        return np.ma.masked_where(empty, data_sum/np.where(empty, 1, weight_sum))
+    elif unweighted:
+        # Sum directly in double precision, without making a weighted copy of the data (which might be memory-mapped, see read_binary)
+        data_sum = np.add.reduceat(data, starts, axis=0, dtype=np.float64)
+        weight_sum = np.add.reduceat(weights, starts, axis=0)
+        return data_sum/weight_sum
+    else:
+        data_sum = np.add.reduceat(data*weights, starts, axis=0)
+        weight_sum = np.add.reduceat(weights, starts, axis=0)
+        return data_sum/weight_sum
+
+
+# Given monthly data where the first dimension is time, starting in January, calculate the annual averages weighted by the number of days in each month. years is a 1D array with the year of each annual average; data must contain at least 12*len(years) time indices, and anything after that is ignored.
+def monthly_to_annual_average (data, years, calendar='standard'):
+
+    years = np.asarray(years)
+    num_time = 12*years.size
+    weights = month_lengths(np.repeat(years, 12), np.tile(np.arange(1, 12+1), years.size), calendar=calendar)
+    return segment_average(data[:num_time], np.arange(0, num_time, 12), weights=weights)
+
+
+# Given one year of data where the first dimension is time, with per_day records per day, calculate the monthly averages.
+# Any records beyond the end of the year (eg a leap day when the calendar has no leap years) are ignored.
+def daily_to_monthly_average (data, year=1979, per_day=1, calendar='standard'):
+
+    num_time = np.sum(month_lengths(year, np.arange(1, 12+1), calendar=calendar))*per_day
+    return segment_average(data[:num_time], month_starts(year=year, per_day=per_day, calendar=calendar))
@@ -7,14 +7,24 @@ import sys
 import datetime
 
 from .grid import choose_grid, Grid
-from .file_io import read_netcdf, netcdf_time
-from .utils import convert_ismr, var_min_max, mask_land_ice, days_per_month, apply_mask, mask_3d, xy_to_xyz, select_top, select_bottom, add_time_dim, z_to_xyz, mask_2d_to_3d, mask_land, depth_of_isoline
+from .file_io import get_multi_file_dataset, iter_netcdf, iter_netcdf_list
+from .utils import convert_ismr, var_min_max, mask_land_ice, apply_mask, mask_3d, xy_to_xyz, select_top, select_bottom, add_time_dim, z_to_xyz, mask_2d_to_3d, mask_land, depth_of_isoline
 from .diagnostics import total_melt, wed_gyre_trans, transport_transect, density, in_situ_temp, tfreeze, adv_heat_wrt_freezing, thermocline
-from .calculus import over_area, area_integral, over_volume, vertical_average_column, area_average, volume_average, volume_integral
+from .calculus import over_area, area_integral, over_volume, over_index, vertical_average_column, area_average, volume_average, volume_integral
 from .interpolation import interp_bilinear, neighbours, interp_to_depth, interp_grid
+from .resample import month_lengths, group_starts, segment_average
 from .constants import deg_string, region_names, temp_C2K, sec_per_year, sec_per_day, rhoConst, Cp_sw
 
 
+# Helper function to concatenate the timeseries calculated from each slab of time indices (see iter_netcdf), keeping the mask only if there is one.
+def concatenate_slabs (timeseries):
+
+    if any([isinstance(data, np.ma.MaskedArray) for data in timeseries]):
+        return np.ma.concatenate(timeseries)
+    else:
+        return np.concatenate(timeseries)
+
+
 # Calculate total mass loss or area-averaged melt rate from ice shelves in the given NetCDF file. You can specify specific ice shelves (as specified in region_names in constants.py). The default behaviour is to calculate the melt at each time index in the file, but you can also select a subset of time indices, and/or time-average - see optional keyword arguments. You can also split into positive (melting) and negative (freezing) components.
 
 # Arguments:
@@ -43,30 +53,23 @@ def timeseries_ismr (file_path, grid, shelf='fris', result='massloss', time_inde
         mask[grid.draft <= z_deep] = False
         mask[grid.draft > z_shallow] = False
 
-    # Read ice shelf melt rate and convert to m/y
-    ismr = convert_ismr(read_netcdf(file_path, 'SHIfwFlx', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average))
-    if len(ismr.shape)==2:
-        # Just one timestep; add a dummy time dimension
-        ismr = np.expand_dims(ismr,0)
-
-    if mass_balance:
-        # Split into melting and freezing
-        ismr_positive = np.maximum(ismr, 0)
-        ismr_negative = np.minimum(ismr, 0)
-        
-    # Loop over timesteps
-    num_time = ismr.shape[0]
+    # Read ice shelf melt rate one slab of time indices at a time, and loop over timesteps
+    melt = []
+    freeze = []
+    for ismr in iter_netcdf(file_path, 'SHIfwFlx', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        # Convert to m/y
+        ismr = convert_ismr(ismr)
+        for t in range(ismr.shape[0]):
+            if mass_balance:
+                # Split into melting and freezing
+                melt.append(total_melt(np.maximum(ismr[t,:], 0), mask, grid, result=result))
+                freeze.append(total_melt(np.minimum(ismr[t,:], 0), mask, grid, result=result))
+            else:
+                melt.append(total_melt(ismr[t,:], mask, grid, result=result))
+    melt = np.array(melt, dtype=float)
     if mass_balance:
-        melt = np.zeros(num_time)
-        freeze = np.zeros(num_time)
-        for t in range(num_time):
-            melt[t] = total_melt(ismr_positive[t,:], mask, grid, result=result)
-            freeze[t] = total_melt(ismr_negative[t,:], mask, grid, result=result)
-        return melt, freeze
+        return melt, np.array(freeze, dtype=float)
     else:
-        melt = np.zeros(num_time)
-        for t in range(num_time):
-            melt[t] = total_melt(ismr[t,:], mask, grid, result=result)
         # Mask out any NaNs (can happen when no cells fall within the given depth range during a coupled run)
         melt = np.ma.masked_where(np.isnan(melt), melt)
         return melt
@@ -75,86 +78,99 @@ def timeseries_ismr (file_path, grid, shelf='fris', result='massloss', time_inde
 # Read the given lat x lon variable from the given NetCDF file, and calculate timeseries of its maximum value in the given region.
 def timeseries_max (file_path, var_name, grid, gtype='t', time_index=None, t_start=None, t_end=None, time_average=False, xmin=None, xmax=None, ymin=None, ymax=None, mask=None):
 
-    data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if var_name == 'PsiVEL':
-        # Special case to get absolute value of vertically integrated streamfunction
-        data = np.abs(np.sum(data, axis=-3))
-    if len(data.shape)==2:
-        # Just one timestep; add a dummy time dimension
-        data = np.expand_dims(data,0)
-
-    num_time = data.shape[0]
-    max_data = np.zeros(num_time)
-    for t in range(num_time):
-        # Mask
-        if mask is None:
-            data_tmp = mask_land(data[t,:], grid, gtype=gtype)
-        else:
-            data_tmp = apply_mask(data[t,:], np.invert(mask))
-        max_data[t] = var_min_max(data_tmp, grid, gtype=gtype, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)[1]
-    return max_data
+    max_data = []
+    for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        if var_name == 'PsiVEL':
+            # Special case to get absolute value of vertically integrated streamfunction
+            data = np.abs(np.sum(data, axis=-3))
+        for t in range(data.shape[0]):
+            # Mask
+            if mask is None:
+                data_tmp = mask_land(data[t,:], grid, gtype=gtype)
+            else:
+                data_tmp = apply_mask(data[t,:], np.invert(mask))
+            max_data.append(var_min_max(data_tmp, grid, gtype=gtype, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)[1])
+    return np.array(max_data, dtype=float)
 
 
 # Helper function for timeseries_avg_sfc and timeseries_int_sfc.
 def timeseries_area_sfc (option, file_path, var_name, grid, gtype='t', time_index=None, t_start=None, t_end=None, time_average=False, mask=None, operator='add'):
     
-    # Read the data
     if isinstance(var_name, str):
         # Just one variable
         # Make it a list
         var_name = [var_name]
-    # Now we have multiple variables to add or subtract together.
-    data = None
-    for var in var_name:
+    if operator not in ['add', 'subtract']:
+        print(('Error (timeseries_area_sfc): invalid operator ' + operator))
+        sys.exit()
+
+    # Inner function to get the list of variables which need to be read from the file for the given variable
+    def read_vars (var):
         if var == 'EXFwind':
             # Special case to get wind speed
-            u = read_netcdf(file_path, 'EXFuwind', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-            v = read_netcdf(file_path, 'EXFvwind', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-            data_tmp = np.sqrt(u**2 + v**2)
+            return ['EXFuwind', 'EXFvwind']
         elif var == 'TminusTf':
             # Special case to get thermal driving
-            temp_3d = read_netcdf(file_path, 'THETA', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-            salt_3d = read_netcdf(file_path, 'SALT', time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-            time_dependent = len(temp_3d.shape)==4
-            temp = select_top(temp_3d, masked=False, grid=grid, time_dependent=time_dependent)
-            salt = select_top(salt_3d, masked=False, grid=grid, time_dependent=time_dependent)
-            z = select_top(z_to_xyz(grid.z, grid), masked=False, grid=grid)
-            if time_dependent:
-                z = add_time_dim(z, temp.shape[0])
-            data_tmp = in_situ_temp(temp, salt, z) - tfreeze(salt, z)
+            return ['THETA', 'SALT']
         else:
-            data_tmp = read_netcdf(file_path, var, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        if var in ['THETA', 'SALT', 'WSLTMASS']:
-            # 3D variable; have to take surface layer
-            data_tmp = select_top(data_tmp, masked=False, grid=grid, time_dependent=len(data_tmp.shape)==4)
-        if var == 'PsiVEL':
-            # Special case to get absolute value of vertically integrated streamfunction
-            data_tmp = np.abs(np.sum(data_tmp, axis=-3))        
-        if data is None:
-            data = data_tmp
+            return [var]
+    var_list = []
+    for var in var_name:
+        var_list += read_vars(var)
+
+    if gtype == 't':
+        # Find the indices and areas of the points to consider, so each slab can be area-averaged or integrated all at once
+        if mask is None:
+            # Mask out land and ice shelves
+            index, weights = grid.get_mask_index(np.invert(grid.get_land_mask() + grid.get_ice_mask()))
         else:
-            if operator == 'add':
+            index, weights = grid.get_mask_index(mask)
+
+    # Read the data one slab of time indices at a time
+    timeseries = []
+    for data_read in iter_netcdf_list(file_path, var_list, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        # Now we have multiple variables to add or subtract together.
+        data = None
+        for var in var_name:
+            num_read = len(read_vars(var))
+            data_var = data_read[:num_read]
+            data_read = data_read[num_read:]
+            if var == 'EXFwind':
+                data_tmp = np.sqrt(data_var[0]**2 + data_var[1]**2)
+            elif var == 'TminusTf':
+                temp = select_top(data_var[0], masked=False, grid=grid, time_dependent=True)
+                salt = select_top(data_var[1], masked=False, grid=grid, time_dependent=True)
+                z = add_time_dim(select_top(z_to_xyz(grid.z, grid), masked=False, grid=grid), temp.shape[0])
+                data_tmp = in_situ_temp(temp, salt, z) - tfreeze(salt, z)
+            else:
+                data_tmp = data_var[0]
+            if var in ['THETA', 'SALT', 'WSLTMASS']:
+                # 3D variable; have to take surface layer
+                data_tmp = select_top(data_tmp, masked=False, grid=grid, time_dependent=True)
+            if var == 'PsiVEL':
+                # Special case to get absolute value of vertically integrated streamfunction
+                data_tmp = np.abs(np.sum(data_tmp, axis=-3))
+            if data is None:
+                data = data_tmp
+            elif operator == 'add':
                 data += data_tmp
             elif operator == 'subtract':
                 data -= data_tmp
-            else:
-                print(('Error (timeseries_area_sfc): invalid operator ' + operator))
-                sys.exit()
-    if len(data.shape)==2:
-        # Just one timestep; add a dummy time dimension
-        data = np.expand_dims(data,0)
-    
-    # Process one time index at a time to save memory
-    timeseries = []
-    for t in range(data.shape[0]):
-        # Mask
-        if mask is None:
-            data_tmp = mask_land_ice(data[t,:], grid, gtype=gtype)
+        if gtype == 't':
+            timeseries.append(over_index(option, data, index, weights))
         else:
-            data_tmp = apply_mask(data[t,:], np.invert(mask))
-        # Area-average or integrate
-        timeseries.append(over_area(option, data_tmp, grid, gtype=gtype))
-    return np.array(timeseries)
+            # Process one time index at a time
+            timeseries_tmp = []
+            for t in range(data.shape[0]):
+                # Mask
+                if mask is None:
+                    data_tmp = mask_land_ice(data[t,:], grid, gtype=gtype)
+                else:
+                    data_tmp = apply_mask(data[t,:], np.invert(mask))
+                # Area-average or integrate
+                timeseries_tmp.append(over_area(option, data_tmp, grid, gtype=gtype))
+            timeseries.append(np.array(timeseries_tmp))
+    return concatenate_slabs(timeseries)
 
 
 # Read the given lat x lon variable from the given NetCDF file, and calculate timeseries of its area-averaged value over the sea surface.
@@ -170,98 +186,117 @@ def timeseries_int_sfc (file_path, var_name, grid, gtype='t', time_index=None, t
 # Integrate the area of the sea surface where the given variable exceeds the given threshold.
 def timeseries_area_threshold (file_path, var_name, val0, grid, gtype='t', time_index=None, t_start=None, t_end=None, time_average=False):
 
-    # Read the data
-    data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(data.shape)==2:
-        # Just one timestep; add a dummy time dimension
-        data = np.expand_dims(data,0)
-    # Convert to array of 1s and 0s based on threshold
-    data = (data >= val0).astype(float)
-    # Now build the timeseries
     timeseries = []
-    for t in range(data.shape[0]):
-        timeseries.append(area_integral(data[t,:], grid, gtype=gtype))
+    for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        # Convert to array of 1s and 0s based on threshold
+        data = (data >= val0).astype(float)
+        # Now build the timeseries
+        for t in range(data.shape[0]):
+            timeseries.append(area_integral(data[t,:], grid, gtype=gtype))
     return np.array(timeseries)
 
 
 # Helper function for timeseries_avg_3d, timeseries_int_3d, timeseries_avg_bottom, timeseries_avg_z0, timeseries_avg_btw_z0, timeseries_int_btw_z0.
 def timeseries_vol_3d (option, file_path, var_name, grid, gtype='t', time_index=None, t_start=None, t_end=None, time_average=False, mask=None, rho=None, z0=None):
         
-    if var_name == 'RHO':
-        if rho is None:
-            print('Error (timeseries_avg_3d): must precompute density')
-            sys.exit()
-        data = rho
-    elif var_name == 'TMINUSTF':
-        # For now, use surface freezing point
-        temp = read_netcdf(file_path, 'THETA', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        salt = read_netcdf(file_path, 'SALT', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        data = temp - tfreeze(salt, 0)
-    elif var_name == 'shortwave_penetration':
-        # Get some variables we'll need
-        z_edges_3d = z_to_xyz(grid.z_edges, grid)
-        dA_3d = xy_to_xyz(grid.dA, grid)
-        swfrac = 0.62*np.exp(z_edges_3d[:-1,:]/0.6) + (1-0.62)*np.exp(z_edges_3d[:-1,:]/20.)
-        swfrac1 = 0.62*np.exp(z_edges_3d[1:,:]/0.6) + (1-0.62)*np.exp(z_edges_3d[1:,:]/20.)
-        # Read shortwave flux at surface
-        data_xy = read_netcdf(file_path, 'oceQsw', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        if len(data_xy.shape)==2:
-            data_xy = np.expand_dims(data_xy,0)
-        # Loop over timesteps to calculate 3D penetration
-        data = np.ma.empty([data_xy.shape[0], grid.nz, grid.ny, grid.nx])
-        for t in range(data.shape[0]):
-            data[t,:] = xy_to_xyz(data_xy[t,:], grid)*(swfrac-swfrac1)*dA_3d/(rhoConst*Cp_sw)
-    else:
-        data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if var_name == 'THETA' and option in ['integrate', 'int_btw_z0']:
-        # Convert to Kelvin
-        data += temp_C2K
-    if len(data.shape)==3:
-        # Just one timestep; add a dummy time dimension
-        data = np.expand_dims(data,0)
+    if var_name == 'RHO' and rho is None:
+        print('Error (timeseries_avg_3d): must precompute density')
+        sys.exit()
+
+    # Inner generator to read the data one slab of time indices at a time, with a time dimension
+    def iter_data ():
+        if var_name == 'RHO':
+            data = rho
+            if len(data.shape)==3:
+                # Just one timestep; add a dummy time dimension
+                data = np.expand_dims(data,0)
+            yield data
+        elif var_name == 'TMINUSTF':
+            # For now, use surface freezing point
+            for temp, salt in iter_netcdf_list(file_path, ['THETA', 'SALT'], time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+                yield temp - tfreeze(salt, 0)
+        elif var_name == 'shortwave_penetration':
+            # Get some variables we'll need
+            z_edges_3d = z_to_xyz(grid.z_edges, grid)
+            dA_3d = xy_to_xyz(grid.dA, grid)
+            swfrac = 0.62*np.exp(z_edges_3d[:-1,:]/0.6) + (1-0.62)*np.exp(z_edges_3d[:-1,:]/20.)
+            swfrac1 = 0.62*np.exp(z_edges_3d[1:,:]/0.6) + (1-0.62)*np.exp(z_edges_3d[1:,:]/20.)
+            # Read shortwave flux at surface
+            for data_xy in iter_netcdf(file_path, 'oceQsw', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+                # Loop over timesteps to calculate 3D penetration
+                data = np.ma.empty([data_xy.shape[0], grid.nz, grid.ny, grid.nx])
+                for t in range(data.shape[0]):
+                    data[t,:] = xy_to_xyz(data_xy[t,:], grid)*(swfrac-swfrac1)*dA_3d/(rhoConst*Cp_sw)
+                yield data
+        else:
+            for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+                if var_name == 'THETA' and option in ['integrate', 'int_btw_z0']:
+                    # Convert to Kelvin
+                    data += temp_C2K
+                yield data
+
     if option in ['avg_btw_z0', 'int_btw_z0']:
         # Need to make mask 3D
         if mask is None:
             # Dummy mask
             mask = np.ones([grid.ny, grid.nx]).astype(bool)
         mask = mask_2d_to_3d(mask, grid, zmin=z0[0], zmax=z0[1])
+    # Shortwave penetration is already mass-weighted, so the integral between depths is just a regular sum
+    plain_sum = var_name == 'shortwave_penetration' and option == 'int_btw_z0'
+
+    if option in ['average', 'integrate', 'avg_btw_z0', 'int_btw_z0'] and gtype == 't':
+        # Volume average or integral over a fixed set of wet cells: find their indices and volumes once, and then each slab is just a gather and a dot product.
+        if mask is None:
+            # Dummy mask
+            mask = np.ones([grid.ny, grid.nx]).astype(bool)
+        if len(mask.shape) == 2:
+            mask = xy_to_xyz(mask, grid)
+        # Mask out land and ice shelves
+        index, weights = grid.get_mask_index(mask*(grid.hfac!=0))
+        if plain_sum:
+            weights = np.ones(index.size)
+        if option in ['average', 'avg_btw_z0']:
+            index_option = 'average'
+        else:
+            index_option = 'integrate'
+        return concatenate_slabs([over_index(index_option, data, index, weights, is_3d=True) for data in iter_data()])
     # Process one time index at a time to save memory
     timeseries = []
-    for t in range(data.shape[0]):
-        # First mask the land and ice shelves
-        data_tmp = mask_3d(data[t,:], grid, gtype=gtype)
-        if option in ['average', 'integrate']:
-            # 3D volume average
-            if mask is not None:
-                # Also mask outside the given region
-                data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
-            # Volume average or integrate
-            timeseries.append(over_volume(option, data_tmp, grid, gtype=gtype))
-        elif option == 'avg_btw_z0':
-            # 3D volume average between the given depths
-            data_tmp = apply_mask(data_tmp, np.invert(mask))
-            timeseries.append(volume_average(data_tmp, grid, gtype=gtype))
-        elif option == 'int_btw_z0':
-            # 3D volume integral between the given depths
-            data_tmp = apply_mask(data_tmp, np.invert(mask))
-            if var_name == 'shortwave_penetration':
-                # Already mass-weighted, so just do a regular sum
-                timeseries.append(np.sum(data_tmp))
-            else:
-                timeseries.append(volume_integral(data_tmp, grid, gtype=gtype))
-        elif option in ['avg_bottom', 'avg_z0']:
-            # 2D area-average
-            if option == 'avg_bottom':
-                # Select the bottom layer
-                data_tmp = select_bottom(data_tmp)
-            elif option == 'avg_z0':
-                # Interpolate to the given depth
-                data_tmp = interp_to_depth(data_tmp, z0, grid, gtype=gtype)
-            if mask is not None:
-                # Mask outside the given region
+    for data in iter_data():
+        for t in range(data.shape[0]):
+            # First mask the land and ice shelves
+            data_tmp = mask_3d(data[t,:], grid, gtype=gtype)
+            if option in ['average', 'integrate']:
+                # 3D volume average
+                if mask is not None:
+                    # Also mask outside the given region
+                    data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
+                # Volume average or integrate
+                timeseries.append(over_volume(option, data_tmp, grid, gtype=gtype))
+            elif option == 'avg_btw_z0':
+                # 3D volume average between the given depths
                 data_tmp = apply_mask(data_tmp, np.invert(mask))
-            # Area-average
-            timeseries.append(area_average(data_tmp, grid, gtype=gtype))
+                timeseries.append(volume_average(data_tmp, grid, gtype=gtype))
+            elif option == 'int_btw_z0':
+                # 3D volume integral between the given depths
+                data_tmp = apply_mask(data_tmp, np.invert(mask))
+                if plain_sum:
+                    timeseries.append(np.sum(data_tmp))
+                else:
+                    timeseries.append(volume_integral(data_tmp, grid, gtype=gtype))
+            elif option in ['avg_bottom', 'avg_z0']:
+                # 2D area-average
+                if option == 'avg_bottom':
+                    # Select the bottom layer
+                    data_tmp = select_bottom(data_tmp)
+                elif option == 'avg_z0':
+                    # Interpolate to the given depth
+                    data_tmp = interp_to_depth(data_tmp, z0, grid, gtype=gtype)
+                if mask is not None:
+                    # Mask outside the given region
+                    data_tmp = apply_mask(data_tmp, np.invert(mask))
+                # Area-average
+                timeseries.append(area_average(data_tmp, grid, gtype=gtype))
     return np.array(timeseries)
 
 
@@ -301,75 +336,59 @@ def timeseries_int_btw_z0 (file_path, var_name, z0, grid, gtype='t', time_index=
 
 def timeseries_thermocline (file_path, grid, mask=None, time_index=None, t_start=None, t_end=None, time_average=False):
 
-    data = read_netcdf(file_path, 'THETA', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(data.shape)==3:
-        data = np.expand_dims(data,0)
     timeseries = []
-    for t in range(data.shape[0]):
-        # Calculate the thermocline at every point - this will mask the land
-        data_tmp = thermocline(data[t,:], grid)
-        # Apply mask
-        if mask is not None:
-            data_tmp = apply_mask(data_tmp, np.invert(mask))
-        timeseries.append(area_average(data_tmp, grid))
+    for data in iter_netcdf(file_path, 'THETA', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(data.shape[0]):
+            # Calculate the thermocline at every point - this will mask the land
+            data_tmp = thermocline(data[t,:], grid)
+            # Apply mask
+            if mask is not None:
+                data_tmp = apply_mask(data_tmp, np.invert(mask))
+            timeseries.append(area_average(data_tmp, grid))
     return np.array(timeseries)
 
 
 # Find the depth of the shallowest given isotherm, below the given depth z0.
 def timeseries_iso_depth (file_path, var_name, val0, grid, z0=None, mask=None, time_index=None, t_start=None, t_end=None, time_average=False):
 
-    data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(data.shape)==3:
-        data = np.expand_dims(data,0)
     timeseries = []
-    for t in range(data.shape[0]):
-        data_tmp = mask_3d(data[t,:], grid)
-        if mask is not None:
-            data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
-        iso_depth_tmp = depth_of_isoline(data_tmp, grid.z, val0, z0=z0)
-        timeseries.append(area_average(iso_depth_tmp, grid))
+    for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(data.shape[0]):
+            data_tmp = mask_3d(data[t,:], grid)
+            if mask is not None:
+                data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
+            iso_depth_tmp = depth_of_isoline(data_tmp, grid.z, val0, z0=z0)
+            timeseries.append(area_average(iso_depth_tmp, grid))
     return np.array(timeseries)
 
 
 # Read the given 3D variable from the given NetCDF file, and calculate timeseries of its depth-averaged value over a given latitude and longitude.
 def timeseries_point_vavg (file_path, var_name, lon0, lat0, grid, gtype='t', time_index=None, t_start=None, t_end=None, time_average=False):
 
-    # Read the data
-    data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(data.shape)==3:
-        # Just one timestep; add a dummy time dimension
-        data = np.expand_dims(data,0)
-    # Interpolate to the point, and get hfac too
-    data_point, hfac_point = interp_bilinear(data, lon0, lat0, grid, gtype=gtype, return_hfac=True)
-    # Vertically average to get timeseries
-    return vertical_average_column(data_point, hfac_point, grid, gtype=gtype, time_dependent=True)
+    timeseries = []
+    # Read the data one slab of time indices at a time
+    for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        # Interpolate to the point, and get hfac too
+        data_point, hfac_point = interp_bilinear(data, lon0, lat0, grid, gtype=gtype, return_hfac=True)
+        # Vertically average to get timeseries
+        timeseries.append(vertical_average_column(data_point, hfac_point, grid, gtype=gtype, time_dependent=True))
+    return concatenate_slabs(timeseries)
 
 
 # Calculate timeseries of the Weddell Gyre transport in the given NetCDF file. Assumes the Weddell Gyre is actually in your domain.
 def timeseries_wed_gyre (file_path, grid, time_index=None, t_start=None, t_end=None, time_average=False):
 
-    # Read u
-    u = read_netcdf(file_path, 'UVEL', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(u.shape)==3:
-        # Just one timestep; add a dummy time dimension
-        u = np.expand_dims(u,0)
-    # Build the timeseries
+    # Read u one slab of time indices at a time, and build the timeseries
     timeseries = []
-    for t in range(u.shape[0]):
-        timeseries.append(wed_gyre_trans(u[t,:], grid))
+    for u in iter_netcdf(file_path, 'UVEL', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(u.shape[0]):
+            timeseries.append(wed_gyre_trans(u[t,:], grid))
     return np.array(timeseries)
 
 
 # Calculate timeseries of the volume (as a percentage of the entire domain, neglecting free surface changes) of the water mass between the given temperature and salinity bounds.
 def timeseries_watermass_volume (file_path, grid, tmin=None, tmax=None, smin=None, smax=None, time_index=None, t_start=None, t_end=None, time_average=False):
 
-    # Read T and S
-    temp = read_netcdf(file_path, 'THETA', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    salt = read_netcdf(file_path, 'SALT', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(temp.shape)==3:
-        # Just one timestep; add a dummy time dimension
-        temp = np.expand_dims(temp,0)
-        salt = np.expand_dims(salt,0)
     # Set any unset bounds
     if tmin is None:
         tmin = -9999
@@ -379,88 +398,68 @@ def timeseries_watermass_volume (file_path, grid, tmin=None, tmax=None, smin=Non
         smin = -9999
     if smax is None:
         smax = 9999
-    # Build the timeseries
+    # Read T and S one slab of time indices at a time, and build the timeseries
     timeseries = []
-    for t in range(temp.shape[0]):
-        # Find points within these bounds
-        index = (temp[t,:] >= tmin)*(temp[t,:] <= tmax)*(salt[t,:] >= smin)*(salt[t,:] <= smax)*(grid.hfac > 0)
-        # Integrate volume of those cells, and get percent of total volume
-        timeseries.append(np.sum(grid.dV[index])/np.sum(grid.dV)*100)
+    for temp, salt in iter_netcdf_list(file_path, ['THETA', 'SALT'], time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(temp.shape[0]):
+            # Find points within these bounds
+            index = (temp[t,:] >= tmin)*(temp[t,:] <= tmax)*(salt[t,:] >= smin)*(salt[t,:] <= smax)*(grid.hfac > 0)
+            # Integrate volume of those cells, and get percent of total volume
+            timeseries.append(np.sum(grid.dV[index])/np.sum(grid.dV)*100)
     return np.array(timeseries)
 
 
 # Calculate timeseries of the volume of the entire domain, including free surface changes.
 def timeseries_domain_volume (file_path, grid, time_index=None, t_start=None, t_end=None, time_average=False):
 
-    # Read free surface
-    eta = read_netcdf(file_path, 'ETAN', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(eta.shape)==2:
-        # Just one timestep; add a dummy time dimension
-        eta = np.expand_dims(eta,0)
     # Calculate volume without free surface changes
     volume = np.sum(grid.dV)
-    # Build the timeseries
+    # Read free surface one slab of time indices at a time, and build the timeseries
     timeseries = []
-    for t in range(eta.shape[0]):
-        # Get volume change in top layer due to free surface
-        volume_top = np.sum(eta[t,:]*grid.dA)
-        timeseries.append(volume+volume_top)
+    for eta in iter_netcdf(file_path, 'ETAN', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(eta.shape[0]):
+            # Get volume change in top layer due to free surface
+            volume_top = np.sum(eta[t,:]*grid.dA)
+            timeseries.append(volume+volume_top)
     return np.array(timeseries)
 
 
 # Calculate timeseries of the transport across the transect given by the two points. The sign convention is to assume point0 is "west" and point1 is "east", returning the "meridional" transport in the local coordinate system based on whether you want the net northward transport (direction='N') or southward (direction='S').
 def timeseries_transport_transect (file_path, grid, point0, point1, direction='N', time_index=None, t_start=None, t_end=None, time_average=False):
 
-    # Read u and v
-    u = mask_3d(read_netcdf(file_path, 'UVEL', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average), grid, gtype='u', time_dependent=True)
-    v = mask_3d(read_netcdf(file_path, 'VVEL', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average), grid, gtype='v', time_dependent=True)
-    if len(u.shape)==3:
-        # Just one timestep; add a dummy time dimension
-        u = np.expand_dims(u,0)
-        v = np.expand_dims(v,0)
-    # Build the timeseries
+    # Read u and v one slab of time indices at a time, and build the timeseries
     timeseries = []
-    for t in range(u.shape[0]):
-        # Get the "southward" and "northward" components
-        trans_S, trans_N =  transport_transect(u[t,:], v[t,:], grid, point0, point1)
-        # Combine them
-        if direction == 'N':
-            trans = trans_N - trans_S
-        elif direction == 'S':
-            trans = trans_S - trans_N
-        else:
-            print(('Error (timeseries_transport_transect): invalid direction ' + direction))
-            sys.exit()
-        timeseries.append(trans)
+    for u, v in iter_netcdf_list(file_path, ['UVEL', 'VVEL'], time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        u = mask_3d(u, grid, gtype='u', time_dependent=True)
+        v = mask_3d(v, grid, gtype='v', time_dependent=True)
+        for t in range(u.shape[0]):
+            # Get the "southward" and "northward" components
+            trans_S, trans_N =  transport_transect(u[t,:], v[t,:], grid, point0, point1)
+            # Combine them
+            if direction == 'N':
+                trans = trans_N - trans_S
+            elif direction == 'S':
+                trans = trans_S - trans_N
+            else:
+                print(('Error (timeseries_transport_transect): invalid direction ' + direction))
+                sys.exit()
+            timeseries.append(trans)
     return np.array(timeseries)
 
 
-# Helper function for timeseries_adv_dif and timeseries_adv_dif_bdry: read the x and y components of the data
-def read_data_xy (file_path, var_name, time_index=None, t_start=None, t_end=None, time_average=False):
+# Helper function for timeseries_adv_dif and timeseries_adv_dif_bdry: read the x and y components of the data, yielding one slab of time indices at a time (as in iter_netcdf_list).
+def iter_data_xy (file_path, var_name, time_index=None, t_start=None, t_end=None, time_average=False):
 
     # We were given the variable name for the x-component, now get the y-component
     var_x = var_name
     var_y = var_name.replace('x', 'y')
-    data_x = read_netcdf(file_path, var_x, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    data_y = read_netcdf(file_path, var_y, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    # Don't actually need to do this bit because it will become a convergence of fluxes
-    #if var_name == 'ADVx_TH':
-        # Need to convert to heat advection relative to freezing point
-        #u = read_netcdf(file_path, 'UVEL',  time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        #v = read_netcdf(file_path, 'VVEL',  time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        #grid = Grid(file_path)
-        #[data_x, data_y] = adv_heat_wrt_freezing([data_x, data_y], [u, v], grid)
-    if len(data_x.shape)==3:
-        # Just one timestep; add a dummy time dimension
-        data_x = np.expand_dims(data_x,0)
-        data_y = np.expand_dims(data_y,0)
-    return data_x, data_y
+    # Don't actually need to convert ADVx_TH to heat advection relative to freezing point (with adv_heat_wrt_freezing) because it will become a convergence of fluxes
+    return iter_netcdf_list(file_path, [var_x, var_y], time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
 
 
 # Calculate the net horizontal advection or diffusion into the given 3D region.
 def timeseries_adv_dif (file_path, var_name, grid, z0, time_index=None, t_start=None, t_end=None, time_average=False, mask=None):
 
-    data_x, data_y = read_data_xy(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
     if z0 is not None:
         # Mask out bounds
         if mask is None:
@@ -468,47 +467,42 @@ def timeseries_adv_dif (file_path, var_name, grid, z0, time_index=None, t_start=
         mask = mask_2d_to_3d(mask, grid, zmin=z0[0], zmax=z0[1])
     # Process one time index at a time to save memory
     timeseries = []
-    for t in range(data_x.shape[0]):
-        # Sum the fluxes across each face, padding with zeros at the eastern and northern boundaries of the domain
-        data_tmp = np.ma.zeros(data_x.shape[1:])
-        data_tmp[:,:-1,:-1] = data_x[t,:,:-1,:-1] - data_x[t,:,:-1,1:] + data_y[t,:,:-1,:-1] - data_y[t,:,1:,:-1]
-        # Sum over the given region
-        data_tmp = mask_3d(data_tmp, grid)
-        if mask is not None:
-            data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
-        timeseries.append(np.sum(data_tmp))
+    for data_x, data_y in iter_data_xy(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(data_x.shape[0]):
+            # Sum the fluxes across each face, padding with zeros at the eastern and northern boundaries of the domain
+            data_tmp = np.ma.zeros(data_x.shape[1:])
+            data_tmp[:,:-1,:-1] = data_x[t,:,:-1,:-1] - data_x[t,:,:-1,1:] + data_y[t,:,:-1,:-1] - data_y[t,:,1:,:-1]
+            # Sum over the given region
+            data_tmp = mask_3d(data_tmp, grid)
+            if mask is not None:
+                data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
+            timeseries.append(np.sum(data_tmp))
     return np.array(timeseries)
 
 
 # Calculate the net vertical advection or diffusion into the given 3D region.
 def timeseries_adv_dif_z (file_path, var_name, grid, z0, time_index=None, t_start=None, t_end=None, time_average=False, mask=None):
 
-    data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    if len(data.shape)==3:
-        data = np.expand_dims(data,0)
     if z0 is not None:
         # Mask out bounds
         if mask is None:
             mask = np.ones([grid.ny, grid.nx]).astype(bool)
         mask = mask_2d_to_3d(mask, grid, zmin=z0[0], zmax=z0[1])
     timeseries = []
-    for t in range(data.shape[0]):
-        data_tmp = np.ma.zeros(data.shape[1:])
-        data_tmp[:-1,:] = data[t,1:,:] - data[t,:-1,:]
-        data_tmp = mask_3d(data_tmp, grid)
-        if mask is not None:
-            data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
-        timeseries.append(np.sum(data_tmp))
+    for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(data.shape[0]):
+            data_tmp = np.ma.zeros(data.shape[1:])
+            data_tmp[:-1,:] = data[t,1:,:] - data[t,:-1,:]
+            data_tmp = mask_3d(data_tmp, grid)
+            if mask is not None:
+                data_tmp = apply_mask(data_tmp, np.invert(mask), depth_dependent=True)
+            timeseries.append(np.sum(data_tmp))
     return np.array(timeseries)
 
 
 # Calculate the net horizontal advection or diffusion across the given boundary into the given region.
 def timeseries_adv_dif_bdry (file_path, var_name, grid, region_mask, bdry_mask, time_index=None, t_start=None, t_end=None, time_average=False):
 
-    data_x, data_y = read_data_xy(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    # Now get data_x and data_y shifted one index to the east and north respectively
-    data_x_plus1 = neighbours(data_x)[1]
-    data_y_plus1 = neighbours(data_y)[3]
     # Find which points have neighbours outside the region, in each direction
     outside_w, outside_e, outside_s, outside_n = neighbours(region_mask.astype(float), missing_val=1)[4:8]
     def face_bdry_mask (outside):
@@ -517,21 +511,25 @@ def timeseries_adv_dif_bdry (file_path, var_name, grid, region_mask, bdry_mask,
     index_e = face_bdry_mask(outside_e)
     index_s = face_bdry_mask(outside_s)
     index_n = face_bdry_mask(outside_n)
-    # Process one time index at a time
+    # Process one slab of time indices at a time, and then one time index at a time
     timeseries = []
-    for t in range(data_x.shape[0]):
-        net_flux = 0
-        # Sum the flux across the western faces of all cells whose western faces are on the boundary of the region
-        if np.count_nonzero(index_w) > 0:
-            net_flux += np.sum(data_x[t,index_w])
-        # Similarly for the other boundaries
-        if np.count_nonzero(index_e) > 0:
-            net_flux += np.sum(-1*data_x_plus1[t,index_e])
-        if np.count_nonzero(index_s) > 0:
-            net_flux += np.sum(data_y[t,index_s])
-        if np.count_nonzero(index_n) > 0:
-            net_flux += np.sum(-1*data_y_plus1[t,index_n])
-        timeseries.append(net_flux)
+    for data_x, data_y in iter_data_xy(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        # Now get data_x and data_y shifted one index to the east and north respectively
+        data_x_plus1 = neighbours(data_x)[1]
+        data_y_plus1 = neighbours(data_y)[3]
+        for t in range(data_x.shape[0]):
+            net_flux = 0
+            # Sum the flux across the western faces of all cells whose western faces are on the boundary of the region
+            if np.count_nonzero(index_w) > 0:
+                net_flux += np.sum(data_x[t,index_w])
+            # Similarly for the other boundaries
+            if np.count_nonzero(index_e) > 0:
+                net_flux += np.sum(-1*data_x_plus1[t,index_e])
+            if np.count_nonzero(index_s) > 0:
+                net_flux += np.sum(data_y[t,index_s])
+            if np.count_nonzero(index_n) > 0:
+                net_flux += np.sum(-1*data_y_plus1[t,index_n])
+            timeseries.append(net_flux)
     return np.array(timeseries)
 
 
@@ -542,37 +540,34 @@ def timeseries_cavity_res_time (file_path, grid, shelf, time_index=None, t_start
     shelf_mask = grid.get_ice_mask(shelf=shelf)
     # Calculate volume of cavity
     cavity_vol = np.sum(grid.dV*xy_to_xyz(shelf_mask, grid))
-    # Read streamfunction, vertically integrate, and mask to given region
-    psi = read_netcdf(file_path, 'PsiVEL', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-    psi = np.sum(psi, axis=-3)
-    if len(psi.shape)==2:
-        # Just one timestep; add a dummy time dimension
-        psi = np.expand_dims(psi,0)
-    psi = apply_mask(psi, np.invert(shelf_mask), time_dependent=True)    
-    # Loop over timesteps
+    # Read streamfunction one slab of time indices at a time
     timeseries = []
-    for t in range(psi.shape[0]):
-        # Area-average absolute value of streamfunction
-        psi_mean = area_average(np.mean(psi[t,:]), grid)
-        # Divide volume by this value to get mean residence time, convert to years
-        res_time = cavity_vol/psi_mean/sec_per_year
-        timeseries.append(res_time)
+    for psi in iter_netcdf(file_path, 'PsiVEL', time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        # Vertically integrate, and mask to given region
+        psi = np.sum(psi, axis=-3)
+        psi = apply_mask(psi, np.invert(shelf_mask), time_dependent=True)
+        # Loop over timesteps
+        for t in range(psi.shape[0]):
+            # Area-average absolute value of streamfunction
+            psi_mean = area_average(np.mean(psi[t,:]), grid)
+            # Divide volume by this value to get mean residence time, convert to years
+            res_time = cavity_vol/psi_mean/sec_per_year
+            timeseries.append(res_time)
     return np.array(timeseries)
 
 
 # Calculate the difference in density between the two points.
 def timeseries_delta_rho (file_path, grid, point0, point1, z0, time_index=None, t_start=None, t_end=None, time_average=False, eosType='MDJWF'):
 
-    # Inner function to read a variable (temperature or salinity) and interpolate it to the given point
+    # Inner function to read a variable (temperature or salinity) one slab of time indices at a time, and interpolate it to the given point
     def read_interp_var (var_name, point):
-        data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
-        if len(data.shape)==3:
-            # Add a time dimension
-            data = np.expand_dims(data,0)
-        # Interpolate to the given depth
-        data_xy = interp_to_depth(data, z0, grid, time_dependent=True)
-        # Interpolate to the given point
-        return interp_bilinear(data_xy, point[0], point[1], grid)
+        data_point = []
+        for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+            # Interpolate to the given depth
+            data_xy = interp_to_depth(data, z0, grid, time_dependent=True)
+            # Interpolate to the given point
+            data_point.append(interp_bilinear(data_xy, point[0], point[1], grid))
+        return concatenate_slabs(data_point)
     
     # Inner function to do this for both temperature and salinity, and then calculate the timeseries of density at that point
     def density_point (point):
@@ -588,17 +583,14 @@ def timeseries_delta_rho (file_path, grid, point0, point1, z0, time_index=None,
 def timeseries_icefront_max (file_path, var_name, grid, shelf, time_index=None, t_start=None, t_end=None, time_average=False):
 
     mask = grid.get_icefront_mask(shelf=shelf)
-    data = read_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average)
     is_3d = var_name in ['THETA', 'SALT']  # Update this as needed when more variables are used
     if is_3d:
         mask = xy_to_xyz(mask, grid)*(grid.hfac!=0)
-    if (is_3d and len(data.shape)==3) or len(data.shape)==2:
-        # Just one timestep
-        data = np.expand_dims(data,0)
     timeseries = []
-    for t in range(data.shape[0]):
-        data_tmp = data[t,:]
-        timeseries.append(np.amax(data_tmp[mask]))
+    for data in iter_netcdf(file_path, var_name, time_index=time_index, t_start=t_start, t_end=t_end, time_average=time_average):
+        for t in range(data.shape[0]):
+            data_tmp = data[t,:]
+            timeseries.append(np.amax(data_tmp[mask]))
     return np.array(timeseries)
 
 
@@ -700,11 +692,15 @@ def calc_timeseries (file_path, option=None, grid=None, gtype='t', var_name=None
     if option == 'adv_dif_bdry':
         bdry_mask = grid.get_region_bdry_mask(region, bdry)
     
-    melt = None
-    freeze = None
-    values = None
-    time = None
-    for fname in file_path:
+    # Time axis of all the files, only read once
+    time_data = get_multi_file_dataset(file_path, monthly=monthly)
+    # Results from each file, to be concatenated at the end
+    melt = []
+    freeze = []
+    values = []
+    time = []
+    for n in range(len(file_path)):
+        fname = file_path[n]
         if option == 'ismr':
             if mass_balance:
                 melt_tmp, freeze_tmp = timeseries_ismr(fname, grid, shelf=region, mass_balance=mass_balance, result=result, time_average=time_average, z0=z0)
@@ -760,28 +756,30 @@ def calc_timeseries (file_path, option=None, grid=None, gtype='t', var_name=None
             values_tmp = timeseries_thermocline(fname, grid, mask=mask, time_average=time_average)
         elif option == 'iso_depth':
             values_tmp = timeseries_iso_depth(fname, var_name, val0, grid, z0=z0, mask=mask, time_average=time_average)
-        if not (option == 'ismr' and mass_balance):
+        if option != 'time' and not (option == 'ismr' and mass_balance):
             values_tmp = values_tmp*factor + offset
-        time_tmp = netcdf_time(fname, monthly=monthly)
+        time_tmp = time_data.file_times[n].copy()
         if time_average:
             # Just save the first time index
             time_tmp = np.array([time_tmp[0]])
-        if time is None:
-            # Initialise the arrays
-            if option == 'ismr' and mass_balance:
-                melt = melt_tmp
-                freeze = freeze_tmp
-            elif option != 'time':
-                values = values_tmp
-            time = time_tmp
-        else:
-            # Concatenate the arrays
-            if option == 'ismr' and mass_balance:
-                melt = np.concatenate((melt, melt_tmp))
-                freeze = np.concatenate((freeze, freeze_tmp))
-            elif option != 'time':
-                values = np.concatenate((values, values_tmp))
-            time = np.concatenate((time, time_tmp))
+        if option == 'ismr' and mass_balance:
+            melt.append(melt_tmp)
+            freeze.append(freeze_tmp)
+        elif option != 'time':
+            values.append(values_tmp)
+        time.append(time_tmp)
+
+    # Concatenate the arrays (if there's only one file, keep its results as they are)
+    def concat_files (data_list):
+        if len(data_list) == 1:
+            return data_list[0]
+        return np.concatenate(data_list)
+    time = concat_files(time)
+    if option == 'ismr' and mass_balance:
+        melt = concat_files(melt)
+        freeze = concat_files(freeze)
+    elif option != 'time':
+        values = concat_files(values)
 
     if option == 'ismr' and mass_balance:
         return time, melt, freeze
@@ -1453,6 +1451,46 @@ def calc_special_timeseries (var, file_path, grid=None, lon0=None, lat0=None, mo
         return time, data
 
 
+# Return a list of the NetCDF variables which calc_special_timeseries needs to read from the MITgcm output file for the given timeseries variable (as in set_parameters). This lets the caller plan ahead and read each variable only once, see precompute_timeseries.
+def timeseries_variables (var):
+
+    option, var_name = set_parameters(var)[:2]
+    if option == 'ismr':
+        return ['SHIfwFlx']
+    elif option == 'wed_gyre_trans':
+        return ['UVEL']
+    elif option in ['watermass', 'delta_rho']:
+        return ['THETA', 'SALT']
+    elif option == 'volume':
+        return ['ETAN']
+    elif option == 'transport_transect':
+        return ['UVEL', 'VVEL']
+    elif option == 'iceprod':
+        return ['SIdHbOCN', 'SIdHbATC', 'SIdHbATO', 'SIdHbFLO']
+    elif option == 'pmepr':
+        return ['oceFWflx', 'SIfwmelt', 'SIfwfrz']
+    elif option == 'res_time':
+        return ['PsiVEL']
+    elif option == 'thermocline':
+        return ['THETA']
+    elif option in ['adv_dif', 'adv_dif_bdry']:
+        return [var_name, var_name.replace('x', 'y')]
+    if isinstance(var_name, str):
+        var_name = [var_name]
+    var_list = []
+    for v in var_name:
+        if v == 'EXFwind':
+            var_list += ['EXFuwind', 'EXFvwind']
+        elif v in ['TminusTf', 'TMINUSTF', 'RHO']:
+            # Density is precomputed from temperature and salinity
+            var_list += ['THETA', 'SALT']
+        elif v == 'shortwave_penetration':
+            var_list += ['oceQsw']
+        else:
+            var_list += [v]
+    return var_list
+
+
 # Interface to calc_timeseries_diff for particular timeseries variables, defined in set_parameters.
 def calc_special_timeseries_diff (var, file_path_1, file_path_2, grid=None, lon0=None, lat0=None, monthly=True, rho=None, time_average=False):
 
@@ -1483,24 +1521,15 @@ def monthly_to_annual (data, time):
         print('Error (monthly_to_annual): timeseries must start with January.')
         sys.exit()
 
-    # Weighted average of each year, taking days per month into account
-    new_data = []
-    new_time = []
-    data_accum = 0
-    ndays = 0
-    for t in range(data.size):
-        ndays_curr = days_per_month(time[t].month, time[t].year)
-        data_accum += data[t]*ndays_curr
-        ndays += ndays_curr
-        if time[t].month == 12:
-            # End of the year
-            # Convert from integral to average
-            new_data.append(data_accum/ndays)
-            # Save the date at the beginning of the year
-            new_time.append(datetime.date(time[t].year, 1, 1))
-            # Reset the accumulation arrays
-            data_accum = 0
-            ndays = 0
+    # Weighted average of each complete year, taking days per month into account
+    years = np.array([t.year for t in time])
+    months = np.array([t.month for t in time])
+    starts = group_starts(years)
+    ends = np.append(starts[1:], years.size) - 1
+    complete = months[ends] == 12
+    new_data = segment_average(data, starts, weights=month_lengths(years, months))[complete]
+    # Save the date at the beginning of each year
+    new_time = [datetime.date(year, 1, 1) for year in years[starts[complete]]]
 
     return np.array(new_data), np.array(new_time)
 
@@ -1524,10 +1553,11 @@ def calc_annual_averages (times, datas):
 
     # Get midpoint of each year
     for n in range(len(times)):
-        times[n] = np.array([times[n][i] for i in range(6, times[n].size, 12)])
+        times[n] = times[n][6::12]
     # Average in blocks of 12
     for n in range(len(datas)):
-        datas[n] = np.mean(datas[n].reshape(datas[n].shape[0]//12, 12), axis=-1)
+        num_years = datas[n].shape[0]//12
+        datas[n] = segment_average(datas[n][:num_years*12], np.arange(0, num_years*12, 12))
 
     if time_single:
         times = times[0]
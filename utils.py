@@ -6,6 +6,7 @@ import numpy as np
 import sys
 
 from .constants import rho_fw, sec_per_year, region_bounds, deg2rad, rEarth
+from .resample import month_lengths, segment_average, daily_to_monthly_average
 
 
 # Given an array containing longitude, make sure it's in the range (max_lon-360, max_lon). Default is (-180, 180). If max_lon is None, nothing will be done to the array.
@@ -545,6 +546,28 @@ def dist_btw_points (point0, point1):
     return np.sqrt(dx**2 + dy**2)
 
 
+# Convert lon-lat points (in degrees, arrays of any shape) to 3D Cartesian coordinates on the surface of the Earth. Returns an array of the same shape plus a trailing dimension of size 3. Straight-line distances between these points are very close to great-circle distances over the scales of a model grid, so they can be used with KD-trees.
+def lonlat_to_cartesian (lon, lat):
+    lon = np.ma.getdata(lon)*deg2rad
+    lat = np.ma.getdata(lat)*deg2rad
+    return rEarth*np.stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)), axis=-1)
+
+
+# Find the distance (in m) from every lon-lat point to the closest point where mask is True. lon, lat, and mask are arrays of the same shape. Distances are straight-line distances between points on the surface of the Earth (see lonlat_to_cartesian), found using a KD-tree of the masked points, so it takes one pass instead of looping over the masked points.
+# If return_index=True, also return the index of the closest point within the array of masked points (eg lon[mask]).
+def distance_to_mask (lon, lat, mask, return_index=False):
+
+    from scipy.spatial import cKDTree
+
+    points = lonlat_to_cartesian(lon, lat)
+    tree = cKDTree(points[mask])
+    distance, index = tree.query(np.reshape(points, (-1,3)))
+    if return_index:
+        return np.reshape(distance, mask.shape), np.reshape(index, mask.shape)
+    else:
+        return np.reshape(distance, mask.shape)
+
+
 # Find all ice shelf front points and return them as a list.
 # For a specific ice shelf, pass a special ice_mask 
 def ice_shelf_front_points (grid, ice_mask=None, gtype='t', xmin=None, xmax=None, ymin=None, ymax=None):
@@ -659,17 +682,7 @@ def daily_to_monthly (data, year=1979, per_day=1):
     if data.shape[0]//per_day not in [365, 366]:
         print('Error (daily_to_monthly): The first dimension is not time, or else this is not one year of data.')
         sys.exit()
-    new_shape = [12] + list(data.shape[1:])
-    if isinstance(data, np.ma.MaskedArray):
-        data_monthly = np.ma.empty(new_shape)
-    else:
-        data_monthly = np.empty(new_shape)
-    t = 0
-    for month in range(12):
-        nt = days_per_month(month+1, year)*per_day
-        data_monthly[month,...] = np.mean(data[t:t+nt,...], axis=0)
-        t += nt
-    return data_monthly
+    return daily_to_monthly_average(data, year=year, per_day=per_day)
 
 
 # Given a set of titles, find the common parts from the beginning and the end of each title. Trim them and return the master beginning title (trimmed of unnecessary prepositions) as well as the trimmed individual titles.
@@ -804,14 +817,8 @@ def average_12_months (data, t0, calendar='standard', year=None):
 
     if calendar == 'standard' and year is None:
         print('Error (average_12_months): must provide year')
-    if calendar in ['360-day', '360_day']:
-        days = None
-    else:
-        if calendar == 'noleap':
-            # Dummy year
-            year = 1979
-        days = np.array([days_per_month(n, year) for n in np.arange(1,12+1)])
-    return np.ma.average(data[t0:t0+12,...], axis=0, weights=days)
+    days = month_lengths(year, np.arange(1,12+1), calendar=calendar)
+    return segment_average(np.ma.asarray(data[t0:t0+12,...]), [0], weights=days)[0]
 
 
 # Calculate the depth of the maximum value of the 3D field at each x-y point.